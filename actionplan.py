@@ -0,0 +1,528 @@
+#!/usr/bin/python
+
+"""Plans of file system actions, run concurrently and journaled.
+
+Tools like cleanup.py first build an ActionPlan of moves, deletes and rmdirs
+without touching the file system. An ActionExecutor then runs the plan in a
+bounded thread pool. The actions are grouped by directory: each group runs
+in order in one thread, while the groups run concurrently. On network shares,
+where every file system call is a round trip, that hides most of the
+latency.
+
+Before anything is touched, the whole plan is written to a write-ahead
+Journal, and every finished action is recorded in it. An interrupted run can
+therefore be resumed, or rolled back. Deleted files are only moved into a
+trash directory at the root of their file system, so a delete stays a single
+rename and a rollback can restore them as well. The trash is purged when the
+next plan is started, or with Journal.purge.
+"""
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+import simplejson
+
+MOVE = 'move'
+DELETE = 'delete'
+RMDIR = 'rmdir'
+DEFAULT_WORKERS = 8
+TRASH_DIR = '.pytunes-trash'
+
+logger = logging.getLogger(__name__)
+
+
+class JournalError(Exception):
+    """Raised when a journal can't be used for the requested operation."""
+
+
+class Action(object):
+    """A single file system action: a move, a delete or an rmdir."""
+
+    __slots__ = ('kind', 'source', 'target')
+
+    def __init__(self, kind, source, target=None):
+        """Creates a new Action.
+
+        @param kind: MOVE, DELETE or RMDIR.
+        @type kind: str
+        @param source: The file to move or delete, or the directory to remove.
+        @type source: unicode
+        @param target: Where to move the file to. Only for MOVE.
+        @type target: unicode
+        """
+        if kind not in (MOVE, DELETE, RMDIR):
+            raise ValueError('Unknown action: %s' % kind)
+        self.kind = kind
+        self.source = source
+        self.target = target
+
+    @property
+    def directory(self):
+        """The directory the action is grouped by."""
+        if self.kind == RMDIR:
+            return self.source
+        return os.path.dirname(self.source)
+
+    def run(self, trash_path=None):
+        """Runs the action.
+
+        @param trash_path: Where to move a deleted file to, so it can be
+                restored. Only for DELETE. If the file can't be moved there,
+                it is removed.
+        @type trash_path: str
+        """
+        if self.kind == MOVE:
+            os.rename(self.source, self.target)
+        elif self.kind == DELETE:
+            self._trash(trash_path)
+        else:
+            os.rmdir(self.source)
+
+    def _trash(self, trash_path):
+        try:
+            try:
+                os.rename(self.source, trash_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT or not os.path.lexists(self.source):
+                    raise
+                # The first delete into this trash directory.
+                _makedirs(os.path.dirname(trash_path))
+                os.rename(self.source, trash_path)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM,
+                               errno.EROFS):
+                raise
+            logger.warning(u'Cannot move %s to the trash, removing it: %s',
+                           self.source, e)
+            os.remove(self.source)
+
+    def is_done(self):
+        """Whether the file system already reflects this action.
+
+        Used to find out whether an interrupted run got to an action before it
+        could record it in the journal.
+        """
+        if self.kind == MOVE:
+            return (not os.path.lexists(self.source) and
+                    os.path.lexists(self.target))
+        return not os.path.lexists(self.source)
+
+    def can_undo(self, trash_path=None):
+        """Whether the action can still be undone. A deleted file can't once
+        the trash is purged.
+        """
+        return self.kind != DELETE or os.path.lexists(trash_path)
+
+    def undo(self, trash_path=None):
+        """Undoes the action.
+
+        @param trash_path: Where the deleted file was moved to. Only for
+                DELETE.
+        @type trash_path: str
+        """
+        if self.kind == MOVE:
+            os.rename(self.target, self.source)
+        elif self.kind == DELETE:
+            os.rename(trash_path, self.source)
+        else:
+            os.mkdir(self.source)
+
+    def to_json(self):
+        return {
+            'kind': self.kind,
+            'source': self.source,
+            'target': self.target,
+        }
+
+    @staticmethod
+    def from_json(item):
+        return Action(item['kind'], item['source'], item.get('target'))
+
+    def _key(self):
+        return self.kind, self.source, self.target
+
+    def __eq__(self, other):
+        return isinstance(other, Action) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __unicode__(self):
+        if self.kind == MOVE:
+            return u'mv "%s" "%s"' % (self.source, self.target)
+        if self.kind == DELETE:
+            return u'rm "%s"' % self.source
+        return u'rmdir "%s"' % self.source
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class ActionPlan(object):
+    """An ordered list of actions, without duplicates."""
+
+    def __init__(self, actions=None):
+        self.actions = []
+        self._seen = set()
+        for action in actions or []:
+            self.add(action)
+
+    def add(self, action):
+        """Appends an action, unless it is already part of the plan.
+
+        @type action: Action
+        """
+        if action in self._seen:
+            return
+        self._seen.add(action)
+        self.actions.append(action)
+
+    def move(self, source, target):
+        self.add(Action(MOVE, source, target))
+
+    def delete(self, source):
+        self.add(Action(DELETE, source))
+
+    def rmdir(self, source):
+        self.add(Action(RMDIR, source))
+
+    def extend(self, plan):
+        for action in plan:
+            self.add(action)
+
+    def group_by_directory(self):
+        """Groups the actions by directory, keeping their order.
+
+        @return: The directories and their actions with their indexes in the
+                plan, in order of first appearance.
+        @rtype: [(unicode, [(int, Action)])]
+        """
+        groups = collections.OrderedDict()
+        for i, action in enumerate(self.actions):
+            groups.setdefault(action.directory, []).append((i, action))
+        return groups.items()
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+
+class Journal(object):
+    """A write-ahead journal of a plan being run, stored as JSON lines.
+
+    The first records are the actions of the plan. They are followed by a
+    record per finished, failed or undone action, and a final record once a
+    run or rollback completed.
+
+    The files deleted by the plan are kept until the next plan is started or
+    the trash is purged, in a directory of the journal under TRASH_DIR at the
+    root of their file system (see trash_path).
+    """
+
+    def __init__(self, path):
+        """Opens a journal, which may not exist yet.
+
+        @type path: str
+        """
+        self.path = path
+        self._trash_id = hashlib.md5(os.path.abspath(path)).hexdigest()[:12]
+        self._mount_points = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._reset()
+        if os.path.exists(path):
+            self._load()
+
+    @property
+    def exists(self):
+        return bool(self.plan)
+
+    @property
+    def is_finished(self):
+        """Whether the last run or rollback of the journal completed."""
+        return self.completed is not None
+
+    def start(self, plan):
+        """Records a new plan, replacing a finished journal and purging its
+        trash.
+
+        The plan is synced to disk before this returns.
+
+        @raise JournalError: If the journal has an unfinished plan.
+        """
+        if self.exists and not self.is_finished:
+            raise JournalError(
+                    'Unfinished journal %s, resume or roll it back first.'
+                    % self.path)
+        self.close()
+        self.purge()
+        self._reset()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.plan = ActionPlan(plan)
+        self._file = open(self.path, 'w')
+        for i, action in enumerate(self.plan):
+            record = action.to_json()
+            record['action'] = i
+            self._write(record)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def trash_path(self, i):
+        """Where the file deleted by the i-th action is kept:
+        MOUNT_POINT/TRASH_DIR/JOURNAL_ID/i, so moving it there is a rename on
+        the same file system.
+
+        @rtype: unicode
+        """
+        return os.path.join(
+                self._trash_dir(self.plan.actions[i].directory), str(i))
+
+    def _trash_dir(self, directory):
+        # Looking up the mount point takes a stat per parent directory, so
+        # it is only done once per directory.
+        mount_point = self._mount_points.get(directory)
+        if mount_point is None:
+            mount_point = _find_mount_point(directory)
+            self._mount_points[directory] = mount_point
+        return os.path.join(mount_point, TRASH_DIR, self._trash_id)
+
+    def purge(self):
+        """Removes the trash, so the deleted files are gone for good.
+
+        @raise JournalError: If the journal has an unfinished plan.
+        """
+        if self.exists and not self.is_finished:
+            raise JournalError(
+                    'Unfinished journal %s, resume or roll it back first.'
+                    % self.path)
+        trash_dirs = set(self._trash_dir(action.directory)
+                         for action in self.plan if action.kind == DELETE)
+        for trash_dir in sorted(trash_dirs):
+            if os.path.isdir(trash_dir):
+                logger.info(u'Purging %s...', trash_dir)
+                shutil.rmtree(trash_dir)
+
+    def mark_done(self, i):
+        self.done.add(i)
+        self._append({'done': i})
+
+    def mark_failed(self, i, error):
+        self.failed.add(i)
+        self._append({'failed': i, 'error': unicode(error)})
+
+    def mark_undone(self, i):
+        self.done.discard(i)
+        self.undone.add(i)
+        self._append({'undone': i})
+
+    def mark_completed(self, operation):
+        """Records that a run or rollback completed."""
+        self.completed = operation
+        self._append({'completed': operation})
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append(self, record):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._write(record)
+            self._file.flush()
+
+    def _reset(self):
+        self.plan = ActionPlan()
+        self.done = set()
+        self.failed = set()
+        self.undone = set()
+        self.completed = None
+
+    def _write(self, record):
+        self._file.write(simplejson.dumps(record) + '\n')
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = simplejson.loads(line)
+                except ValueError:
+                    # The last line of an interrupted run may be incomplete.
+                    logger.warning('Ignoring a broken journal record.')
+                    continue
+                if 'action' in record:
+                    self.plan.actions.append(Action.from_json(record))
+                elif 'done' in record:
+                    self.done.add(record['done'])
+                    self.failed.discard(record['done'])
+                elif 'failed' in record:
+                    self.failed.add(record['failed'])
+                elif 'undone' in record:
+                    self.done.discard(record['undone'])
+                    self.undone.add(record['undone'])
+                elif 'completed' in record:
+                    self.completed = record['completed']
+        self.plan = ActionPlan(self.plan.actions)
+
+
+class ActionExecutor(object):
+    """Runs, resumes and rolls back action plans in a thread pool."""
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        """Creates a new ActionExecutor.
+
+        @param workers: The number of threads, and so the number of
+                directories worked on at the same time. Optional. Defaults to
+                8.
+        @type workers: int
+        """
+        self.workers = workers
+
+    def run(self, plan, journal):
+        """Runs a plan, recording it in the journal first.
+
+        The actions of a directory are skipped if the directory doesn't exist.
+        Failed actions are logged and don't stop the run.
+
+        @type plan: ActionPlan
+        @type journal: Journal
+        @return: The number of done, failed and skipped actions.
+        @rtype: collections.Counter
+        """
+        journal.start(plan)
+        return self._run(journal, resume=False)
+
+    def resume(self, journal):
+        """Runs the actions of an interrupted plan that aren't done yet.
+
+        Actions the file system already reflects are only recorded as done.
+
+        @type journal: Journal
+        @rtype: collections.Counter
+        """
+        if not journal.exists:
+            raise JournalError('No plan in journal %s.' % journal.path)
+        if journal.completed == 'rollback':
+            raise JournalError(
+                    'Journal %s has been rolled back.' % journal.path)
+        return self._run(journal, resume=True)
+
+    def rollback(self, journal):
+        """Undoes the done actions of a plan, last ones first.
+
+        @type journal: Journal
+        @return: The number of undone, failed and unrecoverable actions.
+        @rtype: collections.Counter
+        """
+        if not journal.exists:
+            raise JournalError('No plan in journal %s.' % journal.path)
+        groups = journal.plan.group_by_directory()
+        groups.reverse()
+        counts = self._map(
+                lambda group: self._rollback_group(journal, group[1]), groups)
+        journal.mark_completed('rollback')
+        return counts
+
+    def _run(self, journal, resume):
+        groups = journal.plan.group_by_directory()
+        counts = self._map(
+                lambda group: self._run_group(journal, group, resume), groups)
+        journal.mark_completed('run')
+        return counts
+
+    def _map(self, function, groups):
+        counts = collections.Counter()
+        if not groups:
+            return counts
+        pool = ThreadPool(min(self.workers, len(groups)))
+        try:
+            for group_counts in pool.imap_unordered(function, groups):
+                counts.update(group_counts)
+        finally:
+            pool.close()
+            pool.join()
+        return counts
+
+    def _run_group(self, journal, group, resume):
+        directory, actions = group
+        counts = collections.Counter()
+        pending = [(i, a) for i, a in actions if i not in journal.done]
+        if not pending:
+            return counts
+        if not resume and not os.path.isdir(directory):
+            logger.warning('Path does not exist: %s.', directory)
+            counts['skipped'] += len(pending)
+            return counts
+        for i, action in pending:
+            if resume and action.is_done():
+                journal.mark_done(i)
+                counts['done'] += 1
+                continue
+            logger.info(u'%s', action)
+            try:
+                action.run(journal.trash_path(i))
+            except (OSError, IOError), e:
+                logger.error(e)
+                journal.mark_failed(i, e)
+                counts['failed'] += 1
+            else:
+                journal.mark_done(i)
+                counts['done'] += 1
+        return counts
+
+    def _rollback_group(self, journal, actions):
+        counts = collections.Counter()
+        for i, action in reversed(actions):
+            if i not in journal.done:
+                continue
+            trash_path = journal.trash_path(i)
+            if not action.can_undo(trash_path):
+                logger.warning(
+                        'Cannot restore deleted file: %s', action.source)
+                counts['unrecoverable'] += 1
+                continue
+            logger.info(u'Undoing %s', action)
+            try:
+                action.undo(trash_path)
+            except (OSError, IOError), e:
+                logger.error(e)
+                counts['failed'] += 1
+            else:
+                journal.mark_undone(i)
+                counts['undone'] += 1
+        return counts
+
+
+def _find_mount_point(path):
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _makedirs(path):
+    """Like os.makedirs, but fine if another thread created it first."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
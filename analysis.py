@@ -2,30 +2,64 @@
 
 """A Python library to analyze your iTunes library.
 
-All functions expect data from the pytunes library.
+All functions expect data from the pytunes library. The *_in_table variants
+work on a tracktable.TrackTable instead of a list of tracks and run
+vectorized.
 """
 
+import errno
+import os
+import os.path
+import sys
+import unicodedata
+from multiprocessing.pool import ThreadPool
 
+import duplicates
+import filehashes
+import idset
+import profiling
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# The file extensions considered audio files by the file scan.
+AUDIO_EXTENSIONS = frozenset([
+        '.aac', '.aif', '.aiff', '.flac', '.m4a', '.m4b', '.m4p', '.mp3',
+        '.ogg', '.wav', '.wma'])
+
+
+@profiling.profiled('analysis.find_completely_rated_albums')
 def find_completely_rated_albums(albums):
     return filter(lambda a: a.rating_completeness == 1, albums)
 
 
+@profiling.profiled('analysis.find_incompletely_rated_albums')
 def find_incompletely_rated_albums(albums):
     return filter(lambda a: a.rating_completeness < 1, albums)
 
 
+@profiling.profiled('analysis.find_compilations')
 def find_compilations(albums):
     return filter(lambda a: a.is_compilation, albums)
 
 
+@profiling.profiled('analysis.find_single_tracks')
 def find_single_tracks(all_tracks, albums):
-    tracks_in_albums = set()
-    for album in albums:
-        tracks_in_albums.update(set(album.tracks))
-    single_tracks = set(all_tracks) - tracks_in_albums
-    return single_tracks
+    """Finds the tracks that aren't part of any album.
+
+    The album tracks are only kept as a bitmap of their IDs, and all_tracks
+    is iterated once, so it can be a generator or a pipeline.
+
+    @rtype: set(Track)
+    """
+    album_track_ids = idset.IdSet(
+            t.id for album in albums for t in album.tracks)
+    return set(t for t in all_tracks if t.id not in album_track_ids)
 
 
+@profiling.profiled('analysis.find_crappy_single_tracks')
 def find_crappy_single_tracks(all_tracks, albums, min_rating=80):
     single_tracks = find_single_tracks(all_tracks, albums)
     # 10 means 0 stars in iTunes. We consider 0 stars as unrated.
@@ -34,6 +68,23 @@ def find_crappy_single_tracks(all_tracks, albums, min_rating=80):
             single_tracks)
 
 
+@profiling.profiled('analysis.find_single_tracks_in_table')
+def find_single_tracks_in_table(table, albums):
+    """Like find_single_tracks, but returns a mask of the table."""
+    album_track_ids = [t.id for album in albums for t in album.tracks]
+    return ~table.isin('id', album_track_ids)
+
+
+@profiling.profiled('analysis.find_crappy_single_tracks_in_table')
+def find_crappy_single_tracks_in_table(table, albums, min_rating=80):
+    single_tracks = find_single_tracks_in_table(table, albums)
+    ratings = table.column('rating')
+    # 10 means 0 stars in iTunes. We consider 0 stars as unrated.
+    return table.get_tracks(
+            single_tracks & (10 < ratings) & (ratings < min_rating))
+
+
+@profiling.profiled('analysis.find_crappy_albums')
 def find_crappy_albums(albums, min_good_tracks=4, min_rating=80):
     completely_rated_albums = find_completely_rated_albums(albums)
     for album in completely_rated_albums:
@@ -42,21 +93,261 @@ def find_crappy_albums(albums, min_good_tracks=4, min_rating=80):
             yield album
 
 
+@profiling.profiled('analysis.find_duplicates')
 def find_duplicates(tracks, tolerated_time_difference=10):
-    grouped_tracks = {}
-    for track in tracks:
-        key = '%s-%s' % (track.artist, track.name)
-        grouped_tracks.setdefault(key, [])
-        grouped_tracks[key].append(track)
+    """Finds tracks with the same artist and name and a similar total time.
+
+    @return: All tracks that have at least one duplicate.
+    @rtype: set(Track)
+    """
+    finder = duplicates.DuplicateFinder(
+            [duplicates.DurationSweepRule(tolerated_time_difference)])
+    return set(t for c in finder.find_clusters(tracks) for t in c.tracks)
+
+
+@profiling.profiled('analysis.find_duplicate_clusters')
+def find_duplicate_clusters(
+        tracks, tolerated_time_difference=10, fuzzy_rule=None):
+    """Finds clusters of exact and fuzzy duplicates.
+
+    @param fuzzy_rule: The rule for fuzzy duplicates. Optional. Defaults to a
+            duplicates.FuzzyRule with default settings.
+    @type fuzzy_rule: duplicates.FuzzyRule
+    @return: The clusters, best matches first.
+    @rtype: [duplicates.DuplicateCluster]
+    """
+    rules = [
+        duplicates.DurationSweepRule(tolerated_time_difference),
+        fuzzy_rule or duplicates.FuzzyRule(),
+    ]
+    return duplicates.DuplicateFinder(rules).find_clusters(tracks)
+
+
+@profiling.profiled('analysis.find_duplicates_in_table')
+def find_duplicates_in_table(table, tolerated_time_difference=10):
+    """Like find_duplicates, but on a table.
+
+    Instead of grouping the tracks, all rows are sorted by artist, name and
+    total time at once, so tracks with the same artist and name and a similar
+    total time end up next to each other.
+    """
+    order = table.argsort('artist', 'name', 'total_time')
+    artists = table.column('artist')[order]
+    names = table.column('name')[order]
+    total_times = table.column('total_time')[order]
+    is_duplicate = (
+            (artists[1:] == artists[:-1]) &
+            (names[1:] == names[:-1]) &
+            (total_times[1:] - total_times[:-1] <= tolerated_time_difference))
     duplicates = set()
-    for group in grouped_tracks.itervalues():
-        tracks_sorted_by_time = sorted(group, key=lambda t: t.total_time)
-        last_track = None
-        for track in tracks_sorted_by_time:
-            if last_track is not None:
-                time_difference = abs(last_track.total_time - track.total_time)
-                if time_difference <= tolerated_time_difference:
-                    duplicates.add(last_track)
-                    duplicates.add(track)
-            last_track = track
+    for i in is_duplicate.nonzero()[0]:
+        duplicates.add(table.tracks[order[i]])
+        duplicates.add(table.tracks[order[i + 1]])
     return duplicates
+
+
+@profiling.profiled('analysis.find_duplicate_files')
+def find_duplicate_files(tracks, workers=16, cache=None):
+    """Finds tracks whose files have the same content, even if their tags or
+    paths differ, e.g. the same file imported twice.
+
+    Only tracks with the same size and total time can share a file content,
+    so the files are bucketed by those first and files alone in their bucket
+    are never read. Within a bucket, the files are told apart by a hash of
+    their first and last blocks, and only files with the same partial hash
+    are hashed fully. The files are read in a thread pool.
+
+    @param workers: The number of files read at the same time. Optional.
+            Defaults to 16.
+    @type workers: int
+    @param cache: The cache of the hashes. Optional. Defaults to none.
+    @type cache: filehashes.HashCache
+    @return: The groups of tracks with the same file content, each sorted by
+            id, sorted by the id of their first track. Tracks pointing to the
+            same file are in the same group.
+    @rtype: [[Track]]
+    """
+    buckets = {}
+    for track in tracks:
+        if track.path is None or not track.size:
+            continue
+        key = (track.size, track.total_time)
+        buckets.setdefault(key, {}).setdefault(track.path, []).append(track)
+
+    candidates = [
+            paths for paths in buckets.itervalues()
+            if len(paths) > 1 or len(paths.values()[0]) > 1]
+    hasher = filehashes.FileHasher(cache, workers)
+    partial_hashes = hasher.partial_hashes(
+            path for paths in candidates if len(paths) > 1 for path in paths)
+
+    groups = []
+    pending = []
+    for paths in candidates:
+        by_partial_hash = {}
+        for path in paths:
+            if len(paths) > 1:
+                partial_hash = partial_hashes.get(path)
+                if partial_hash is None:
+                    continue
+            else:
+                # Tracks pointing to the same file don't need to be read.
+                partial_hash = None
+            by_partial_hash.setdefault(partial_hash, []).append(path)
+        for partial_hash, same_paths in by_partial_hash.iteritems():
+            if len(same_paths) > 1:
+                pending.append([(p, paths[p]) for p in same_paths])
+            elif len(paths[same_paths[0]]) > 1:
+                groups.append(paths[same_paths[0]])
+
+    full_hashes = hasher.full_hashes(
+            path for same_paths in pending for path, _ in same_paths)
+    for same_paths in pending:
+        by_full_hash = {}
+        for path, path_tracks in same_paths:
+            full_hash = full_hashes.get(path)
+            if full_hash is None:
+                continue
+            by_full_hash.setdefault(full_hash, []).extend(path_tracks)
+        groups.extend(
+                group for group in by_full_hash.itervalues() if len(group) > 1)
+
+    groups = [sorted(group, key=lambda t: t.id) for group in groups]
+    groups.sort(key=lambda g: g[0].id)
+    return groups
+
+
+class FileScanResult(object):
+    """The result of find_dead_tracks_and_orphan_files."""
+
+    def __init__(self):
+        # Tracks whose file doesn't exist, sorted by path.
+        self.dead_tracks = []
+        # Audio files no track points to, sorted.
+        self.orphan_files = []
+        # Directories that exist but couldn't be listed, and the errors.
+        self.unreadable_directories = []
+
+
+@profiling.profiled('analysis.find_dead_tracks_and_orphan_files')
+def find_dead_tracks_and_orphan_files(
+        tracks, roots=(), workers=16, extensions=AUDIO_EXTENSIONS):
+    """Finds tracks whose files are gone, and audio files without a track.
+
+    Instead of checking every file, the tracks are grouped by directory and
+    each directory is listed once, in a thread pool. That is a lot faster on
+    network shares, where every call is a round trip.
+
+    @param roots: Directories to search for orphan files recursively.
+            Optional. Without roots, only the directories of the tracks are
+            searched.
+    @type roots: [unicode]
+    @param workers: The number of directories listed at the same time.
+            Optional. Defaults to 16.
+    @type workers: int
+    @param extensions: The extensions of the files considered audio files.
+    @type extensions: set(str)
+    @rtype: FileScanResult
+    """
+    tracks_by_directory = {}
+    for track in tracks:
+        path = track.path
+        if path is None:
+            continue
+        directory, name = os.path.split(path)
+        directory = _normalize_path(directory)
+        names = tracks_by_directory.setdefault(directory, {})
+        names.setdefault(_normalize_file_name(name), []).append(track)
+
+    listings = {}
+    pool = ThreadPool(workers)
+    try:
+        # Walk the roots level by level, then list the directories of tracks
+        # outside the roots.
+        pending = set(_normalize_path(os.path.abspath(root)) for root in roots)
+        while pending:
+            listings.update(pool.imap_unordered(
+                    lambda d: (d, _list_directory(d, extensions, True)),
+                    pending))
+            pending = set(
+                    subdir for d in pending if listings[d][0] is None
+                    for subdir in listings[d][2]
+                    if subdir not in listings)
+        pending = [d for d in tracks_by_directory if d not in listings]
+        listings.update(pool.imap_unordered(
+                lambda d: (d, _list_directory(d, extensions, False)),
+                pending))
+    finally:
+        pool.close()
+        pool.join()
+
+    result = FileScanResult()
+    for directory, (error, files, _) in listings.iteritems():
+        names = tracks_by_directory.get(directory, {})
+        if error is None:
+            for name, file_name in files.iteritems():
+                if name not in names:
+                    result.orphan_files.append(
+                            os.path.join(directory, file_name))
+            for name, name_tracks in names.iteritems():
+                if name not in files:
+                    result.dead_tracks.extend(name_tracks)
+        elif error.errno in (errno.ENOENT, errno.ENOTDIR):
+            for name_tracks in names.itervalues():
+                result.dead_tracks.extend(name_tracks)
+        else:
+            result.unreadable_directories.append((directory, error))
+    result.dead_tracks.sort(key=lambda t: t.path)
+    result.orphan_files.sort()
+    result.unreadable_directories.sort()
+    return result
+
+
+def _list_directory(directory, extensions, with_subdirs):
+    """Lists the audio files, and optionally the subdirectories, of a
+    directory.
+
+    @return: The error if the directory can't be listed, the audio files
+            keyed by their normalized names and the subdirectories.
+    @rtype: (OSError, {unicode: unicode}, [unicode])
+    """
+    files = {}
+    subdirs = []
+    try:
+        if scandir is not None:
+            # The entry types mostly come with the listing itself, so this
+            # doesn't need a stat per entry.
+            for entry in scandir(directory):
+                if entry.is_dir():
+                    if with_subdirs:
+                        subdirs.append(_normalize_path(entry.path))
+                elif _is_audio_file(entry.name, extensions):
+                    files[_normalize_file_name(entry.name)] = entry.name
+        else:
+            for name in os.listdir(directory):
+                if _is_audio_file(name, extensions):
+                    files[_normalize_file_name(name)] = name
+                elif with_subdirs:
+                    path = os.path.join(directory, name)
+                    if os.path.isdir(path):
+                        subdirs.append(_normalize_path(path))
+    except OSError, e:
+        return e, files, subdirs
+    return None, files, subdirs
+
+
+def _is_audio_file(name, extensions):
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+def _normalize_path(path):
+    if isinstance(path, str):
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return _normalize_file_name(os.path.normpath(path))
+
+
+def _normalize_file_name(name):
+    # HFS+ stores names decomposed, while iTunes mostly writes them composed.
+    if isinstance(name, unicode):
+        return unicodedata.normalize('NFC', name)
+    return name
@@ -0,0 +1,449 @@
+#!/usr/bin/python
+
+"""A benchmark suite for pytunes and the tools built on it.
+
+Runs each benchmark in a forked process, on synthetic libraries generated
+with generate_library.py, and measures:
+
+    - wall_time: The wall time of the measured operation, in seconds.
+    - peak_rss_kb: The peak RSS of the benchmark process, in KB.
+    - rss_delta_kb: How much the measured operation raised the peak RSS.
+    - objects: The number of objects tracked by the garbage collector that
+      the measured operation left allocated.
+
+The results can be saved as JSON and compared against a previous run.
+"""
+
+import contextlib
+import cPickle
+import gc
+import getopt
+import logging
+import multiprocessing
+import os
+import os.path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import simplejson
+
+import analysis
+import generate_library
+import moody
+import pytunes
+import similarity
+import snapshot
+import stats
+
+LOG_FORMAT = '%(message)s'
+DEFAULT_SIZES = (10000,)
+# Changes by more than this factor are reported as regressions.
+REGRESSION_THRESHOLD = 1.1
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: benchmark.py
+    [-h|--help]             This screen.
+    [-n|--tracks N,...]     The library sizes to benchmark. Defaults to 10000.
+    [-l|--library PATH]     Benchmark an existing library instead.
+    [-b|--benchmarks NAMES] Comma separated benchmarks to run. Defaults to all.
+    [-w|--work-dir PATH]    Where to keep generated libraries and snapshots.
+                            Defaults to a temporary directory.
+    [-o|--output PATH]      Save the results as JSON.
+    [-c|--compare PATH]     Compare the results with previously saved ones.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    sizes = DEFAULT_SIZES
+    library_path = None
+    names = None
+    work_dir = None
+    output = None
+    compare = None
+
+    options = 'hn:l:b:w:o:c:'
+    options_long = [
+            'help', 'tracks=', 'library=', 'benchmarks=', 'work-dir=',
+            'output=', 'compare=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-n', '--tracks'):
+                sizes = [int(s) for s in arg.split(',')]
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-b', '--benchmarks'):
+                names = arg.split(',')
+            if opt in ('-w', '--work-dir'):
+                work_dir = arg
+            if opt in ('-o', '--output'):
+                output = arg
+            if opt in ('-c', '--compare'):
+                compare = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    known_names = [b.name for b in BENCHMARKS]
+    for name in names or []:
+        if name not in known_names:
+            raise Usage('Unknown benchmark: %s.' % name)
+
+    return sizes, library_path, names, work_dir, output, compare
+
+
+class Benchmark(object):
+    """A benchmark: an operation, and how to prepare for it.
+
+    Only the run function is measured.
+    """
+
+    def __init__(self, name, run, setup=None):
+        """Creates a new Benchmark.
+
+        @param name: The name of the benchmark.
+        @type name: str
+        @param run: The operation to measure. Called with the result of setup.
+        @type run: function(object)
+        @param setup: Prepares the operation. Called with the Context.
+                Optional. Defaults to passing the Context to run.
+        @type setup: function(Context)
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda context: context)
+
+
+class Context(object):
+    """The library to benchmark and where to keep snapshots."""
+
+    def __init__(self, library_path, snapshot_dir):
+        self.library_path = library_path
+        self.snapshot_dir = snapshot_dir
+
+    def open_library(self, use_snapshot=False, workers=1):
+        return pytunes.Library(
+                self.library_path, use_snapshot=use_snapshot,
+                snapshot_dir=self.snapshot_dir, workers=workers)
+
+    def load_songs(self):
+        return filter(lambda t: not t.podcast, self.open_library().tracks)
+
+    def load_albums(self):
+        songs = self.load_songs()
+        return list(pytunes.Album.group_tracks_into_albums(songs))
+
+
+def _setup_cold_snapshot(context):
+    lib = context.open_library(use_snapshot=True)
+    lib.invalidate_snapshot()
+    return lib
+
+
+def _setup_warm_snapshot(context):
+    lib = context.open_library(use_snapshot=True)
+    lib._open()
+    return context.open_library(use_snapshot=True)
+
+
+def _setup_playlists(context):
+    lib = context.open_library()
+    list(lib.tracks)
+    return lib
+
+
+def _setup_moody_diff(context):
+    tracks = list(context.open_library().tracks)
+    tags = moody.get_moody_tags(tracks)
+    # Change every other tag, so there are differences to find.
+    for i, track_key in enumerate(sorted(tags)):
+        if i % 2:
+            tags[track_key] = 'A1'
+    return tracks, tags
+
+
+def _setup_moody_stream_diff(context):
+    tracks, tags = _setup_moody_diff(context)
+    records = list(moody.iter_moody_records(tracks))
+    for record in records:
+        record['mood'] = tags['%s----%s' % (record['artist'], record['name'])]
+    lines = [simplejson.dumps(record) + '\n' for record in records]
+    return tracks, lines
+
+
+def _run_moody_stream_diff(tracks_and_lines):
+    tracks, lines = tracks_and_lines
+    records = moody.read_moody_records(lines)
+    return list(moody.diff_moody_records(tracks, records))
+
+
+def _setup_similarity(context):
+    lib = _setup_playlists(context)
+    lib.playlists
+    return lib
+
+
+def _run_stats(context):
+    snapshot.DEFAULT_SNAPSHOT_DIR = context.snapshot_dir
+    with open(os.devnull, 'w') as devnull:
+        with _redirect_stdout(devnull):
+            stats.main(['stats.py', '--library', context.library_path])
+
+
+# Opening the XML is lazy, the first pass over the tracks (tracks_xml) is
+# what reads it.
+BENCHMARKS = [
+    Benchmark(
+            'library_open_snapshot_cold',
+            lambda lib: lib._open(),
+            _setup_cold_snapshot),
+    Benchmark(
+            'library_open_snapshot_warm',
+            lambda lib: lib._open(),
+            _setup_warm_snapshot),
+    Benchmark(
+            'tracks_xml',
+            lambda lib: list(lib.tracks),
+            lambda context: context.open_library()),
+    Benchmark(
+            'tracks_xml_parallel',
+            lambda lib: list(lib.tracks),
+            lambda context: context.open_library(
+                    workers=multiprocessing.cpu_count())),
+    Benchmark(
+            'tracks_snapshot',
+            lambda lib: list(lib.tracks),
+            _setup_warm_snapshot),
+    Benchmark(
+            'playlists',
+            lambda lib: lib.playlists,
+            _setup_playlists),
+    Benchmark(
+            'group_tracks_into_albums',
+            lambda songs: list(pytunes.Album.group_tracks_into_albums(songs)),
+            lambda context: context.load_songs()),
+    Benchmark(
+            'find_duplicates',
+            analysis.find_duplicates,
+            lambda context: context.load_songs()),
+    Benchmark(
+            'find_crappy_albums',
+            lambda albums: list(analysis.find_crappy_albums(albums)),
+            lambda context: context.load_albums()),
+    Benchmark(
+            'get_moody_tags',
+            moody.get_moody_tags,
+            lambda context: list(context.open_library().tracks)),
+    Benchmark(
+            'diff_moody_tags',
+            lambda tracks_and_tags: moody.diff_moody_tags(*tracks_and_tags),
+            _setup_moody_diff),
+    Benchmark(
+            'diff_moody_records',
+            _run_moody_stream_diff,
+            _setup_moody_stream_diff),
+    Benchmark(
+            'similarity_build',
+            similarity.SimilarityModel.build,
+            _setup_similarity),
+    Benchmark(
+            'stats_main',
+            _run_stats),
+]
+
+
+def run_benchmarks(context, names=None):
+    """Runs the benchmarks, each in its own process.
+
+    @param names: The names of the benchmarks to run. Optional. Defaults to
+            all.
+    @type names: [str]
+    @return: The measurements, keyed by benchmark name.
+    @rtype: {str: dict}
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names and benchmark.name not in names:
+            continue
+        logger.info('Running %s...', benchmark.name)
+        result = _run_in_child(_measure, benchmark, context)
+        if 'error' in result:
+            logger.error('%s failed:\n%s', benchmark.name, result['error'])
+        else:
+            logger.info(
+                    '%s: %.3fs, peak RSS %d KB (+%d KB), %d objects',
+                    benchmark.name, result['wall_time'],
+                    result['peak_rss_kb'], result['rss_delta_kb'],
+                    result['objects'])
+        results[benchmark.name] = result
+    return results
+
+
+def compare_results(old_results, new_results):
+    """Prints the changes between two saved results.
+
+    @return: The number of regressions.
+    @rtype: int
+    """
+    regressions = 0
+    for size in sorted(new_results, key=int):
+        old_by_name = old_results.get(size, {})
+        print 'Library with %s tracks:' % size
+        for name, new in sorted(new_results[size].iteritems()):
+            old = old_by_name.get(name)
+            if not old or 'error' in old or 'error' in new:
+                print '  %-28s no comparison' % name
+                continue
+            changes = []
+            for metric in ('wall_time', 'peak_rss_kb', 'objects'):
+                if old[metric]:
+                    ratio = float(new[metric]) / old[metric]
+                else:
+                    ratio = 1.0
+                is_regression = ratio > REGRESSION_THRESHOLD
+                regressions += is_regression
+                changes.append('%s %.2fx%s' % (
+                        metric, ratio,
+                        ' (REGRESSION)' if is_regression else ''))
+            print '  %-28s %s' % (name, ', '.join(changes))
+    return regressions
+
+
+def _measure(benchmark, context):
+    state = benchmark.setup(context)
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    rss_before = _get_peak_rss_kb()
+    start = time.time()
+    result = benchmark.run(state)
+    wall_time = time.time() - start
+    rss_after = _get_peak_rss_kb()
+    gc.collect()
+    objects_after = len(gc.get_objects())
+    del result
+    return {
+        'wall_time': wall_time,
+        'peak_rss_kb': rss_after,
+        'rss_delta_kb': rss_after - rss_before,
+        'objects': objects_after - objects_before,
+    }
+
+
+def _run_in_child(function, *args):
+    """Calls a function in a forked process and returns its result."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = function(*args)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        with os.fdopen(write_fd, 'wb') as f:
+            cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'The benchmark process died.'}
+    return cPickle.loads(data)
+
+
+def _get_peak_rss_kb():
+    # KB on Linux, bytes on Mac OS X.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return peak_rss
+
+
+@contextlib.contextmanager
+def _redirect_stdout(f):
+    stdout = sys.stdout
+    sys.stdout = f
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def _generate(size, work_dir):
+    path = os.path.join(work_dir, 'library-%d.xml' % size)
+    if not os.path.exists(path):
+        logger.info('Generating a library with %d tracks...', size)
+        with open(path, 'wb') as out:
+            generate_library.LibraryGenerator(size).write(out)
+    return path
+
+
+def _count_tracks(library_path):
+    lib = pytunes.Library(library_path, use_snapshot=False)
+    return sum(1 for _ in lib.tracks)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        sizes, library_path, names, work_dir, output, compare = (
+                _parse_args(argv))
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    temporary_work_dir = work_dir is None
+    if temporary_work_dir:
+        work_dir = tempfile.mkdtemp(prefix='pytunes-benchmark-')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        snapshot_dir = os.path.join(work_dir, 'snapshots')
+        if library_path:
+            libraries = [(_count_tracks(library_path), library_path)]
+        else:
+            libraries = [(size, _generate(size, work_dir)) for size in sizes]
+        results = {}
+        for size, path in libraries:
+            logger.info('Benchmarking %s (%d tracks)...', path, size)
+            context = Context(path, snapshot_dir)
+            results[str(size)] = run_benchmarks(context, names)
+    finally:
+        if temporary_work_dir:
+            shutil.rmtree(work_dir)
+
+    if output:
+        with open(output, 'w') as f:
+            simplejson.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if compare:
+        with open(compare) as f:
+            old_results = simplejson.load(f)['results']
+        if compare_results(old_results, results):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
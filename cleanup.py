@@ -2,106 +2,310 @@
 
 """A tool to delete crappy tracks from your iTunes library."""
 
+import getopt
 import logging
 import os
 import os.path
+import sys
 
+import simplejson
+
+import actionplan
 import analysis
+import pipeline
+import profiling
 import pytunes
+import rewrite
+import serverclient
 
 LOG_FORMAT = '%(message)s'
+DEFAULT_JOURNAL_PATH = os.path.expanduser('~/.pytunes/cleanup-journal')
 
 logger = logging.getLogger(__name__)
 
 
-def delete_crappy_singles(songs, albums, min_rating=80, dryrun=True):
-    logger.info('Deleting crappy singles...')
-    crappy_singles = analysis.find_crappy_single_tracks(songs, albums, min_rating)
-    # 10 means 0 stars in iTunes. We consider 0 stars as unrated.
+class Usage(Exception):
+    """Usage: cleanup.py
+    [-h|--help]         This screen.
+    [-l|--library PATH] The iTunes library XML. Defaults to the user's.
+    [-x|--execute]      Run the planned actions. Without it, they are only
+                        printed.
+    [-r|--resume]       Resume the interrupted run recorded in the journal.
+    [-u|--rollback]     Roll back the run recorded in the journal. Deleted
+                        files are restored from the trash of the journal.
+    [-P|--purge]        Purge the trash of the finished run recorded in the
+                        journal. It can't be rolled back completely anymore.
+                        Starting the next run purges it as well.
+    [-j|--journal PATH] The journal of the run. Defaults to
+                        ~/.pytunes/cleanup-journal.
+    [-w|--workers N]    The number of directories to work on at the same
+                        time. Defaults to 8.
+    [-o|--output PATH]  Also write a copy of the library XML to PATH without
+                        the deleted tracks and with the moved tracks pointing
+                        to their new files, to import into iTunes.
+    [--server ADDRESS]  Ask the library server at ADDRESS (e.g.
+                        localhost:8752) for the plan instead of loading the
+                        library, if it is running. Not used with --output.
+    [-p|--profile PATH] Write a profile of the run to PATH, as collapsed
+                        stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    operation = 'dryrun'
+    library_path = None
+    journal_path = DEFAULT_JOURNAL_PATH
+    workers = actionplan.DEFAULT_WORKERS
+    output_path = None
+    server_address = None
+    profile_path = None
+
+    options = 'hl:xruPj:w:o:p:'
+    options_long = [
+            'help', 'library=', 'execute', 'resume', 'rollback', 'purge',
+            'journal=', 'workers=', 'output=', 'server=', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-x', '--execute'):
+                operation = _set_operation(operation, 'execute')
+            if opt in ('-r', '--resume'):
+                operation = _set_operation(operation, 'resume')
+            if opt in ('-u', '--rollback'):
+                operation = _set_operation(operation, 'rollback')
+            if opt in ('-P', '--purge'):
+                operation = _set_operation(operation, 'purge')
+            if opt in ('-j', '--journal'):
+                journal_path = arg
+            if opt in ('-w', '--workers'):
+                workers = int(arg)
+            if opt in ('-o', '--output'):
+                output_path = arg
+            if opt == '--server':
+                server_address = arg
+                serverclient.parse_address(server_address)
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if workers < 1:
+        raise Usage('Need at least one worker.')
+    if output_path and operation in ('resume', 'rollback', 'purge'):
+        raise Usage('Cannot write the library when resuming, rolling back or '
+                    'purging.')
+
+    return (operation, library_path, journal_path, workers, output_path,
+            server_address, profile_path)
+
+
+def _set_operation(operation, new_operation):
+    if operation != 'dryrun':
+        raise Usage('Cannot %s and %s at the same time.' % (
+                operation, new_operation))
+    return new_operation
+
+
+def plan_crappy_singles(songs, albums, min_rating=80):
+    """Plans deleting the crappy single tracks.
+
+    @rtype: actionplan.ActionPlan
+    """
+    logger.info('Planning to delete crappy singles...')
+    crappy_singles = analysis.find_crappy_single_tracks(
+            songs, albums, min_rating)
+    plan = actionplan.ActionPlan()
     for track in crappy_singles:
-        location = track.location.replace('file://', '')
-        logger.info('Deleting ' + location)
-        if dryrun:
-            print ('rm "%s"' % location).encode('utf-8')
-        else:
-            os.remove(location)
+        plan.delete(track.path)
+    return plan
 
 
-def delete_crappy_albums(
-        albums, min_good_tracks=4, min_rating=80, keep_good_tracks=True,
-        dryrun=True):
-    logger.info('Deleting crappy albums...')
-    crappy_albums = analysis.find_crappy_albums(albums, min_good_tracks, min_rating)
+def plan_crappy_albums(
+        albums, min_good_tracks=4, min_rating=80, keep_good_tracks=True):
+    logger.info('Planning to delete crappy albums...')
+    crappy_albums = analysis.find_crappy_albums(
+            albums, min_good_tracks, min_rating)
     sorted_crappy_albums = sorted(crappy_albums, key=lambda a: a.artist)
-    delete_albums(sorted_crappy_albums, min_rating, keep_good_tracks, dryrun)
+    return plan_albums(sorted_crappy_albums, min_rating, keep_good_tracks)
+
+
+def plan_compilations(albums, min_rating=80, keep_good_tracks=True):
+    logger.info('Planning to delete compilations...')
+    sorted_compilations = sorted(
+            pipeline.compilations(albums), key=lambda a: a.artist)
+    return plan_albums(sorted_compilations, min_rating, keep_good_tracks)
 
 
-def delete_compilations(
-        albums, min_rating=80, keep_good_tracks=True, dryrun=True):
-    logger.info('Deleting compilations...')
-    completely_rated_albums = analysis.find_completely_rated_albums(albums)
-    compilations = analysis.find_compilations(completely_rated_albums)
-    sorted_compilations = sorted(compilations, key=lambda a: a.artist)
-    delete_albums(sorted_compilations, min_rating, keep_good_tracks, dryrun)
+def plan_albums(albums, min_rating=80, keep_good_tracks=True):
+    """Plans deleting albums, optionally keeping their good tracks.
 
+    The good tracks are moved to the parent directory of the album, all other
+    tracks are deleted, and then the album directory is removed.
 
-def delete_albums(albums, min_rating=80, keep_good_tracks=True, dryrun=True):
+    @rtype: actionplan.ActionPlan
+    """
+    plan = actionplan.ActionPlan()
     for album in albums:
-        source = album.tracks[0].location.replace('file://', '')
+        source = album.tracks[0].path
         source_dir = os.path.dirname(source)
-        if not os.path.exists(source_dir):
-            logger.warning('Path does not exist: %s.', source_dir)
-            continue
-        source_base = os.path.basename(source)
         source_parent = os.path.split(source_dir)[0]
 
         for track in album.tracks:
-            source = track.location.replace('file://', '')
+            source = track.path
             if track.rating >= min_rating:
                 if keep_good_tracks:
-                    target_dir = source_parent
                     target_file = '%s - %s.mp3' % (track.artist, track.name)
-                    target = os.path.join(target_dir, target_file)
-                    if dryrun:
-                        logger.info('Moving ' + source)
-                        print ('mv "%s" "%s"' % (source, target)) \
-                                .encode('utf-8')
-                    else:
-                        os.rename(source, target)
+                    plan.move(source, os.path.join(source_parent, target_file))
             else:
-                logger.info('Deleting ' + source)
-                if dryrun:
-                    print ('rm "%s"' % source).encode('utf-8')
-                else:
-                    os.remove(source)
-        if dryrun:
-            print ('rmdir "%s"' % source_dir).encode('utf-8')
-        else:
-            try:
-                os.rmdir(source_dir)
-            except OSError, e:
-                logger.error(e)
+                plan.delete(source)
+        plan.rmdir(source_dir)
+    return plan
 
 
-def main():
-    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+def _plan_cleanup(library_path, server_address=None):
+    """@return: The plan, and the songs it was planned from, or None if it
+            came from the server.
+    @rtype: (actionplan.ActionPlan, pipeline.Pipeline)
+    """
+    if server_address:
+        output = serverclient.query(server_address, '/cleanup', library_path)
+        if output is not None:
+            plan = actionplan.ActionPlan([
+                    actionplan.Action.from_json(item)
+                    for item in simplejson.loads(output)])
+            return plan, None
 
     logger.info('Opening iTunes library...')
-    lib = pytunes.Library()
+    lib = pytunes.Library(library_path)
     logger.info('Loading all tracks...')
-    songs = filter(lambda t: not t.podcast, lib.tracks)
-    albums = list(pytunes.Album.group_tracks_into_albums(songs))
-    dryrun = True
+    songs = pipeline.Pipeline(lambda: lib.tracks).pipe(
+            pipeline.without_podcasts)
+    albums = list(songs.pipe(pipeline.group_albums))
+    return plan_cleanup(songs, albums), songs
+
+
+def _write_library(library_path, output_path, plan, songs):
+    source_path = pytunes.Library(library_path).path
+    logger.info('Writing the cleaned up library to %s...', output_path)
+    counts = rewrite.rewrite_library(
+            source_path, output_path, patch_plan(plan, songs))
+    logger.info('Wrote the library: %s.', ', '.join(
+            '%d %s' % (n, name) for name, n in sorted(counts.items())))
+
+
+def plan_cleanup(songs, albums):
+    """Plans deleting the crappy singles, crappy albums and compilations.
+
+    @param songs: The songs. Iterated once.
+    @type songs: iterable(Track)
+    @param albums: The albums of the songs.
+    @type albums: [Album]
+    @rtype: actionplan.ActionPlan
+    """
     min_rating = 80  # 4 stars.
     min_good_tracks = 4
     keep_good_tracks = True
-    tolerated_time_difference = 10
 
-    delete_crappy_singles(songs, albums, min_rating, dryrun)
-    delete_crappy_albums(
-            albums, min_good_tracks, min_rating, keep_good_tracks, dryrun)
-    delete_compilations(albums, min_rating, keep_good_tracks, dryrun)
+    plan = plan_crappy_singles(songs, albums, min_rating)
+    plan.extend(plan_crappy_albums(
+            albums, min_good_tracks, min_rating, keep_good_tracks))
+    plan.extend(plan_compilations(albums, min_rating, keep_good_tracks))
+    return plan
+
+
+def patch_plan(plan, tracks):
+    """Builds the library patch matching a plan: tracks whose files are
+    deleted are removed, tracks whose files are moved point to the targets.
+
+    @type plan: actionplan.ActionPlan
+    @param tracks: The tracks the plan was made for.
+    @type tracks: iterable(Track)
+    @rtype: rewrite.LibraryPatch
+    """
+    tracks_by_path = dict((t.path, t) for t in tracks if t.path)
+    patch = rewrite.LibraryPatch()
+    for action in plan:
+        track = tracks_by_path.get(action.source)
+        if track is None:
+            continue
+        if action.kind == actionplan.DELETE:
+            patch.remove_track(track.id)
+        elif action.kind == actionplan.MOVE:
+            patch.move_track(action.target, track.id)
+    return patch
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (operation, library_path, journal_path, workers, output_path,
+                server_address, profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    executor = actionplan.ActionExecutor(workers)
+    journal = actionplan.Journal(journal_path)
+    try:
+        if operation == 'resume':
+            logger.info('Resuming the run in %s...', journal_path)
+            counts = executor.resume(journal)
+        elif operation == 'rollback':
+            logger.info('Rolling back the run in %s...', journal_path)
+            counts = executor.rollback(journal)
+        elif operation == 'purge':
+            journal.purge()
+            counts = None
+        else:
+            if output_path:
+                # Rewriting the library needs the tracks, not just the plan.
+                server_address = None
+            plan, songs = _plan_cleanup(library_path, server_address)
+            if output_path:
+                _write_library(library_path, output_path, plan, songs)
+            if operation == 'dryrun':
+                for action in plan:
+                    print unicode(action).encode('utf-8')
+                counts = None
+            else:
+                logger.info('Running %d actions...', len(plan))
+                counts = executor.run(plan, journal)
+    except (actionplan.JournalError, serverclient.ServerError, IOError,
+            OSError, ValueError), e:
+        logger.error(e)
+        return 1
+    finally:
+        journal.close()
+    if counts is not None:
+        logger.info('Done: %s.', ', '.join(
+                '%d %s' % (n, state) for state, n in sorted(counts.items())))
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+    if operation == 'rollback' and (
+            counts['failed'] or counts['unrecoverable']):
+        logger.error('Some actions could not be undone.')
+        return 1
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+"""A duplicate detection engine for iTunes tracks.
+
+Duplicates are found by rules. Each rule proposes pairs of tracks it
+considers duplicates, with a score between 0 and 1. The pairs of all rules
+are merged into clusters (if A duplicates B and B duplicates C, all three end
+up in one cluster), which are ranked by their best score.
+
+Two rules are provided:
+
+    - DurationSweepRule: tracks with exactly the same artist and name whose
+      total times differ by at most some tolerance. This is what
+      analysis.find_duplicates always did.
+    - FuzzyRule: tracks whose normalized artists and names are similar, with
+      configurable weights for name, artist, duration, album and bit rate.
+
+Both rules only compare tracks within small blocks (same artist and name, or
+same normalized artist and a shared name token), so the engine stays near
+linear in the number of tracks.
+"""
+
+import collections
+import difflib
+import re
+import unicodedata
+
+# Bracketed parts or dash suffixes containing these are release details, not
+# part of the song's name, e.g. "Song (Remastered)" or "Song - 2009 Mono".
+_VERSION_NOISE = (
+        r'remaster(?:ed)?|mono|stereo|explicit|clean|bonus(?: track)?|'
+        r'deluxe|edition|(?:album|single|lp|\d{4}) version')
+_BRACKETED_NOISE_PATTERN = re.compile(
+        r'[\(\[][^\)\]]*\b(?:%s)\b[^\)\]]*[\)\]]' % _VERSION_NOISE,
+        re.IGNORECASE | re.UNICODE)
+_DASH_NOISE_PATTERN = re.compile(
+        r'\s-\s[^-]*\b(?:%s)\b.*$' % _VERSION_NOISE,
+        re.IGNORECASE | re.UNICODE)
+_FEATURING_PATTERN = re.compile(
+        r'[\(\[]?\s*\b(?:feat\.?|ft\.?|featuring)\s.*$',
+        re.IGNORECASE | re.UNICODE)
+_PUNCTUATION_PATTERN = re.compile(r'[^\w\s]+', re.UNICODE)
+_WHITESPACE_PATTERN = re.compile(r'\s+', re.UNICODE)
+
+_STOPWORDS = frozenset(['a', 'an', 'and', 'de', 'der', 'die', 'el', 'in',
+                        'la', 'le', 'of', 'on', 'the', 'to'])
+
+
+def normalize_name(name):
+    """Normalizes a track name for comparison.
+
+    Lower-cases, strips accents, punctuation, "feat." clauses and release
+    details like "(Remastered)", and collapses whitespace.
+
+    @type name: unicode
+    @rtype: unicode
+    """
+    if not name:
+        return u''
+    name = _FEATURING_PATTERN.sub(u'', unicode(name))
+    name = _BRACKETED_NOISE_PATTERN.sub(u'', name)
+    name = _DASH_NOISE_PATTERN.sub(u'', name)
+    return _normalize_text(name)
+
+
+def normalize_artist(artist):
+    """Normalizes an artist for comparison.
+
+    Like normalize_name, but also drops a leading "The".
+
+    @type artist: unicode
+    @rtype: unicode
+    """
+    if not artist:
+        return u''
+    artist = _FEATURING_PATTERN.sub(u'', unicode(artist))
+    artist = _normalize_text(artist)
+    if artist.startswith(u'the '):
+        artist = artist[4:]
+    return artist
+
+
+def normalize_album(album):
+    """Normalizes an album for comparison.
+
+    @type album: unicode
+    @rtype: unicode
+    """
+    if not album:
+        return u''
+    return _normalize_text(unicode(album))
+
+
+def _normalize_text(text):
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    text = text.lower().replace(u'&', u' and ')
+    text = _PUNCTUATION_PATTERN.sub(u' ', text)
+    return _WHITESPACE_PATTERN.sub(u' ', text).strip()
+
+
+class DuplicateCluster(object):
+    """A group of tracks that are considered duplicates of each other."""
+
+    def __init__(self, tracks, score):
+        """Creates a new DuplicateCluster.
+
+        @param tracks: The tracks, sorted by artist and name.
+        @type tracks: [Track]
+        @param score: The best score of any pair in the cluster, 0..1.
+        @type score: float
+        """
+        self.tracks = tracks
+        self.score = score
+
+    def __unicode__(self):
+        return 'DuplicateCluster(score=%0.2f, tracks=%d)' % (
+                self.score, len(self.tracks))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class DurationSweepRule(object):
+    """Tracks with the same artist and name and a similar total time.
+
+    Within each group of tracks with the same artist and name, the tracks are
+    sorted by total time and neighbours within the tolerance are paired.
+    """
+
+    def __init__(self, tolerated_time_difference=10):
+        self.tolerated_time_difference = tolerated_time_difference
+
+    def find_pairs(self, tracks):
+        """Proposes duplicate pairs.
+
+        @param tracks: All candidate tracks.
+        @type tracks: [Track]
+        @return: Yields the indexes of both tracks and the pair's score.
+        @rtype: generator((int, int, float))
+        """
+        groups = collections.defaultdict(list)
+        for i, track in enumerate(tracks):
+            groups[(track.artist, track.name)].append(i)
+        for group in groups.itervalues():
+            if len(group) < 2:
+                continue
+            group.sort(key=lambda i: tracks[i].total_time)
+            for a, b in zip(group, group[1:]):
+                time_difference = abs(
+                        tracks[a].total_time - tracks[b].total_time)
+                if time_difference <= self.tolerated_time_difference:
+                    yield a, b, 1.0
+
+
+class FuzzyRule(object):
+    """Tracks with similar normalized artists and names.
+
+    Tracks are blocked by their normalized artist and the rarest tokens of
+    their normalized name. Within a block, tracks are sorted by total time
+    and only pairs within max_time_difference are scored, each track against
+    at most max_comparisons neighbours.
+
+    The score of a pair is the weighted mean of the similarities of its
+    fields, each between 0 and 1:
+
+        - name, artist, album: difflib ratio of the normalized values.
+        - duration: 1 for equal total times, down to 0 at max_time_difference.
+        - bit_rate: the ratio of the lower to the higher bit rate.
+
+    Fields missing on either track count as 0.5.
+    """
+
+    DEFAULT_WEIGHTS = {
+        'name': 0.4,
+        'artist': 0.3,
+        'duration': 0.2,
+        'album': 0.05,
+        'bit_rate': 0.05,
+    }
+
+    def __init__(self, weights=None, threshold=0.9, max_time_difference=5000,
+                 block_tokens=2, max_comparisons=50):
+        """Creates a new FuzzyRule.
+
+        @param weights: The weights of the field similarities, keyed by name,
+                artist, duration, album and bit_rate. Optional. Missing fields
+                use the DEFAULT_WEIGHTS.
+        @type weights: {str: float}
+        @param threshold: The minimum score of a duplicate pair.
+        @type threshold: float
+        @param max_time_difference: The maximum difference in total time of a
+                duplicate pair, in milliseconds.
+        @type max_time_difference: int
+        @param block_tokens: The number of name tokens to block on.
+        @type block_tokens: int
+        @param max_comparisons: The maximum number of neighbours in a block to
+                compare each track with.
+        @type max_comparisons: int
+        """
+        self.weights = dict(FuzzyRule.DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.threshold = threshold
+        self.max_time_difference = max_time_difference
+        self.block_tokens = block_tokens
+        self.max_comparisons = max_comparisons
+
+    def find_pairs(self, tracks):
+        """Proposes duplicate pairs. See DurationSweepRule.find_pairs."""
+        artists = _normalize_all(normalize_artist, [t.artist for t in tracks])
+        names = _normalize_all(normalize_name, [t.name for t in tracks])
+        albums = _normalize_all(normalize_album, [t.album for t in tracks])
+
+        token_counts = collections.Counter()
+        tokens = []
+        for name in names:
+            name_tokens = set(name.split()) - _STOPWORDS or set(name.split())
+            tokens.append(name_tokens)
+            token_counts.update(name_tokens)
+
+        blocks = collections.defaultdict(list)
+        for i, name_tokens in enumerate(tokens):
+            if not artists[i] or not name_tokens:
+                continue
+            rarest_tokens = sorted(
+                    name_tokens, key=lambda t: (token_counts[t], t))
+            for token in rarest_tokens[:self.block_tokens]:
+                blocks[(artists[i], token)].append(i)
+
+        scored_pairs = set()
+        for block in blocks.itervalues():
+            if len(block) < 2:
+                continue
+            block.sort(key=lambda i: tracks[i].total_time)
+            for position, a in enumerate(block):
+                neighbours = block[position + 1:
+                                   position + 1 + self.max_comparisons]
+                for b in neighbours:
+                    time_difference = _time_difference(tracks[a], tracks[b])
+                    if time_difference > self.max_time_difference:
+                        break
+                    pair = (min(a, b), max(a, b))
+                    if pair in scored_pairs:
+                        continue
+                    scored_pairs.add(pair)
+                    score = self._score(
+                            tracks, artists, names, albums, a, b,
+                            time_difference)
+                    if score >= self.threshold:
+                        yield a, b, score
+
+    def _score(self, tracks, artists, names, albums, a, b, time_difference):
+        weights = self.weights
+        total_weight = sum(weights.itervalues())
+        if not total_weight:
+            return 0.0
+        if self.max_time_difference:
+            duration_similarity = (
+                    1.0 - float(time_difference) / self.max_time_difference)
+        else:
+            duration_similarity = 1.0
+        bit_rate_similarity = _bit_rate_similarity(tracks[a], tracks[b])
+        score = (
+                weights['duration'] * duration_similarity +
+                weights['bit_rate'] * bit_rate_similarity)
+        # The text similarities are the expensive ones. Stop as soon as the
+        # threshold can't be reached anymore, even if all remaining fields
+        # were identical.
+        remaining_weight = (
+                weights['name'] + weights['artist'] + weights['album'])
+        for field, values in (
+                ('name', names), ('artist', artists), ('album', albums)):
+            weight = weights[field]
+            remaining_weight -= weight
+            needed = self.threshold * total_weight - score - remaining_weight
+            if weight:
+                score += weight * _ratio(values[a], values[b], needed / weight)
+            if score + remaining_weight < self.threshold * total_weight:
+                return 0.0
+        return score / total_weight
+
+
+class DuplicateFinder(object):
+    """Finds duplicates by combining the pairs of several rules."""
+
+    def __init__(self, rules=None):
+        """Creates a new DuplicateFinder.
+
+        @param rules: The rules to apply. Optional. Defaults to a
+                DurationSweepRule and a FuzzyRule with default settings.
+        @type rules: [object]
+        """
+        if rules is None:
+            rules = [DurationSweepRule(), FuzzyRule()]
+        self.rules = rules
+
+    def find_clusters(self, tracks):
+        """Finds clusters of duplicates.
+
+        @type tracks: iterable(Track)
+        @return: The clusters, best score first, larger clusters first for
+                equal scores.
+        @rtype: [DuplicateCluster]
+        """
+        tracks = list(tracks)
+        parents = range(len(tracks))
+        best_scores = {}
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for rule in self.rules:
+            for a, b, score in rule.find_pairs(tracks):
+                root_a, root_b = find(a), find(b)
+                root_score = max(
+                        score, best_scores.pop(root_a, 0.0),
+                        best_scores.pop(root_b, 0.0))
+                parents[root_b] = root_a
+                best_scores[root_a] = root_score
+
+        members = collections.defaultdict(list)
+        for i in xrange(len(tracks)):
+            root = find(i)
+            if root in best_scores:
+                members[root].append(tracks[i])
+
+        clusters = []
+        for root, cluster_tracks in members.iteritems():
+            cluster_tracks.sort(key=lambda t: (t.artist, t.name, t.total_time))
+            clusters.append(DuplicateCluster(cluster_tracks, best_scores[root]))
+        clusters.sort(key=lambda c: (-c.score, -len(c.tracks)))
+        return clusters
+
+
+def _ratio(a, b, minimum=0.0):
+    """Returns the similarity of two strings.
+
+    If the similarity is certainly below the minimum, returns an upper bound
+    of it instead, which is cheaper to compute.
+    """
+    if not a or not b:
+        return 0.5
+    if a == b:
+        return 1.0
+    matcher = difflib.SequenceMatcher(None, a, b)
+    upper_bound = matcher.real_quick_ratio()
+    if upper_bound < minimum:
+        return upper_bound
+    upper_bound = matcher.quick_ratio()
+    if upper_bound < minimum:
+        return upper_bound
+    return matcher.ratio()
+
+
+def _normalize_all(normalize, values):
+    """Normalizes some values, each distinct value only once."""
+    normalized_values = {}
+    result = []
+    for value in values:
+        normalized = normalized_values.get(value)
+        if normalized is None:
+            normalized = normalize(value)
+            normalized_values[value] = normalized
+        result.append(normalized)
+    return result
+
+
+def _time_difference(a, b):
+    return abs((a.total_time or 0) - (b.total_time or 0))
+
+
+def _bit_rate_similarity(a, b):
+    if not a.bit_rate or not b.bit_rate:
+        return 0.5
+    return float(min(a.bit_rate, b.bit_rate)) / max(a.bit_rate, b.bit_rate)
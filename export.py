@@ -0,0 +1,596 @@
+#!/usr/bin/python
+
+"""A tool to export an iTunes library to SQLite and to columnar files.
+
+Both exports can be queried without pytunes: the SQLite database with any
+SQLite client, the columnar files with NumPy (see read_chunk).
+
+The tracks, playlists and playlist items are streamed into the exports in
+batches. Exporting into an existing export is incremental:
+
+    - SQLite: Rows are keyed by persistent ID. Only rows whose Date Modified
+      or checksum changed are rewritten, rows that are gone are deleted. The
+      checksum covers all exported fields, since iTunes doesn't touch Date
+      Modified for play counts, play dates or ratings.
+    - Columnar: Each table is split into chunks of a fixed number of rows.
+      Only chunks whose checksum changed are rewritten.
+
+The columnar chunks are .npz files with one array per column. Integers,
+booleans and dates (as seconds since the epoch) are stored as int64 and bool
+arrays, with missing values stored as 0 or False. Strings are stored as
+their concatenated UTF-8 bytes (<column>.data) and the offsets of the
+strings into them (<column>.offsets), missing values as empty strings. A
+manifest.json lists the columns and the chunks of each table.
+"""
+
+import calendar
+import collections
+import contextlib
+import getopt
+import logging
+import os
+import os.path
+import sqlite3
+import sys
+import tempfile
+import zlib
+
+import numpy
+import simplejson
+
+import profiling
+import pytunes
+
+LOG_FORMAT = '%(message)s'
+
+# The column types.
+TEXT = 'text'
+INTEGER = 'integer'
+BOOLEAN = 'boolean'
+DATE = 'date'
+
+# The exported tables: their columns and types. The first column is the key.
+TRACK_COLUMNS = (
+        ('persistent_id', TEXT),
+        ('track_id', INTEGER),
+        ('name', TEXT),
+        ('artist', TEXT),
+        ('album_artist', TEXT),
+        ('album', TEXT),
+        ('genre', TEXT),
+        ('kind', TEXT),
+        ('composer', TEXT),
+        ('year', INTEGER),
+        ('number', INTEGER),
+        ('total_time', INTEGER),
+        ('size', INTEGER),
+        ('bit_rate', INTEGER),
+        ('sample_rate', INTEGER),
+        ('rating', INTEGER),
+        ('play_count', INTEGER),
+        ('skip_count', INTEGER),
+        ('podcast', BOOLEAN),
+        ('date_added', DATE),
+        ('date_modified', DATE),
+        ('play_date_utc', DATE),
+        ('location', TEXT),
+)
+PLAYLIST_COLUMNS = (
+        ('persistent_id', TEXT),
+        ('playlist_id', INTEGER),
+        ('name', TEXT),
+        ('master', BOOLEAN),
+        ('smart', BOOLEAN),
+        ('items', INTEGER),
+)
+PLAYLIST_ITEM_COLUMNS = (
+        ('playlist_persistent_id', TEXT),
+        ('position', INTEGER),
+        ('track_persistent_id', TEXT),
+)
+TABLES = collections.OrderedDict([
+    ('tracks', TRACK_COLUMNS),
+    ('playlists', PLAYLIST_COLUMNS),
+    ('playlist_items', PLAYLIST_ITEM_COLUMNS),
+])
+
+# The indexes of the SQLite export, besides the primary keys.
+SQLITE_INDEXES = (
+        ('tracks', 'artist'),
+        ('tracks', 'album_artist'),
+        ('tracks', 'album'),
+        ('tracks', 'genre'),
+        ('tracks', 'year'),
+        ('tracks', 'date_added'),
+        ('playlists', 'name'),
+        ('playlist_items', 'track_persistent_id'),
+)
+
+DEFAULT_CHUNK_SIZE = 50000
+# The number of rows written to SQLite at a time.
+BATCH_SIZE = 1000
+MANIFEST_NAME = 'manifest.json'
+
+# Bump this whenever the layout of the exports changes. Exports with another
+# version are rebuilt from scratch.
+_FORMAT_VERSION = 1
+_SQLITE_TYPES = {TEXT: 'TEXT', INTEGER: 'INTEGER', BOOLEAN: 'INTEGER',
+                 DATE: 'TEXT'}
+_DATE_MODIFIED_COLUMN = [c for c, _ in TRACK_COLUMNS].index('date_modified')
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: export.py
+    [-h|--help]              This screen.
+    [-l|--library PATH]      The iTunes library XML. Defaults to the user's.
+    [-s|--sqlite PATH]       Export to the SQLite database at PATH.
+    [-c|--columnar DIR]      Export to columnar files in DIR.
+    [-n|--chunk-size N]      The rows per columnar chunk. Defaults to 50000.
+    [-f|--full]              Rebuild the exports instead of updating them.
+    [-p|--profile PATH]      Write a profile of the run to PATH, as collapsed
+                             stacks if it ends with .folded, as JSON
+                             otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    library_path = None
+    sqlite_path = None
+    columnar_dir = None
+    chunk_size = DEFAULT_CHUNK_SIZE
+    full = False
+    profile_path = None
+
+    options = 'hl:s:c:n:fp:'
+    options_long = [
+            'help', 'library=', 'sqlite=', 'columnar=', 'chunk-size=', 'full',
+            'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-s', '--sqlite'):
+                sqlite_path = arg
+            if opt in ('-c', '--columnar'):
+                columnar_dir = arg
+            if opt in ('-n', '--chunk-size'):
+                chunk_size = int(arg)
+            if opt in ('-f', '--full'):
+                full = True
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if not sqlite_path and not columnar_dir:
+        raise Usage('Must specify an export.')
+    if chunk_size < 1:
+        raise Usage('Chunks need at least one row.')
+
+    return (library_path, sqlite_path, columnar_dir, chunk_size, full,
+            profile_path)
+
+
+def iter_rows(library):
+    """Yields the rows of all tables, tracks first.
+
+    The tracks are yielded in order of their Track ID, so the order is the
+    same for every export and new tracks come last.
+
+    @type library: pytunes.Library
+    @return: Yields the table name and a row, as a tuple in the order of the
+            table's columns.
+    @rtype: generator((str, tuple))
+    """
+    for track in sorted(library.tracks, key=lambda t: t.id):
+        yield 'tracks', (
+                _get_key(track), track.id, track.name, track.artist,
+                track.album_artist, track.album, track.genre, track.kind,
+                track.composer, track.year, track.number, track.total_time,
+                track.size, track.bit_rate, track.sample_rate, track.rating,
+                track.play_count, track.skip_count, track.podcast,
+                track.date_added, track.date_modified, track.play_date_utc,
+                track.location)
+    for playlist in library.playlists:
+        playlist_key = _get_key(playlist)
+        position = 0
+        for position, track in enumerate(playlist.items, 1):
+            yield 'playlist_items', (playlist_key, position, _get_key(track))
+        yield 'playlists', (
+                playlist_key, playlist.id, playlist.name, playlist.master,
+                playlist.smart_criteria is not None, position)
+
+
+class SqliteExporter(object):
+    """Exports a library into a SQLite database, incrementally."""
+
+    def __init__(self, path):
+        """Creates a new SqliteExporter.
+
+        @param path: The path of the database. Created if it doesn't exist.
+        @type path: str
+        """
+        self.path = path
+
+    @profiling.profiled('export.sqlite')
+    def export(self, library, full=False):
+        """Exports a library.
+
+        All changes are committed in a single transaction, so readers see
+        either the previous or the new export.
+
+        @type library: pytunes.Library
+        @param full: Whether to rebuild the database instead of updating it.
+        @type full: bool
+        @return: The number of added, updated, removed and unchanged rows per
+                table, e.g. 'tracks.updated'.
+        @rtype: collections.Counter
+        """
+        counts = collections.Counter()
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            self._create_schema(conn, full)
+            old_states = dict(
+                    (table, self._read_states(conn, table))
+                    for table in TABLES)
+            batches = dict((table, []) for table in TABLES)
+            for table, row in iter_rows(library):
+                checksum = _checksum(row)
+                old_state = old_states[table].pop(
+                        _get_row_key(table, row), None)
+                if old_state == _get_state(table, row, checksum):
+                    counts[table + '.unchanged'] += 1
+                    continue
+                counts[table + ('.updated' if old_state else '.added')] += 1
+                batch = batches[table]
+                batch.append(_to_sqlite_row(table, row) + (checksum,))
+                if len(batch) >= BATCH_SIZE:
+                    self._write(conn, table, batch)
+                    del batch[:]
+            for table, batch in batches.iteritems():
+                self._write(conn, table, batch)
+            for table, states in old_states.iteritems():
+                self._delete(conn, table, states.keys())
+                counts[table + '.removed'] += len(states)
+            conn.commit()
+        return counts
+
+    def _create_schema(self, conn, full):
+        conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta '
+                '(key TEXT PRIMARY KEY, value TEXT)')
+        version = conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if full or version != (str(_FORMAT_VERSION),):
+            for table in TABLES:
+                conn.execute('DROP TABLE IF EXISTS %s' % table)
+            conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                    (str(_FORMAT_VERSION),))
+        for table, columns in TABLES.iteritems():
+            conn.execute('CREATE TABLE IF NOT EXISTS %s (%s, %s)' % (
+                    table,
+                    ', '.join('%s %s' % (c, _SQLITE_TYPES[t])
+                              for c, t in columns),
+                    'checksum INTEGER'))
+            key = columns[0][0]
+            if table == 'playlist_items':
+                key = '%s, position' % key
+            conn.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS %s_key ON %s (%s)'
+                    % (table, table, key))
+        for table, column in SQLITE_INDEXES:
+            conn.execute(
+                    'CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                    % (table, column, table, column))
+
+    def _read_states(self, conn, table):
+        """Reads what identifies the version of each row."""
+        if table == 'tracks':
+            rows = conn.execute(
+                    'SELECT persistent_id, date_modified, checksum '
+                    'FROM tracks')
+            return dict((row[0], row[1:]) for row in rows)
+        key = TABLES[table][0][0]
+        if table == 'playlist_items':
+            rows = conn.execute(
+                    'SELECT %s, position, checksum FROM %s' % (key, table))
+            return dict(((row[0], row[1]), (row[2],)) for row in rows)
+        rows = conn.execute('SELECT %s, checksum FROM %s' % (key, table))
+        return dict((row[0], row[1:]) for row in rows)
+
+    def _write(self, conn, table, rows):
+        if not rows:
+            return
+        conn.executemany(
+                'INSERT OR REPLACE INTO %s VALUES (%s)'
+                % (table, ', '.join('?' * len(rows[0]))), rows)
+
+    def _delete(self, conn, table, keys):
+        key = TABLES[table][0][0]
+        if table == 'playlist_items':
+            conn.executemany(
+                    'DELETE FROM %s WHERE %s = ? AND position = ?'
+                    % (table, key), keys)
+        else:
+            conn.executemany(
+                    'DELETE FROM %s WHERE %s = ?' % (table, key),
+                    ((k,) for k in keys))
+
+    def __unicode__(self):
+        return 'SqliteExporter(%s)' % self.path
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class ColumnarExporter(object):
+    """Exports a library into chunked columnar files, incrementally."""
+
+    def __init__(self, directory, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Creates a new ColumnarExporter.
+
+        @param directory: Where to write the chunks and the manifest. Created
+                if it doesn't exist.
+        @type directory: str
+        @param chunk_size: The number of rows per chunk. Optional. Defaults to
+                50000.
+        @type chunk_size: int
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    @profiling.profiled('export.columnar')
+    def export(self, library, full=False):
+        """Exports a library.
+
+        Only one chunk per table is held in memory at a time.
+
+        @type library: pytunes.Library
+        @param full: Whether to rewrite all chunks instead of only the changed
+                ones.
+        @type full: bool
+        @return: The number of written, unchanged and removed chunks per
+                table, e.g. 'tracks.written'.
+        @rtype: collections.Counter
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        old_manifest = self._read_manifest()
+        if (full or old_manifest.get('version') != _FORMAT_VERSION or
+            old_manifest.get('chunk_size') != self.chunk_size):
+            old_manifest = {}
+        old_chunks = old_manifest.get('tables', {})
+        counts = collections.Counter()
+        chunks = dict((table, []) for table in TABLES)
+        pending = dict((table, ([], [])) for table in TABLES)
+
+        def flush(table):
+            rows, checksums = pending[table]
+            if not rows:
+                return
+            index = len(chunks[table])
+            old = old_chunks.get(table, [])
+            chunk = {
+                'file': '%s-%05d.npz' % (table, index),
+                'rows': len(rows),
+                'checksum': _checksum(checksums),
+            }
+            path = os.path.join(self.directory, chunk['file'])
+            if (index < len(old) and old[index] == chunk and
+                os.path.exists(path)):
+                counts[table + '.unchanged'] += 1
+            else:
+                self._write_chunk(path, TABLES[table], rows)
+                counts[table + '.written'] += 1
+            chunks[table].append(chunk)
+            del rows[:]
+            del checksums[:]
+
+        for table, row in iter_rows(library):
+            rows, checksums = pending[table]
+            rows.append(row)
+            checksums.append(_checksum(row))
+            if len(rows) >= self.chunk_size:
+                flush(table)
+        for table in TABLES:
+            flush(table)
+
+        self._write_manifest({
+            'version': _FORMAT_VERSION,
+            'chunk_size': self.chunk_size,
+            'columns': dict(
+                    (table, [list(column) for column in columns])
+                    for table, columns in TABLES.iteritems()),
+            'tables': chunks,
+        })
+        for table, old in old_chunks.iteritems():
+            for chunk in old[len(chunks.get(table, [])):]:
+                path = os.path.join(self.directory, chunk['file'])
+                if os.path.exists(path):
+                    os.remove(path)
+                counts[table + '.removed'] += 1
+        return counts
+
+    def _write_chunk(self, path, columns, rows):
+        arrays = {}
+        for i, (column, column_type) in enumerate(columns):
+            values = [row[i] for row in rows]
+            if column_type == TEXT:
+                data, offsets = _encode_strings(values)
+                arrays[column + '.data'] = data
+                arrays[column + '.offsets'] = offsets
+            elif column_type == BOOLEAN:
+                arrays[column] = numpy.array(
+                        [bool(v) for v in values], dtype=numpy.bool_)
+            elif column_type == DATE:
+                arrays[column] = numpy.array(
+                        [_to_timestamp(v) for v in values], dtype=numpy.int64)
+            else:
+                arrays[column] = numpy.array(
+                        [v or 0 for v in values], dtype=numpy.int64)
+        _write_atomically(path, lambda f: numpy.savez(f, **arrays))
+
+    def _read_manifest(self):
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            try:
+                return simplejson.load(f)
+            except ValueError:
+                logger.warning('Ignoring a broken manifest: %s', path)
+                return {}
+
+    def _write_manifest(self, manifest):
+        _write_atomically(
+                os.path.join(self.directory, MANIFEST_NAME),
+                lambda f: simplejson.dump(manifest, f, indent=2))
+
+    def __unicode__(self):
+        return 'ColumnarExporter(%s)' % self.directory
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def read_chunk(path):
+    """Reads a columnar chunk.
+
+    @type path: str
+    @return: The columns: NumPy arrays, and lists of unicode for strings.
+    @rtype: {str: object}
+    """
+    columns = {}
+    with contextlib.closing(numpy.load(path)) as chunk:
+        for name in chunk.files:
+            column, _, part = name.partition('.')
+            if part == 'offsets':
+                continue
+            if part == 'data':
+                columns[column] = _decode_strings(
+                        chunk[name], chunk[column + '.offsets'])
+            else:
+                columns[column] = chunk[name]
+    return columns
+
+
+def _get_key(item):
+    """Returns the key of a track or playlist in the exports."""
+    return item.persistent_id or unicode(item.id)
+
+
+def _get_row_key(table, row):
+    # Playlist items are keyed by playlist and position.
+    if table == 'playlist_items':
+        return row[0], row[1]
+    return row[0]
+
+
+def _get_state(table, row, checksum):
+    if table == 'tracks':
+        return _to_sqlite_value(row[_DATE_MODIFIED_COLUMN], DATE), checksum
+    return (checksum,)
+
+
+def _checksum(value):
+    # repr is stable for the tuples of strings, numbers and dates in rows.
+    return zlib.crc32(repr(value)) & 0xffffffff
+
+
+def _to_sqlite_row(table, row):
+    return tuple(
+            _to_sqlite_value(value, column_type)
+            for value, (_, column_type) in zip(row, TABLES[table]))
+
+
+def _to_sqlite_value(value, column_type):
+    if value is None:
+        return None
+    if column_type == DATE:
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if column_type == BOOLEAN:
+        return int(bool(value))
+    return value
+
+
+def _to_timestamp(date):
+    if date is None:
+        return 0
+    return calendar.timegm(date.utctimetuple())
+
+
+def _encode_strings(values):
+    encoded = [(v or u'').encode('utf-8') for v in values]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = numpy.frombuffer(''.join(encoded), dtype=numpy.uint8)
+    return data, offsets
+
+
+def _decode_strings(data, offsets):
+    data = data.tostring()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+            for i in xrange(len(offsets) - 1)]
+
+
+def _write_atomically(path, write):
+    """Writes a file through a temporary file, so it is never seen half
+    written."""
+    fd, tmp_path = tempfile.mkstemp(
+            suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (library_path, sqlite_path, columnar_dir, chunk_size, full,
+         profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    logger.info('Opening iTunes library...')
+    lib = pytunes.Library(library_path)
+    exporters = []
+    if sqlite_path:
+        exporters.append(SqliteExporter(sqlite_path))
+    if columnar_dir:
+        exporters.append(ColumnarExporter(columnar_dir, chunk_size))
+    for exporter in exporters:
+        logger.info('Exporting to %s...', exporter)
+        counts = exporter.export(lib, full)
+        for name, count in sorted(counts.iteritems()):
+            logger.info('  %s: %d', name, count)
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
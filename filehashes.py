@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""Content hashes of files, computed on a thread pool and cached on disk.
+
+Two hashes are computed per file:
+
+    - The partial hash covers the size and the first and last blocks of the
+      file. It is cheap, even for large files, and tells most files of the
+      same size apart.
+    - The full hash covers the whole file. It is only computed when the
+      partial hashes match.
+
+For files no larger than two blocks, both hashes are the same.
+
+The hashes are cached in a small SQLite database, keyed by path, size and
+modification time, so files that didn't change are never read again.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import os.path
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.pytunes/filehashes.sqlite')
+DEFAULT_WORKERS = 16
+BLOCK_SIZE = 64 << 10
+
+# The maximum number of keys per query, below SQLite's limit of 999
+# parameters.
+_MAX_QUERY_KEYS = 500
+_READ_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+class HashCache(object):
+    """A persistent cache of file hashes."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        """Creates a new HashCache.
+
+        @param path: The path of the cache database. Created if it doesn't
+                exist. Optional. Defaults to ~/.pytunes/filehashes.sqlite.
+        @type path: str
+        """
+        self.path = path
+
+    def get(self, paths):
+        """Reads the cached entries of some files.
+
+        @type paths: [unicode]
+        @return: The size, modification time, partial and full hash (None if
+                not computed yet) per path found in the cache.
+        @rtype: {unicode: (int, str, str, str)}
+        """
+        paths = list(paths)
+        entries = {}
+        with self._connect() as conn:
+            for start in xrange(0, len(paths), _MAX_QUERY_KEYS):
+                chunk = paths[start:start + _MAX_QUERY_KEYS]
+                rows = conn.execute(
+                        'SELECT path, size, mtime, partial_hash, full_hash '
+                        'FROM hashes WHERE path IN (%s)'
+                        % ', '.join('?' * len(chunk)), chunk)
+                for row in rows:
+                    entries[row[0]] = tuple(row[1:])
+        return entries
+
+    def put(self, entries):
+        """Stores some entries, replacing the previous ones of their paths.
+
+        @param entries: The path, size, modification time, partial and full
+                hash (None if not computed) of each file.
+        @type entries: [(unicode, int, str, str, str)]
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                    entries)
+            conn.commit()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            conn.execute(
+                    'CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+                    'size INTEGER, mtime TEXT, partial_hash TEXT, '
+                    'full_hash TEXT)')
+            yield conn
+
+    def __unicode__(self):
+        return 'HashCache(%s)' % self.path
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class FileHasher(object):
+    """Hashes files on a thread pool, using a HashCache if given.
+
+    Files that can't be read are left out of the results.
+    """
+
+    def __init__(self, cache=None, workers=DEFAULT_WORKERS,
+                 block_size=BLOCK_SIZE):
+        """Creates a new FileHasher.
+
+        @param cache: The cache to use. Optional. Defaults to none.
+        @type cache: HashCache
+        @param workers: The number of files read at the same time. Optional.
+                Defaults to 16.
+        @type workers: int
+        @param block_size: The size of the first and last blocks covered by
+                the partial hash. Optional. Defaults to 64 KB.
+        @type block_size: int
+        """
+        self.cache = cache
+        self.workers = workers
+        self.block_size = block_size
+        self.counts = {'cached': 0, 'hashed': 0, 'failed': 0}
+
+    def partial_hashes(self, paths):
+        """@return: The size and partial hash per path.
+        @rtype: {unicode: (int, str)}
+        """
+        return dict(
+                (path, (entry[0], entry[2]))
+                for path, entry in self._hash(paths, full=False).iteritems())
+
+    def full_hashes(self, paths):
+        """@return: The full hash per path.
+        @rtype: {unicode: str}
+        """
+        return dict(
+                (path, entry[3])
+                for path, entry in self._hash(paths, full=True).iteritems())
+
+    def _hash(self, paths, full):
+        paths = list(set(paths))
+        cached = self.cache.get(paths) if self.cache else {}
+        tasks = [(path, cached.get(path), full) for path in paths]
+        entries = {}
+        updated = []
+        pool = ThreadPool(max(1, min(self.workers, len(tasks))))
+        try:
+            for path, entry, is_new in pool.imap_unordered(
+                    self._hash_file, tasks):
+                if entry is None:
+                    self.counts['failed'] += 1
+                    continue
+                entries[path] = entry
+                if is_new:
+                    self.counts['hashed'] += 1
+                    updated.append((path,) + entry)
+                else:
+                    self.counts['cached'] += 1
+        finally:
+            pool.close()
+            pool.join()
+        if self.cache and updated:
+            self.cache.put(updated)
+        return entries
+
+    def _hash_file(self, task):
+        """Hashes a file in a worker thread, unless the cached entry is still
+        valid.
+
+        @return: The path, its entry (size, mtime, partial and full hash) or
+                None if the file can't be read, and whether the entry is new.
+        @rtype: (unicode, tuple, bool)
+        """
+        path, entry, full = task
+        try:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, repr(stat.st_mtime)
+            if entry is None or entry[:2] != (size, mtime):
+                entry = (size, mtime, None, None)
+            elif entry[2] is not None and (entry[3] is not None or not full):
+                return path, entry, False
+            partial_hash = entry[2]
+            full_hash = entry[3]
+            if partial_hash is None:
+                partial_hash = self._get_partial_hash(path, size)
+                if size <= 2 * self.block_size:
+                    full_hash = partial_hash
+            if full and full_hash is None:
+                full_hash = self._get_full_hash(path)
+            return path, (size, mtime, partial_hash, full_hash), True
+        except (IOError, OSError), e:
+            logger.debug('Cannot hash %s: %s', path, e)
+            return path, None, False
+
+    def _get_partial_hash(self, path, size):
+        content_hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            if size <= 2 * self.block_size:
+                content_hash.update(f.read())
+            else:
+                content_hash.update(str(size))
+                content_hash.update(f.read(self.block_size))
+                f.seek(-self.block_size, os.SEEK_END)
+                content_hash.update(f.read(self.block_size))
+        return content_hash.hexdigest()
+
+    def _get_full_hash(self, path):
+        content_hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(_READ_SIZE)
+                if not block:
+                    break
+                content_hash.update(block)
+        return content_hash.hexdigest()
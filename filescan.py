@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+"""A tool to find dead tracks, orphan audio files and duplicate files.
+
+Dead tracks are tracks in your iTunes library whose file no longer exists.
+Orphan files are audio files on disk that no track points to. Duplicate files
+are files of different tracks with the same content.
+"""
+
+import getopt
+import logging
+import sys
+
+import simplejson
+
+import analysis
+import filehashes
+import profiling
+import pytunes
+
+LOG_FORMAT = '%(message)s'
+FORMATS = ('text', 'json')
+DEFAULT_WORKERS = 16
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: filescan.py
+    [-h|--help]          This screen.
+    [-d|--duplicates]    Find tracks whose files have the same content
+                         instead.
+    [-n|--no-cache]      Don't use the cache of file hashes in
+                         ~/.pytunes/filehashes.sqlite.
+    [-f|--format FORMAT] The output format: text (default) or json.
+    [-l|--library PATH]  The iTunes library XML. Defaults to the user's.
+    [-r|--root PATH]     A directory to search for orphan files recursively.
+                         Can be given more than once. Without it, only the
+                         directories of the tracks are searched.
+    [-w|--workers N]     The number of directories listed or files read at
+                         the same time.
+                         Defaults to 16.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    find_duplicates = False
+    use_cache = True
+    output_format = 'text'
+    library_path = None
+    roots = []
+    workers = DEFAULT_WORKERS
+    profile_path = None
+
+    options = 'hdnf:l:r:w:p:'
+    options_long = [
+            'help', 'duplicates', 'no-cache', 'format=', 'library=', 'root=',
+            'workers=', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-d', '--duplicates'):
+                find_duplicates = True
+            if opt in ('-n', '--no-cache'):
+                use_cache = False
+            if opt in ('-f', '--format'):
+                output_format = arg
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-r', '--root'):
+                roots.append(arg)
+            if opt in ('-w', '--workers'):
+                workers = int(arg)
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if output_format not in FORMATS:
+        raise Usage('Unknown format: %s.' % output_format)
+    if workers < 1:
+        raise Usage('Need at least one worker.')
+
+    return (find_duplicates, use_cache, output_format, library_path, roots,
+            workers, profile_path)
+
+
+def print_text(result):
+    print 'Dead tracks (%d):' % len(result.dead_tracks)
+    for track in result.dead_tracks:
+        print (u'%s - %s: %s' % (
+                track.artist, track.name, track.path)).encode('utf-8')
+    print
+    print 'Orphan files (%d):' % len(result.orphan_files)
+    for path in result.orphan_files:
+        print path.encode('utf-8')
+    if result.unreadable_directories:
+        print
+        print 'Unreadable directories (%d):' % len(
+                result.unreadable_directories)
+        for directory, error in result.unreadable_directories:
+            print (u'%s: %s' % (directory, error.strerror)).encode('utf-8')
+
+
+def print_json(result):
+    print simplejson.dumps({
+        'dead_tracks': [
+            {
+                'id': t.id,
+                'persistent_id': t.persistent_id,
+                'artist': t.artist,
+                'name': t.name,
+                'path': t.path,
+            }
+            for t in result.dead_tracks
+        ],
+        'orphan_files': result.orphan_files,
+        'unreadable_directories': [
+            {'directory': directory, 'error': error.strerror}
+            for directory, error in result.unreadable_directories
+        ],
+    }, indent=2)
+
+
+def print_duplicates_text(groups):
+    print 'Duplicate files (%d):' % len(groups)
+    for group in groups:
+        print
+        for track in group:
+            print (u'%s - %s: %s' % (
+                    track.artist, track.name, track.path)).encode('utf-8')
+
+
+def print_duplicates_json(groups):
+    print simplejson.dumps({
+        'duplicate_files': [
+            [
+                {
+                    'id': t.id,
+                    'persistent_id': t.persistent_id,
+                    'artist': t.artist,
+                    'name': t.name,
+                    'path': t.path,
+                }
+                for t in group
+            ]
+            for group in groups
+        ],
+    }, indent=2)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (find_duplicates, use_cache, output_format, library_path, roots,
+                workers, profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    logger.info('Opening iTunes library...')
+    lib = pytunes.Library(library_path)
+    logger.info('Loading all tracks...')
+    tracks = list(lib.tracks)
+    if find_duplicates:
+        logger.info('Hashing files...')
+        cache = filehashes.HashCache() if use_cache else None
+        groups = analysis.find_duplicate_files(tracks, workers, cache)
+        if output_format == 'json':
+            print_duplicates_json(groups)
+        else:
+            print_duplicates_text(groups)
+    else:
+        logger.info('Scanning directories...')
+        result = analysis.find_dead_tracks_and_orphan_files(
+                tracks, roots, workers)
+        if output_format == 'json':
+            print_json(result)
+        else:
+            print_text(result)
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,438 @@
+#!/usr/bin/python
+
+"""A tool to generate synthetic iTunes library XML files.
+
+The libraries look like real ones as far as this project is concerned:
+albums in their own directories, compilations, single tracks, duplicates
+(some with "(Remastered)" names or slightly different total times), Moody
+composer tags, podcasts, regular playlists and smart playlists.
+
+The XML is written track by track, so even libraries with millions of tracks
+can be generated with little memory.
+"""
+
+import base64
+import datetime
+import getopt
+import logging
+import random
+import sys
+import urllib
+from xml.sax.saxutils import escape
+
+import smartplaylists
+
+LOG_FORMAT = '%(message)s'
+MUSIC_FOLDER = 'file://localhost/Users/generated/Music/iTunes/iTunes Music/'
+GENRES = (
+        'Alternative', 'Blues', 'Classical', 'Electronic', 'Hip-Hop', 'Jazz',
+        'Metal', 'Pop', 'Punk', 'Reggae', 'Rock', 'Soundtrack')
+MOODS = ['%s%d' % (c, i) for c in 'ABCD' for i in range(1, 5)]
+SYLLABLES = (
+        'ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'vi', 'an', 'el', 'or',
+        'us', 'bra', 'dor', 'fen', 'gal', 'hum', 'jin', 'kor', 'lum', 'mar',
+        'nox', 'pel', 'qua', 'ros', 'sil', 'tur', 'vex', 'wal', 'zen')
+
+# Smart playlists: name, rules and whether any (instead of all) rule must
+# match. See smart_criteria for the rules.
+SMART_PLAYLISTS = (
+        ('Top Rated', [('rating', 'gte', 80)], False),
+        ('Recently Added Rock', [('genre', 'is', 'Rock'),
+                                 ('year', 'gte', 2000)], False),
+        ('Never Played', [('play_count', 'is', 0)], False),
+        ('Jazz or Blues', [('genre', 'is', 'Jazz'),
+                           ('genre', 'is', 'Blues')], True),
+        ('Moody', [('composer', 'starts', 'Moody')], False),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: generate_library.py
+    [-h|--help]            This screen.
+    [-n|--tracks N]        The number of tracks. Defaults to 10000.
+    [-p|--playlists N]     The number of regular playlists. Defaults to 20.
+    [-s|--seed N]          The random seed. Defaults to 0.
+    [-o|--output PATH]     Where to write the XML. Defaults to STDOUT.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    num_tracks = 10000
+    num_playlists = 20
+    seed = 0
+    output = None
+
+    options = 'hn:p:s:o:'
+    options_long = ['help', 'tracks=', 'playlists=', 'seed=', 'output=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-n', '--tracks'):
+                num_tracks = int(arg)
+            if opt in ('-p', '--playlists'):
+                num_playlists = int(arg)
+            if opt in ('-s', '--seed'):
+                seed = int(arg)
+            if opt in ('-o', '--output'):
+                output = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    return num_tracks, num_playlists, seed, output
+
+
+class LibraryGenerator(object):
+    """Generates the tracks and playlists of a synthetic library."""
+
+    def __init__(self, num_tracks, num_playlists=20, seed=0):
+        self.num_tracks = num_tracks
+        self.num_playlists = num_playlists
+        self._random = random.Random(seed)
+        num_artists = max(1, num_tracks / 40)
+        self._artists = [self._make_name(2) for _ in xrange(num_artists)]
+        self._next_id = 1000
+
+    def write(self, out):
+        """Writes the library XML.
+
+        @param out: The file to write to.
+        @type out: file
+        """
+        rnd = self._random
+        out.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+                '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                '<plist version="1.0">\n<dict>\n')
+        _write_entry(out, 1, 'Major Version', 1)
+        _write_entry(out, 1, 'Minor Version', 1)
+        _write_entry(out, 1, 'Application Version', '10.6.3')
+        _write_entry(out, 1, 'Features', 5)
+        _write_entry(out, 1, 'Show Content Ratings', True)
+        _write_entry(out, 1, 'Music Folder', MUSIC_FOLDER)
+        _write_entry(
+                out, 1, 'Library Persistent ID', '%016X' % rnd.getrandbits(64))
+
+        # Only the track IDs are kept, to fill the playlists.
+        all_ids = []
+        smart_ids = [[] for _ in SMART_PLAYLISTS]
+        out.write('\t<key>Tracks</key>\n\t<dict>\n')
+        for track in self._generate_tracks():
+            out.write('\t\t<key>%d</key>\n' % track['Track ID'])
+            _write_dict(out, 2, track)
+            all_ids.append(track['Track ID'])
+            for ids, (_, rules, match_any) in zip(smart_ids, SMART_PLAYLISTS):
+                if _matches(track, rules, match_any):
+                    ids.append(track['Track ID'])
+        out.write('\t</dict>\n')
+
+        out.write('\t<key>Playlists</key>\n\t<array>\n')
+        self._write_playlist(out, {
+            'Name': 'Library',
+            'Master': True,
+            'Visible': False,
+            'All Items': True,
+        }, all_ids)
+        self._write_playlist(out, {
+            'Name': 'Music',
+            'Distinguished Kind': 4,
+            'Music': True,
+            'All Items': True,
+        }, all_ids)
+        for i in xrange(self.num_playlists):
+            size = min(len(all_ids), rnd.randint(10, 200))
+            self._write_playlist(out, {
+                'Name': self._make_name(2).title(),
+                'All Items': True,
+            }, rnd.sample(all_ids, size))
+        for ids, (name, rules, match_any) in zip(smart_ids, SMART_PLAYLISTS):
+            self._write_playlist(out, {
+                'Name': name,
+                'All Items': True,
+                'Smart Info': _Data(smart_info()),
+                'Smart Criteria': _Data(smart_criteria(rules, match_any)),
+            }, ids)
+        out.write('\t</array>\n</dict>\n</plist>\n')
+
+    def _write_playlist(self, out, playlist, track_ids):
+        playlist['Playlist ID'] = self._new_id()
+        playlist['Playlist Persistent ID'] = (
+                '%016X' % self._random.getrandbits(64))
+        playlist['Playlist Items'] = [{'Track ID': i} for i in track_ids]
+        _write_dict(out, 2, playlist)
+
+    def _generate_tracks(self):
+        rnd = self._random
+        count = 0
+        while count < self.num_tracks:
+            kind = rnd.random()
+            if kind < 0.7:
+                tracks = self._generate_album()
+            elif kind < 0.8:
+                tracks = self._generate_album(compilation=True)
+            elif kind < 0.97:
+                tracks = [self._generate_single()]
+            else:
+                tracks = [self._generate_single(podcast=True)]
+            for track in tracks:
+                if count >= self.num_tracks:
+                    return
+                yield track
+                count += 1
+                # Duplicates, either as is or as a "new" release.
+                if count < self.num_tracks and rnd.random() < 0.03:
+                    yield self._duplicate(track)
+                    count += 1
+
+    def _generate_album(self, compilation=False):
+        rnd = self._random
+        album = self._make_name(rnd.randint(1, 3)).title()
+        year = rnd.randint(1960, 2012)
+        genre = rnd.choice(GENRES)
+        if compilation:
+            album_artist = 'Various Artists'
+        else:
+            album_artist = rnd.choice(self._artists)
+        directory = '%s/%s/' % (album_artist, album)
+        tracks = []
+        for number in xrange(1, rnd.randint(8, 16)):
+            if compilation:
+                artist = rnd.choice(self._artists)
+            else:
+                artist = album_artist
+            name = self._make_name(rnd.randint(1, 4)).title()
+            track = self._generate_track(
+                    artist, name, '%s%02d %s.mp3' % (directory, number, name))
+            track.update({
+                'Album': album,
+                'Year': year,
+                'Genre': genre,
+                'Track Number': number,
+            })
+            if compilation:
+                track['Album Artist'] = album_artist
+                track['Compilation'] = True
+            tracks.append(track)
+        return tracks
+
+    def _generate_single(self, podcast=False):
+        rnd = self._random
+        artist = rnd.choice(self._artists)
+        name = self._make_name(rnd.randint(1, 4)).title()
+        if podcast:
+            track = self._generate_track(
+                    artist, name, 'Podcasts/%s/%s.mp3' % (artist, name))
+            track['Podcast'] = True
+            track['Genre'] = 'Podcast'
+        else:
+            track = self._generate_track(
+                    artist, name, 'Singles/%s - %s.mp3' % (artist, name))
+            track['Genre'] = rnd.choice(GENRES)
+            if rnd.random() < 0.5:
+                track['Year'] = rnd.randint(1960, 2012)
+        return track
+
+    def _generate_track(self, artist, name, path):
+        rnd = self._random
+        track_id = self._new_id()
+        added = datetime.datetime(2005, 1, 1) + datetime.timedelta(
+                seconds=rnd.randint(0, 7 * 365 * 86400))
+        total_time = rnd.randint(60000, 600000)
+        bit_rate = rnd.choice((128, 192, 256, 320))
+        track = {
+            'Track ID': track_id,
+            'Name': name,
+            'Artist': artist,
+            'Kind': 'MPEG audio file',
+            'Size': total_time * bit_rate / 8,
+            'Total Time': total_time,
+            'Date Modified': added,
+            'Date Added': added,
+            'Bit Rate': bit_rate,
+            'Sample Rate': 44100,
+            'Persistent ID': '%016X' % rnd.getrandbits(64),
+            'Track Type': 'File',
+            'Location': MUSIC_FOLDER + urllib.quote(path),
+            'File Folder Count': 4,
+            'Library Folder Count': 1,
+        }
+        if rnd.random() < 0.7:
+            track['Rating'] = rnd.choice((20, 40, 60, 80, 100))
+        if rnd.random() < 0.6:
+            track['Play Count'] = rnd.randint(1, 100)
+            track['Play Date UTC'] = added + datetime.timedelta(days=30)
+        if rnd.random() < 0.2:
+            track['Skip Count'] = rnd.randint(1, 10)
+        if rnd.random() < 0.1:
+            track['Composer'] = 'Moody' + rnd.choice(MOODS)
+        return track
+
+    def _duplicate(self, track):
+        rnd = self._random
+        duplicate = dict(track)
+        duplicate['Track ID'] = self._new_id()
+        duplicate['Persistent ID'] = '%016X' % rnd.getrandbits(64)
+        duplicate['Location'] = track['Location'].replace('.mp3', ' 1.mp3')
+        duplicate['Total Time'] = track['Total Time'] + rnd.randint(-8, 8)
+        if rnd.random() < 0.3:
+            duplicate['Name'] = track['Name'] + ' (Remastered)'
+            duplicate['Total Time'] += rnd.randint(-1500, 1500)
+        duplicate.pop('Rating', None)
+        duplicate.pop('Play Count', None)
+        duplicate.pop('Play Date UTC', None)
+        return duplicate
+
+    def _make_name(self, words):
+        rnd = self._random
+        return ' '.join(
+                ''.join(rnd.choice(SYLLABLES)
+                        for _ in xrange(rnd.randint(1, 3)))
+                for _ in xrange(words))
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+
+class _Data(object):
+    """Raw bytes, written as a <data> element."""
+
+    def __init__(self, data):
+        self.data = data
+
+
+_SMART_TRACK_KEYS = {
+    'name': 'Name',
+    'album': 'Album',
+    'artist': 'Artist',
+    'year': 'Year',
+    'genre': 'Genre',
+    'composer': 'Composer',
+    'play_count': 'Play Count',
+    'rating': 'Rating',
+}
+
+
+def smart_info():
+    """Returns a Smart Info blob: live updating, no limit."""
+    return smartplaylists.encode_smart_info(smartplaylists.SmartInfo())
+
+
+def smart_criteria(rules, match_any=False):
+    """Encodes some rules as a Smart Criteria blob.
+
+    @param rules: The rules as field name, operator name and value. Supports
+            the fields in _SMART_TRACK_KEYS and the operators in
+            smartplaylists.OPERATORS, plus 'gte' and 'lte', which are encoded
+            as an inclusive range.
+    @type rules: [(str, str, object)]
+    @param match_any: Whether any rule must match, instead of all.
+    @type match_any: bool
+    @rtype: str
+    """
+    smart_rules = []
+    for field, operator_name, value in rules:
+        code = smartplaylists.FIELD_CODES[field]
+        if operator_name == 'gte':
+            rule = smartplaylists.SmartRule(
+                    code, 'in_range', value, smartplaylists.MAX_VALUE)
+        elif operator_name == 'lte':
+            rule = smartplaylists.SmartRule(
+                    code, 'in_range', -smartplaylists.MAX_VALUE, value)
+        else:
+            rule = smartplaylists.SmartRule(code, operator_name, value)
+        smart_rules.append(rule)
+    return smartplaylists.encode_smart_criteria(
+            smartplaylists.SmartCriteria(smart_rules, match_any))
+
+
+def _matches(track, rules, match_any):
+    results = []
+    for field, operator_name, value in rules:
+        track_value = track.get(_SMART_TRACK_KEYS[field])
+        if operator_name == 'is':
+            if field == 'play_count' and track_value is None:
+                track_value = 0
+            result = track_value == value
+        elif operator_name == 'starts':
+            result = (track_value or '').startswith(value)
+        elif operator_name == 'gte':
+            result = track_value is not None and track_value >= value
+        elif operator_name == 'lte':
+            result = track_value is not None and track_value <= value
+        else:
+            raise ValueError('Unsupported operator: %s' % operator_name)
+        results.append(result)
+    if match_any:
+        return any(results)
+    return all(results)
+
+
+def _write_entry(out, depth, key, value):
+    out.write('%s<key>%s</key>' % ('\t' * depth, escape(key)))
+    _write_value(out, depth, value)
+
+
+def _write_dict(out, depth, item):
+    indent = '\t' * depth
+    out.write('%s<dict>\n' % indent)
+    for key in sorted(item):
+        _write_entry(out, depth + 1, key, item[key])
+    out.write('%s</dict>\n' % indent)
+
+
+def _write_value(out, depth, value):
+    if value is True:
+        out.write('<true/>\n')
+    elif value is False:
+        out.write('<false/>\n')
+    elif isinstance(value, (int, long)):
+        out.write('<integer>%d</integer>\n' % value)
+    elif isinstance(value, datetime.datetime):
+        out.write('<date>%s</date>\n' % value.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    elif isinstance(value, _Data):
+        out.write('<data>\n%s</data>\n' % base64.encodestring(value.data))
+    elif isinstance(value, list):
+        indent = '\t' * depth
+        out.write('\n%s<array>\n' % indent)
+        for item in value:
+            _write_dict(out, depth + 1, item)
+        out.write('%s</array>\n' % indent)
+    else:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        out.write('<string>%s</string>\n' % escape(value))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        num_tracks, num_playlists, seed, output = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    logger.info('Generating a library with %d tracks...', num_tracks)
+    generator = LibraryGenerator(num_tracks, num_playlists, seed)
+    if output:
+        with open(output, 'wb') as out:
+            generator.write(out)
+    else:
+        generator.write(sys.stdout)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+"""A compact set of integer IDs, e.g. Track IDs."""
+
+
+class IdSet(object):
+    """A set of non-negative integer IDs, stored as a bitmap.
+
+    Takes one bit per ID up to the largest one: 125 KB for IDs up to a
+    million, where a set of as many Track objects or ints takes tens of MB.
+    """
+
+    __slots__ = ('_bits', '_len')
+
+    def __init__(self, ids=()):
+        """Creates a new IdSet.
+
+        @param ids: The initial IDs. Optional.
+        @type ids: iterable(int)
+        """
+        self._bits = bytearray()
+        self._len = 0
+        self.update(ids)
+
+    def add(self, item_id):
+        if item_id < 0:
+            raise ValueError('Negative ID: %d' % item_id)
+        byte = item_id >> 3
+        bit = 1 << (item_id & 7)
+        bits = self._bits
+        if byte >= len(bits):
+            # Grow at least twofold, so adding ascending IDs stays linear.
+            bits.extend(bytearray(max(byte + 1 - len(bits), len(bits))))
+        if not bits[byte] & bit:
+            bits[byte] |= bit
+            self._len += 1
+
+    def update(self, ids):
+        add = self.add
+        for item_id in ids:
+            add(item_id)
+
+    def discard(self, item_id):
+        byte = item_id >> 3
+        bit = 1 << (item_id & 7)
+        bits = self._bits
+        if 0 <= byte < len(bits) and bits[byte] & bit:
+            bits[byte] &= ~bit & 0xff
+            self._len -= 1
+
+    def __contains__(self, item_id):
+        byte = item_id >> 3
+        return (0 <= byte < len(self._bits) and
+                bool(self._bits[byte] & (1 << (item_id & 7))))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        """Yields the IDs in ascending order."""
+        for byte_index, byte in enumerate(self._bits):
+            if byte:
+                base = byte_index << 3
+                for bit in xrange(8):
+                    if byte & (1 << bit):
+                        yield base + bit
+
+    def __unicode__(self):
+        return u'IdSet(%d IDs)' % self._len
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
@@ -0,0 +1,517 @@
+#!/usr/bin/python
+
+"""A tool to diff two copies of an iTunes library XML.
+
+Reports tracks added and removed, changed fields (with play count deltas)
+and playlists added, removed, renamed or with changed membership.
+
+Neither library is loaded as a whole. Both XMLs are streamed, and the
+tracks and playlists are hash-joined on their Persistent ID: the entries of
+the old library are kept in memory up to a limit, beyond which they are
+partitioned into temporary files by the hash of their key, along with the
+entries of the new library. Each partition is then joined on its own. Every
+entry is read, written and joined a constant number of times, so a diff
+takes time linear in the size of the libraries.
+
+To map the Track IDs of playlist items to Persistent IDs, each library keeps
+a compact table of 16 bytes per track.
+"""
+
+import array
+import collections
+import cPickle
+import datetime
+import getopt
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+import numpy
+import simplejson
+
+import profiling
+import pytunes
+
+LOG_FORMAT = '%(message)s'
+FORMATS = ('text', 'json')
+
+# The compared track fields: plist key and report name.
+TRACK_FIELDS = (
+        ('Name', 'name'),
+        ('Artist', 'artist'),
+        ('Album Artist', 'album_artist'),
+        ('Album', 'album'),
+        ('Genre', 'genre'),
+        ('Composer', 'composer'),
+        ('Year', 'year'),
+        ('Track Number', 'number'),
+        ('Total Time', 'total_time'),
+        ('Size', 'size'),
+        ('Bit Rate', 'bit_rate'),
+        ('Rating', 'rating'),
+        ('Play Count', 'play_count'),
+        ('Play Date UTC', 'play_date_utc'),
+        ('Skip Count', 'skip_count'),
+        ('Date Modified', 'date_modified'),
+        ('Location', 'location'),
+)
+# The fields kept in the report of added and removed tracks.
+_SUMMARY_FIELDS = ('name', 'artist', 'album')
+
+# The change types.
+TRACK_ADDED = 'track_added'
+TRACK_REMOVED = 'track_removed'
+TRACK_MODIFIED = 'track_modified'
+PLAYLIST_ADDED = 'playlist_added'
+PLAYLIST_REMOVED = 'playlist_removed'
+PLAYLIST_MODIFIED = 'playlist_modified'
+
+# The number of entries of the old library kept in memory before spilling to
+# disk.
+DEFAULT_MAX_ENTRIES_IN_MEMORY = 200000
+PARTITIONS = 64
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: libdiff.py [options] OLD_XML NEW_XML
+    [-h|--help]          This screen.
+    [-f|--format FORMAT] The output format: text (default) or json, which
+                         prints one change per line (JSON Lines).
+    [-m|--max-memory N]  The number of tracks or playlists of the old library
+                         kept in memory before spilling to disk. Defaults to
+                         200000.
+    [-t|--temp-dir PATH] Where to spill to. Defaults to the system's
+                         temporary directory.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    output_format = 'text'
+    max_entries = DEFAULT_MAX_ENTRIES_IN_MEMORY
+    temp_dir = None
+    profile_path = None
+
+    options = 'hf:m:t:p:'
+    options_long = ['help', 'format=', 'max-memory=', 'temp-dir=', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-f', '--format'):
+                output_format = arg
+            if opt in ('-m', '--max-memory'):
+                max_entries = int(arg)
+            if opt in ('-t', '--temp-dir'):
+                temp_dir = arg
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if len(args) != 2:
+        raise Usage('Need the old and the new library XML.')
+    if output_format not in FORMATS:
+        raise Usage('Unknown format: %s.' % output_format)
+    if max_entries < 1:
+        raise Usage('Need to keep at least one entry in memory.')
+
+    return (args[0], args[1], output_format, max_entries, temp_dir,
+            profile_path)
+
+
+class HashJoin(object):
+    """A full outer hash join of two streams of (key, value) pairs, which
+    spills to disk when the left side doesn't fit in memory.
+
+    Both streams are consumed once. Keys must be unique per stream.
+    """
+
+    def __init__(self, max_in_memory=DEFAULT_MAX_ENTRIES_IN_MEMORY,
+                 partitions=PARTITIONS, temp_dir=None):
+        """Creates a new HashJoin.
+
+        @param max_in_memory: The number of left entries to keep in memory.
+                If there are more, both sides are spilled to disk.
+        @type max_in_memory: int
+        @param partitions: The number of partitions to spill to.
+        @type partitions: int
+        @param temp_dir: Where to spill to. Optional. Defaults to the
+                system's temporary directory.
+        @type temp_dir: str
+        """
+        self.max_in_memory = max_in_memory
+        self.partitions = partitions
+        self.temp_dir = temp_dir
+        self.spilled = False
+
+    def join(self, left, right):
+        """Joins two streams.
+
+        @type left: iterable((object, object))
+        @type right: iterable((object, object))
+        @return: Yields the keys and their left and right values, None for a
+                missing side. In no particular order.
+        @rtype: generator((object, object, object))
+        """
+        table = {}
+        left = iter(left)
+        for key, value in left:
+            if len(table) >= self.max_in_memory:
+                # Only spill once an entry doesn't fit.
+                overflow = [(key, value)]
+                break
+            table[key] = value
+        else:
+            for item in self._probe(table, right):
+                yield item
+            return
+
+        self.spilled = True
+        directory = tempfile.mkdtemp(prefix='libdiff-', dir=self.temp_dir)
+        try:
+            left_paths = self._partition(
+                    directory, 'left',
+                    _chain(table.iteritems(), overflow, left))
+            del table
+            right_paths = self._partition(directory, 'right', right)
+            for left_path, right_path in zip(left_paths, right_paths):
+                table = dict(_read_partition(left_path))
+                os.remove(left_path)
+                for item in self._probe(table, _read_partition(right_path)):
+                    yield item
+                os.remove(right_path)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _probe(self, table, right):
+        for key, value in right:
+            yield key, table.pop(key, None), value
+        for key, value in table.iteritems():
+            yield key, value, None
+
+    def _partition(self, directory, side, items):
+        paths = [os.path.join(directory, '%s-%03d' % (side, i))
+                 for i in xrange(self.partitions)]
+        files = [open(path, 'wb') for path in paths]
+        try:
+            for key, value in items:
+                partition = files[hash(key) % self.partitions]
+                cPickle.dump((key, value), partition, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            for f in files:
+                f.close()
+        return paths
+
+
+class _TrackIdMap(object):
+    """Maps the Track IDs of a library to Persistent IDs, compactly.
+
+    Persistent IDs are 16 hex digits, so they are stored as 64-bit integers
+    in a sorted array next to the Track IDs. Anything else is kept in a dict.
+    """
+
+    def __init__(self):
+        self._track_ids = []
+        self._persistent_ids = []
+        self._others = {}
+        self._sorted = None
+
+    def add(self, track_id, persistent_id):
+        try:
+            value = int(persistent_id, 16)
+        except (TypeError, ValueError):
+            value = None
+        if (value is None or value >= 1 << 64 or
+            len(persistent_id) != 16):
+            self._others[track_id] = persistent_id
+            return
+        # Stored as int64, wrapping the upper half to negative values.
+        if value >= 1 << 63:
+            value -= 1 << 64
+        self._track_ids.append(track_id)
+        self._persistent_ids.append(value)
+
+    def freeze(self):
+        """Builds the lookup arrays, after all tracks have been added."""
+        track_ids = numpy.array(self._track_ids, dtype=numpy.int64)
+        persistent_ids = numpy.array(self._persistent_ids, dtype=numpy.int64)
+        order = numpy.argsort(track_ids, kind='mergesort')
+        self._sorted = track_ids[order], persistent_ids[order]
+        self._track_ids = self._persistent_ids = None
+
+    def lookup(self, track_ids):
+        """Maps Track IDs to Persistent IDs. Unknown Track IDs are dropped.
+
+        @type track_ids: array.array
+        @rtype: frozenset(str)
+        """
+        sorted_track_ids, persistent_ids = self._sorted
+        result = set()
+        if self._others:
+            for track_id in track_ids:
+                if track_id in self._others:
+                    result.add(self._others[track_id])
+        if len(sorted_track_ids):
+            track_ids = numpy.array(track_ids, dtype=numpy.int64)
+            indexes = numpy.searchsorted(sorted_track_ids, track_ids)
+            indexes = numpy.minimum(indexes, len(sorted_track_ids) - 1)
+            found = sorted_track_ids[indexes] == track_ids
+            result.update(
+                    '%016X' % (v & 0xffffffffffffffff)
+                    for v in persistent_ids[indexes[found]].tolist())
+        return frozenset(result)
+
+
+class LibraryDiff(object):
+    """The changes between two library XMLs."""
+
+    def __init__(self, old_path, new_path,
+                 max_in_memory=DEFAULT_MAX_ENTRIES_IN_MEMORY, temp_dir=None):
+        """Creates a new LibraryDiff.
+
+        @param old_path: The path to the old library XML.
+        @type old_path: str
+        @param new_path: The path to the new library XML.
+        @type new_path: str
+        @param max_in_memory: The number of tracks or playlists of the old
+                library to keep in memory before spilling to disk. Optional.
+                Defaults to 200000.
+        @type max_in_memory: int
+        @param temp_dir: Where to spill to. Optional. Defaults to the
+                system's temporary directory.
+        @type temp_dir: str
+        """
+        self.old_path = old_path
+        self.new_path = new_path
+        self.max_in_memory = max_in_memory
+        self.temp_dir = temp_dir
+        self.counts = collections.Counter()
+
+    def __iter__(self):
+        """Yields the changes, tracks first.
+
+        Each change is a dict with its type and the Persistent ID. Added and
+        removed tracks have their name, artist and album. Modified tracks
+        have the changed fields as old and new value, and the play count
+        delta. Playlists have their name, modified ones the previous name if
+        it changed and the Persistent IDs of added and removed tracks.
+
+        The number of changes per type is counted in LibraryDiff.counts.
+
+        @rtype: generator(dict)
+        """
+        self.counts.clear()
+        old_ids = _TrackIdMap()
+        new_ids = _TrackIdMap()
+        for change in self._diff_tracks(old_ids, new_ids):
+            yield change
+        old_ids.freeze()
+        new_ids.freeze()
+        for change in self._diff_playlists(old_ids, new_ids):
+            yield change
+
+    @profiling.profiled('libdiff.tracks')
+    def _diff_tracks(self, old_ids, new_ids):
+        join = self._new_join()
+        old_tracks = _iter_track_entries(self.old_path, old_ids)
+        new_tracks = _iter_track_entries(self.new_path, new_ids)
+        for key, old, new in join.join(old_tracks, new_tracks):
+            if old is None:
+                change = _summarize(TRACK_ADDED, key, new)
+            elif new is None:
+                change = _summarize(TRACK_REMOVED, key, old)
+            else:
+                change = _diff_track(key, old, new)
+                if change is None:
+                    self.counts['tracks_unchanged'] += 1
+                    continue
+            self.counts[change['type']] += 1
+            yield change
+        if join.spilled:
+            logger.info('Tracks spilled to disk.')
+
+    @profiling.profiled('libdiff.playlists')
+    def _diff_playlists(self, old_ids, new_ids):
+        join = self._new_join()
+        old_playlists = _iter_playlist_entries(self.old_path)
+        new_playlists = _iter_playlist_entries(self.new_path)
+        for key, old, new in join.join(old_playlists, new_playlists):
+            if old is None:
+                change = {'type': PLAYLIST_ADDED, 'persistent_id': key,
+                          'name': new[0], 'items': len(new[1])}
+            elif new is None:
+                change = {'type': PLAYLIST_REMOVED, 'persistent_id': key,
+                          'name': old[0], 'items': len(old[1])}
+            else:
+                change = _diff_playlist(key, old, new, old_ids, new_ids)
+                if change is None:
+                    self.counts['playlists_unchanged'] += 1
+                    continue
+            self.counts[change['type']] += 1
+            yield change
+        if join.spilled:
+            logger.info('Playlists spilled to disk.')
+
+    def _new_join(self):
+        return HashJoin(self.max_in_memory, temp_dir=self.temp_dir)
+
+
+def _iter_track_entries(path, track_ids):
+    """Yields the Persistent IDs and compared fields of the tracks."""
+    for key, item in pytunes.PlistReader(path).iter_tracks():
+        persistent_id = item.get('Persistent ID') or key
+        track_ids.add(item.get('Track ID'), persistent_id)
+        yield persistent_id, tuple(item.get(k) for k, _ in TRACK_FIELDS)
+
+
+def _iter_playlist_entries(path):
+    """Yields the Persistent IDs, names and item Track IDs of the
+    playlists."""
+    for item in pytunes.PlistReader(path).iter_playlists():
+        persistent_id = (
+                item.get('Playlist Persistent ID') or
+                item.get('Persistent ID') or unicode(item.get('Playlist ID')))
+        item_ids = array.array(
+                'l', (i['Track ID'] for i in item.get('Playlist Items', ())))
+        yield persistent_id, (item.get('Name'), item_ids)
+
+
+def _summarize(change_type, key, values):
+    change = {'type': change_type, 'persistent_id': key}
+    for (_, name), value in zip(TRACK_FIELDS, values):
+        if name in _SUMMARY_FIELDS:
+            change[name] = value
+    return change
+
+
+def _diff_track(key, old, new):
+    if old == new:
+        return None
+    change = {'type': TRACK_MODIFIED, 'persistent_id': key, 'changes': {}}
+    for (_, name), old_value, new_value in zip(TRACK_FIELDS, old, new):
+        if name in _SUMMARY_FIELDS:
+            change[name] = new_value
+        if old_value != new_value:
+            change['changes'][name] = [old_value, new_value]
+    if 'play_count' in change['changes']:
+        old_count, new_count = change['changes']['play_count']
+        change['play_count_delta'] = (new_count or 0) - (old_count or 0)
+    return change
+
+
+def _diff_playlist(key, old, new, old_ids, new_ids):
+    old_name, old_items = old
+    new_name, new_items = new
+    if old_name == new_name and old_items == new_items:
+        return None
+    old_members = old_ids.lookup(old_items)
+    new_members = new_ids.lookup(new_items)
+    change = {
+        'type': PLAYLIST_MODIFIED,
+        'persistent_id': key,
+        'name': new_name,
+        'added_tracks': sorted(new_members - old_members),
+        'removed_tracks': sorted(old_members - new_members),
+    }
+    if old_name != new_name:
+        change['old_name'] = old_name
+    elif not change['added_tracks'] and not change['removed_tracks']:
+        # Only the Track IDs or the order changed.
+        return None
+    return change
+
+
+def _read_partition(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield cPickle.load(f)
+            except EOFError:
+                return
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+
+def print_text(change):
+    change_type = change['type']
+    if change_type in (TRACK_ADDED, TRACK_REMOVED):
+        line = u'%s %s: %s - %s' % (
+                '+' if change_type == TRACK_ADDED else '-',
+                change['persistent_id'], change['artist'], change['name'])
+    elif change_type == TRACK_MODIFIED:
+        line = u'~ %s: %s - %s: %s' % (
+                change['persistent_id'], change['artist'], change['name'],
+                u', '.join(u'%s %s -> %s' % (name, old, new)
+                           for name, (old, new)
+                           in sorted(change['changes'].iteritems())))
+    elif change_type in (PLAYLIST_ADDED, PLAYLIST_REMOVED):
+        line = u'%s playlist %s: %s (%d tracks)' % (
+                '+' if change_type == PLAYLIST_ADDED else '-',
+                change['persistent_id'], change['name'], change['items'])
+    else:
+        line = u'~ playlist %s: %s' % (change['persistent_id'], change['name'])
+        if 'old_name' in change:
+            line += u' (was %s)' % change['old_name']
+        line += u': +%d -%d tracks' % (
+                len(change['added_tracks']), len(change['removed_tracks']))
+    print line.encode('utf-8')
+
+
+def print_json(change):
+    print simplejson.dumps(change, default=_to_json)
+
+
+def _to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('Not JSON serializable: %r' % value)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (old_path, new_path, output_format, max_entries, temp_dir,
+         profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    print_change = print_json if output_format == 'json' else print_text
+    diff = LibraryDiff(old_path, new_path, max_entries, temp_dir)
+    for change in diff:
+        print_change(change)
+    for name, count in sorted(diff.counts.iteritems()):
+        logger.info('%s: %d', name, count)
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
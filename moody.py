@@ -8,11 +8,15 @@ http://www.crayonroom.com/moody.php
 import getopt
 import logging
 import re
+import StringIO
 import sys
 
 import simplejson
 
+import profiling
 import pytunes
+import rewrite
+import serverclient
 
 LOG_FORMAT = '%(message)s'
 MOODY_PATTERN = re.compile(r'Moody([A-D][1-4])')
@@ -25,6 +29,19 @@ class Usage(Exception):
     [-h|--help]   This screen.
     [-e|--export] Print the Moody tags as JSON to STDOUT.
     [-d|--diff]   Loads the Moody tags as JSON from STDIN and prints out differences.
+    [-l|--library PATH] The iTunes library XML. Defaults to the user's.
+    [-s|--stream] Export and diff the tags as JSON Lines, one track per line,
+                  keyed by persistent ID. The diff reads the tags line by
+                  line and prints the differences as it finds them.
+    [-w|--write PATH] With --diff, also write a copy of the library XML to
+                  PATH with the Moody tags from STDIN restored, to import
+                  into iTunes.
+    [--server ADDRESS] Ask the library server at ADDRESS (e.g.
+                  localhost:8752) instead of loading the library, if it is
+                  running. The diff then reads all of STDIN first. Not used
+                  with --write.
+    [-p|--profile PATH] Write a profile of the run to PATH, as collapsed
+                  stacks if it ends with .folded, as JSON otherwise.
     """
     def __init__(self, msg=''):
         self.msg = msg
@@ -36,28 +53,53 @@ class Usage(Exception):
 def _parse_args(argv):
     export = False
     diff = False
+    library_path = None
+    stream = False
+    write_path = None
+    server_address = None
+    profile_path = None
     
-    options = 'hed'
-    options_long = ['help', 'export=', 'diff=']
+    options = 'hedl:sw:p:'
+    options_long = [
+            'help', 'export', 'diff', 'library=', 'stream', 'write=',
+            'server=', 'profile=']
     try:
         opts, args = getopt.getopt(argv[1:], options, options_long)
     except getopt.error, msg:
         raise Usage(msg)
     for opt, arg in opts:
         if opt in ('-h', '--help'):
-            print Usage()
-            return 0
+            raise Usage()
         if opt in ('-e', '--export'):
             export = True
         if opt in ('-d', '--diff'):
             diff = True
+        if opt in ('-l', '--library'):
+            library_path = arg
+        if opt in ('-s', '--stream'):
+            stream = True
+        if opt in ('-w', '--write'):
+            write_path = arg
+        if opt == '--server':
+            server_address = arg
+        if opt in ('-p', '--profile'):
+            profile_path = arg
 
     if not export and not diff:
         raise Usage('Must specify an operation.')
     if export and diff:
         raise Usage('Cannot do export and diff at the same time.')
+    if write_path and not diff:
+        raise Usage('Can only write the library with a diff.')
     
-    return export, diff
+    if server_address:
+        try:
+            serverclient.parse_address(server_address)
+        except ValueError, e:
+            raise Usage(e)
+    
+    return (export, diff, library_path, stream, write_path, server_address,
+            profile_path)
 
 
 def _get_mood(track):
@@ -97,14 +139,167 @@ def diff_moody_tags(tracks, tags):
 	return differing_tracks
 
 
-def print_diff(differing_tracks):
-	print 'Mood differences:'
+def iter_moody_records(tracks):
+	"""Yields a JSON Lines record per track with a Moody tag.
+
+	@type tracks: iterable(Track)
+	@rtype: generator(dict)
+	"""
+	for track in tracks:
+		mood = _get_mood(track)
+		if mood:
+			yield {
+				'persistent_id': track.persistent_id,
+				'artist': track.artist,
+				'name': track.name,
+				'mood': mood,
+			}
+
+
+def read_moody_records(lines):
+	"""Parses JSON Lines records one at a time. Blank lines are skipped.
+
+	@type lines: iterable(str)
+	@rtype: generator(dict)
+	@raise ValueError: If a line isn't a valid record.
+	"""
+	for line_number, line in enumerate(lines, 1):
+		if not line.strip():
+			continue
+		try:
+			record = simplejson.loads(line)
+		except ValueError, e:
+			raise ValueError('Line %d: %s' % (line_number, e))
+		if not isinstance(record, dict) or 'mood' not in record:
+			raise ValueError('Line %d: Not a Moody record.' % line_number)
+		yield record
+
+
+def diff_moody_records(tracks, records):
+	"""Yields the tracks whose Moody tag differs from the records.
+
+	Records are matched to tracks by persistent ID. Records without one, or
+	with one that isn't in the library (e.g. from another library), are
+	matched by artist and name, to all tracks with them.
+
+	Only the tracks are indexed, the records are consumed one at a time.
+
+	@type tracks: iterable(Track)
+	@param records: The records, as read by read_moody_records.
+	@type records: iterable(dict)
+	@return: Yields a dict with the track and the mood of the record, like
+			diff_moody_tags.
+	@rtype: generator(dict)
+	"""
+	tracks_by_persistent_id = {}
+	tracks_by_name = {}
+	for track in tracks:
+		if track.persistent_id:
+			tracks_by_persistent_id[track.persistent_id] = track
+		tracks_by_name.setdefault((track.artist, track.name), []).append(track)
+
+	for record in records:
+		track = tracks_by_persistent_id.get(record.get('persistent_id'))
+		if track:
+			matching_tracks = [track]
+		else:
+			matching_tracks = tracks_by_name.get(
+					(record.get('artist'), record.get('name')), [])
+		mood = record['mood']
+		for track in matching_tracks:
+			if mood != _get_mood(track):
+				yield {'track': track, 'mood': mood}
+
+
+def print_diff(differing_tracks, out=None):
+	out = out or sys.stdout
+	print >>out, 'Mood differences:'
 	sorted_differing_tracks = sorted(differing_tracks, key=lambda d: d['track'].artist)
 	for diff in sorted_differing_tracks:
-		track, mood = diff['track'], diff['mood']
-		lib_mood = _get_mood(track)
-		print '%s - %s: In library: %s. From input: %s.' % (
-				track.artist, track.name, lib_mood, mood)
+		_print_difference(diff, out)
+
+
+def _print_difference(diff, out=None):
+	out = out or sys.stdout
+	track, mood = diff['track'], diff['mood']
+	lib_mood = _get_mood(track)
+	print >>out, (u'%s - %s: In library: %s. From input: %s.' % (
+			track.artist, track.name, lib_mood, mood)).encode('utf-8')
+
+
+def patch_moods(differences):
+	"""Builds a library patch that sets the Moody tags of the differing tracks
+	to the ones from the input. Moody tags are kept at the start of the
+	composer.
+
+	@param differences: As returned by diff_moody_tags.
+	@type differences: [dict]
+	@rtype: rewrite.LibraryPatch
+	"""
+	patch = rewrite.LibraryPatch()
+	for diff in differences:
+		_patch_mood(patch, diff)
+	return patch
+
+
+def _patch_mood(patch, diff):
+	track, tag = diff['track'], 'Moody' + diff['mood']
+	if _get_mood(track):
+		composer = MOODY_PATTERN.sub(tag, track.composer, 1)
+	elif track.composer:
+		composer = u'%s %s' % (tag, track.composer)
+	else:
+		composer = tag
+	patch.update_track({'Composer': composer}, track.id)
+
+
+def run(tracks, export, diff, stream, input_file=None, out=None, patch=None):
+	"""Exports the Moody tags of the tracks, or diffs them with the input.
+
+	The streamed diff prints every difference as it is found and doesn't keep
+	it, unless it is added to the patch.
+
+	@type tracks: iterable(Track)
+	@param input_file: The tags to diff with, as written by the export.
+			Optional. Defaults to STDIN.
+	@type input_file: file
+	@param out: Where to write the tags or differences to. Optional.
+			Defaults to STDOUT.
+	@type out: file
+	@param patch: Gets the Moody tags from the input set on the differing
+			tracks, see patch_moods. Optional.
+	@type patch: rewrite.LibraryPatch
+	@raise ValueError: If the input isn't valid.
+	"""
+	input_file = input_file or sys.stdin
+	out = out or sys.stdout
+	if stream:
+		if export:
+			for record in iter_moody_records(tracks):
+				out.write(simplejson.dumps(record) + '\n')
+		if diff:
+			records = read_moody_records(iter(input_file.readline, ''))
+			print >>out, 'Mood differences:'
+			for difference in diff_moody_records(tracks, records):
+				_print_difference(difference, out)
+				out.flush()
+				if patch is not None:
+					_patch_mood(patch, difference)
+	else:
+		logger.info('Loading all tracks...')
+		all_tracks = list(tracks)
+
+		if export:
+			tags = get_moody_tags(all_tracks)
+			print >>out, simplejson.dumps(tags)
+
+		if diff:
+			tags = simplejson.loads(input_file.read())
+			differences = diff_moody_tags(all_tracks, tags)
+			print_diff(differences, out)
+			if patch is not None:
+				for difference in differences:
+					_patch_mood(patch, difference)
 
 
 def main(argv=None):
@@ -112,24 +307,53 @@ def main(argv=None):
         argv = sys.argv
 
     try:
-        export, diff = _parse_args(argv)
+        (export, diff, library_path, stream, write_path, server_address,
+                profile_path) = _parse_args(argv)
     except Usage, err:
         print >>sys.stderr, err
         return 2
-    
-    logger.info('Opening iTunes library...')
-    lib = pytunes.Library()
-    logger.info('Loading all tracks...')
-    all_tracks = list(lib.tracks)
-    
-    if export:
-    	tags = get_moody_tags(all_tracks)
-    	print simplejson.dumps(tags)
-    
-    if diff:
-    	tags = simplejson.loads(sys.stdin.read())
-    	differing_tracks = diff_moody_tags(all_tracks, tags)
-    	print_diff(differing_tracks)
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    output = None
+    input_file = sys.stdin
+    if server_address and not write_path:
+        body = sys.stdin.read() if diff else None
+        try:
+            output = serverclient.query(
+                    server_address, '/moody', library_path, body,
+                    export=int(export), diff=int(diff), stream=int(stream))
+        except serverclient.ServerError, e:
+            logger.error(e)
+            return 1
+        if output is None and diff:
+            input_file = StringIO.StringIO(body)
+
+    if output is not None:
+        sys.stdout.write(output)
+    else:
+        logger.info('Opening iTunes library...')
+        lib = pytunes.Library(library_path)
+        patch = rewrite.LibraryPatch() if write_path else None
+        try:
+            run(lib.tracks, export, diff, stream, input_file, patch=patch)
+        except ValueError, e:
+            logger.error('Invalid input: %s', e)
+            return 1
+        if write_path:
+            logger.info('Writing the library to %s...', write_path)
+            try:
+                rewrite.rewrite_library(lib.path, write_path, patch)
+            except (IOError, OSError, ValueError), e:
+                logger.error('Cannot write the library: %s', e)
+                return 1
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+"""Lazy pipelines over the tracks of a library.
+
+A Pipeline is a source of items and a chain of stages. A stage is a function
+that takes an iterable and returns one, usually a generator, e.g.:
+
+    songs = Pipeline(lambda: lib.tracks).pipe(without_podcasts)
+    albums = list(songs.pipe(group_albums))
+    singles = songs.pipe(excluding, album_track_ids(albums))
+
+Nothing runs until a pipeline is iterated, and every iteration runs all
+stages again from the source. So the items are streamed through the stages
+one at a time and no stage output is stored, unless a stage needs all its
+input at once, like group_albums. Iterating the tracks of a loaded library
+again costs less than keeping a filtered copy of them.
+
+Stages that check membership take IdSets of Track IDs instead of sets of
+tracks.
+"""
+
+import itertools
+
+import analysis
+import idset
+import profiling
+import pytunes
+
+
+class Pipeline(object):
+    """A lazy, re-iterable chain of stages over some items."""
+
+    def __init__(self, source, stages=()):
+        """Creates a new Pipeline.
+
+        @param source: Returns a fresh iterable of the items on every call,
+                e.g. lambda: library.tracks.
+        @type source: function()
+        @param stages: The stages and their extra arguments. Optional.
+        @type stages: ((function, tuple, dict),)
+        """
+        self._source = source
+        self._stages = tuple(stages)
+
+    def pipe(self, stage, *args, **kwargs):
+        """Appends a stage.
+
+        @param stage: Called with the items from the previous stage and the
+                extra arguments.
+        @type stage: function(iterable, ...)
+        @return: A new pipeline, this one is unchanged.
+        @rtype: Pipeline
+        """
+        return Pipeline(self._source,
+                        self._stages + ((stage, args, kwargs),))
+
+    def filter(self, predicate):
+        """Appends a stage that keeps the items matching a predicate.
+
+        @rtype: Pipeline
+        """
+        return self.pipe(_keep, predicate)
+
+    def ids(self):
+        """Runs the pipeline and collects the IDs of the items.
+
+        @rtype: idset.IdSet
+        """
+        return idset.IdSet(item.id for item in self)
+
+    def __iter__(self):
+        items = self._source()
+        for stage, args, kwargs in self._stages:
+            items = stage(items, *args, **kwargs)
+        return iter(items)
+
+    def __unicode__(self):
+        return u'Pipeline(%s)' % u', '.join(
+                stage.__name__ for stage, _, _ in self._stages)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _keep(items, predicate):
+    return itertools.ifilter(predicate, items)
+
+
+def without_podcasts(tracks):
+    """Drops the podcasts.
+
+    @rtype: generator(Track)
+    """
+    for track in tracks:
+        if not track.podcast:
+            yield track
+
+
+def excluding(tracks, ids):
+    """Drops the tracks with one of the IDs.
+
+    @type ids: idset.IdSet
+    @rtype: generator(Track)
+    """
+    for track in tracks:
+        if track.id not in ids:
+            yield track
+
+
+def rated_between(tracks, low, high):
+    """Keeps the tracks rated above low and below high.
+
+    @rtype: generator(Track)
+    """
+    for track in tracks:
+        if track.rating is not None and low < track.rating < high:
+            yield track
+
+
+@profiling.profiled('pipeline.group_albums')
+def group_albums(tracks, workers=1):
+    """Groups the tracks into albums. Needs all tracks before yielding the
+    first album.
+
+    @rtype: generator(Album)
+    """
+    return pytunes.Album.group_tracks_into_albums(tracks, workers)
+
+
+def crappy_albums(albums, min_good_tracks=4, min_rating=80):
+    """Keeps the albums with only a few good tracks, see
+    analysis.find_crappy_albums.
+
+    @rtype: generator(Album)
+    """
+    return analysis.find_crappy_albums(albums, min_good_tracks, min_rating)
+
+
+def compilations(albums):
+    """Keeps the completely rated compilations.
+
+    @rtype: generator(Album)
+    """
+    for album in albums:
+        if album.rating_completeness == 1 and album.is_compilation:
+            yield album
+
+
+@profiling.profiled('pipeline.album_track_ids')
+def album_track_ids(albums):
+    """Collects the IDs of the tracks of some albums.
+
+    @rtype: idset.IdSet
+    """
+    return idset.IdSet(t.id for album in albums for t in album.tracks)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+"""Phase level profiling for pytunes and the tools built on it.
+
+Profiling is disabled by default. While disabled, phase returns a shared no-op
+context manager, count returns right away and functions decorated with
+profiled are called directly, so the hooks cost next to nothing. Code that
+runs once per track checks the enabled flag instead, to not even pay for a
+function call.
+
+Once enabled, every phase records how often it ran, its total and self time
+and the peak RSS of the process, keyed by the stack of enclosing phases. The
+report can be written as JSON or as collapsed stacks for flame graph tools
+(e.g. flamegraph.pl).
+"""
+
+import collections
+import functools
+import inspect
+import resource
+import sys
+import time
+
+import simplejson
+
+# The stack separator of collapsed stacks.
+STACK_SEPARATOR = ';'
+
+# Whether profiling is enabled. Read only, use enable and disable.
+enabled = False
+
+_profiler = None
+
+
+class Profiler(object):
+    """Records timers, counters and peak memory per phase."""
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self._start_time = time.time()
+        self._stack = []
+        self._stats_by_path = collections.OrderedDict()
+
+    def phase(self, name):
+        """@return: A context manager timing a phase, nested in the current
+                one.
+        @rtype: context manager
+        """
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def get_report(self):
+        """@return: The phases, in order of first entry, and the counters.
+        @rtype: dict
+        """
+        phases = []
+        for path, stats in self._stats_by_path.iteritems():
+            child_time = sum(
+                    s.total_time for p, s in self._stats_by_path.iteritems()
+                    if len(p) == len(path) + 1 and p[:-1] == path)
+            phases.append({
+                'name': path[-1],
+                'path': STACK_SEPARATOR.join(path),
+                'calls': stats.calls,
+                'total_time': stats.total_time,
+                'self_time': max(stats.total_time - child_time, 0.0),
+                'peak_rss_kb': stats.peak_rss_kb,
+                'rss_growth_kb': stats.rss_growth_kb,
+            })
+        return {
+            'wall_time': time.time() - self._start_time,
+            'peak_rss_kb': _get_peak_rss_kb(),
+            'phases': phases,
+            'counters': dict(self.counters),
+        }
+
+    def write(self, path):
+        """Writes the report.
+
+        @param path: Where to write the report. Written as collapsed stacks
+                (self time in microseconds) if it ends with .folded, as JSON
+                otherwise.
+        @type path: str
+        """
+        report = self.get_report()
+        with open(path, 'w') as f:
+            if path.endswith('.folded'):
+                for phase in report['phases']:
+                    f.write('%s %d\n' % (
+                            phase['path'], phase['self_time'] * 1000000))
+            else:
+                simplejson.dump(report, f, indent=2, sort_keys=True)
+
+
+class _PhaseStats(object):
+
+    __slots__ = ('calls', 'total_time', 'peak_rss_kb', 'rss_growth_kb')
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.peak_rss_kb = 0
+        self.rss_growth_kb = 0
+
+
+class _Phase(object):
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        stack = self._profiler._stack
+        stack.append(self._name)
+        self._path = tuple(stack)
+        self._rss_before = _get_peak_rss_kb()
+        self._start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.time() - self._start
+        peak_rss = _get_peak_rss_kb()
+        self._profiler._stack.pop()
+        stats_by_path = self._profiler._stats_by_path
+        stats = stats_by_path.get(self._path)
+        if stats is None:
+            stats = stats_by_path[self._path] = _PhaseStats()
+        stats.calls += 1
+        stats.total_time += elapsed
+        stats.peak_rss_kb = max(stats.peak_rss_kb, peak_rss)
+        stats.rss_growth_kb += peak_rss - self._rss_before
+        return False
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def enable():
+    """Starts profiling with a new Profiler.
+
+    @rtype: Profiler
+    """
+    global _profiler, enabled
+    _profiler = Profiler()
+    enabled = True
+    return _profiler
+
+
+def disable():
+    """Stops profiling.
+
+    @return: The Profiler that was in use, if any.
+    @rtype: Profiler
+    """
+    global _profiler, enabled
+    profiler, _profiler = _profiler, None
+    enabled = False
+    return profiler
+
+
+def phase(name):
+    """@return: A context manager timing a phase if profiling is enabled, a
+            no-op otherwise.
+    @rtype: context manager
+    """
+    if _profiler is None:
+        return _NULL_PHASE
+    return _profiler.phase(name)
+
+
+def count(name, n=1):
+    """Adds n to a counter if profiling is enabled."""
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def profiled(name):
+    """Decorates a function to run as a phase when profiling is enabled.
+
+    Generator functions are timed while they run only, not while their
+    consumer handles the yielded items.
+
+    @param name: The name of the phase.
+    @type name: str
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if _profiler is None:
+                    return function(*args, **kwargs)
+                return _profile_generator(name, function(*args, **kwargs))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if _profiler is None:
+                    return function(*args, **kwargs)
+                with _profiler.phase(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _profile_generator(name, generator):
+    while True:
+        with phase(name):
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _get_peak_rss_kb():
+    # KB on Linux, bytes on Mac OS X.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return peak_rss
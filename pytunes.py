@@ -2,32 +2,101 @@
 
 """A pythonic interface to the iTunes library."""
 
+import array
+import bisect
+import contextlib
 import getpass
+import itertools
+import logging
+import mmap
+import multiprocessing
+import operator
 import os.path
 import plistlib
+import re
+import sqlite3
 import urllib2
+import xml.etree.cElementTree as ElementTree
+
+import profiling
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+# The track fields Library keeps secondary indexes for.
+INDEXED_FIELDS = (
+        'persistent_id', 'artist', 'album_artist', 'album', 'genre', 'year',
+        'kind')
+
+# The operators of Library.query. The range operators never match missing
+# values.
+QUERY_OPERATORS = {
+    'exact': operator.eq,
+    'in': lambda value, values: value in values,
+    'gt': lambda value, low: value is not None and value > low,
+    'gte': lambda value, low: value is not None and value >= low,
+    'lt': lambda value, high: value is not None and value < high,
+    'lte': lambda value, high: value is not None and value <= high,
+    'between': lambda value, bounds: (
+            value is not None and bounds[0] <= value <= bounds[1]),
+}
 
 
 class Library(object):
     """An iTunes library.
 
     The items are loaded lazily and/or cached where possible.
+
+    The library XML is streamed section by section, so no complete copy of the
+    parsed plist is ever held in memory. Only the Track and Playlist objects
+    built from it are kept.
+
+    Unless disabled, the parsed library is also stored in an on-disk snapshot
+    (see snapshot.Snapshot), which is used instead of the XML as long as the
+    XML hasn't changed.
     """
 
+    _indexes = None
     _lib = None
+    _playlists_by_id_cache = None
     _playlists_cache = None
-    _tracks_by_id_cache = {}
+    _sorted_index_keys = None
+    _source_stat = None
+    _track_keys = None
+    _tracks_by_id_cache = None
+    _tracks_complete = False
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, use_snapshot=True, snapshot_dir=None,
+                 workers=1):
         """Creates a new Library.
 
         @param path: The path to the iTunes library. Optional. Defaults to
                 /Users/$USER/Music/iTunes/iTunes Music Library.xml.
         @type path: str
+        @param use_snapshot: Whether to load the library from (and store it
+                in) an on-disk snapshot. Optional. Defaults to True.
+        @type use_snapshot: bool
+        @param snapshot_dir: The directory to keep the snapshots in. Optional.
+                Defaults to ~/.pytunes/snapshots.
+        @type snapshot_dir: str
+        @param workers: The number of processes parsing the tracks of the
+                XML, see PlistReader. Optional. Defaults to 1.
+        @type workers: int
         """
         self._path = path
+        self._use_snapshot = use_snapshot
+        self._snapshot_dir = snapshot_dir
+        self._workers = workers
+        self._subscribers = []
+        self._playlists_by_id_cache = {}
+        self._tracks_by_id_cache = {}
 
-    def _open(self):
+    @property
+    def path(self):
+        """The path to the library XML."""
+        return self._get_path()
+
+    def _get_path(self):
         path = self._path
         # TODO: Add path auto-detection for other OSes.
         if path is None:
@@ -35,34 +104,364 @@ class Library(object):
             path = '/Users/%s/Music/iTunes/iTunes Music Library.xml' % user
             if not os.path.exists(path):
                 path = '/Users/%s/Music/iTunes/iTunes Library.xml' % user
-        self._lib = plistlib.readPlist(path)
+        return path
+
+    @profiling.profiled('library.open')
+    def _open(self):
+        path = self._open_xml()
+        if not self._use_snapshot:
+            return
+        library_snapshot = snapshot.Snapshot(path, self._snapshot_dir)
+        try:
+            if not library_snapshot.is_current():
+                logger.info('Building library snapshot...')
+                with profiling.phase('library.build_snapshot'):
+                    library_snapshot.build(self._lib)
+        except (IOError, OSError, sqlite3.Error), e:
+            logger.warning('Not using the library snapshot: %s', e)
+        else:
+            self._lib = library_snapshot
+
+    def _open_xml(self):
+        """Reads the XML itself from now on.
+
+        @return: The path to the XML.
+        @rtype: str
+        """
+        path = self._get_path()
+        self._source_stat = _get_stat(path)
+        self._lib = PlistReader(path, self._workers)
+        return path
 
     def _ensure_opened(self):
         if self._lib is None:
             self._open()
 
+    def invalidate_snapshot(self):
+        """Deletes the on-disk snapshot of this library.
+
+        The snapshot is rebuilt from the XML the next time the library is
+        opened.
+        """
+        snapshot.Snapshot(self._get_path(), self._snapshot_dir).invalidate()
+
     @property
     def playlists(self):
         self._ensure_opened()
         if self._playlists_cache is None:
-            self._playlists_cache = []
-            tracks_by_id = {}
-            for track in self.tracks:
-                tracks_by_id[track.id] = track
-            for playlist_item in self._lib['Playlists']:
-                playlist = Playlist.from_plist_item(playlist_item, tracks_by_id)
-                self._playlists_cache.append(playlist)
+            with profiling.phase('library.playlists'):
+                playlists = []
+                for item in self._lib.iter_playlists():
+                    playlists.append(self._get_playlist_from_item(item))
+            self._playlists_cache = playlists
         return self._playlists_cache
 
+    def playlist(self, name=None, id=None):
+        """Gets a single playlist by name or ID.
+
+        Only the requested playlist is built. Its tracks are loaded when its
+        items are first accessed, and from a snapshot only those tracks are
+        loaded.
+
+        @param name: The name of the playlist. If several playlists have the
+                name, the first one is returned.
+        @type name: unicode
+        @param id: The Playlist ID of the playlist.
+        @type id: int
+        @return: The playlist, or None if there is no such playlist.
+        @rtype: Playlist
+        """
+        if (name is None) == (id is None):
+            raise ValueError('Pass either a name or an ID.')
+        self._ensure_opened()
+        if self._playlists_cache is not None:
+            for playlist in self._playlists_cache:
+                if (playlist.id == id if name is None
+                    else playlist.name == name):
+                    return playlist
+            return None
+        if id is not None and id in self._playlists_by_id_cache:
+            return self._playlists_by_id_cache[id]
+        with profiling.phase('library.playlist'):
+            item = self._lib.get_playlist(name=name, playlist_id=id)
+            if item is None:
+                return None
+            return self._get_playlist_from_item(item)
+
+    def _get_playlist_from_item(self, item):
+        """Builds a playlist, reusing the one already built for its ID."""
+        playlist_id = item.get('Playlist ID')
+        playlist = self._playlists_by_id_cache.get(playlist_id)
+        if playlist is None:
+            playlist = Playlist.from_plist_item(item, self)
+            self._playlists_by_id_cache[playlist_id] = playlist
+        return playlist
+
+    def _get_tracks_by_ids(self, track_ids, tracks_by_key=None):
+        """Looks up tracks by their Track IDs in the track cache.
+
+        Missing tracks are loaded first: just those from a snapshot, all
+        tracks from the XML.
+
+        @param tracks_by_key: The track cache to look up. Optional. Defaults
+                to the current one.
+        @type tracks_by_key: {str: Track}
+        @rtype: [Track]
+        """
+        self._ensure_opened()
+        if tracks_by_key is None:
+            tracks_by_key = self._tracks_by_id_cache
+        keys = [str(track_id) for track_id in track_ids]
+        if not self._tracks_complete:
+            missing_keys = [k for k in keys if k not in tracks_by_key]
+            if missing_keys and isinstance(self._lib, snapshot.Snapshot):
+                for key, item in self._lib.get_tracks(missing_keys):
+                    tracks_by_key[key] = Track.from_plist_item(item)
+            elif missing_keys:
+                for _ in self.tracks:
+                    pass
+        return [tracks_by_key[k] for k in keys]
+
     @property
+    @profiling.profiled('library.tracks')
     def tracks(self):
         self._ensure_opened()
-        for track_id, track_item in self._lib['Tracks'].iteritems():
-            track = self._tracks_by_id_cache.get(track_id)
-            if not track:
-                track = Track.from_plist_item(track_item)
-                self._tracks_by_id_cache[track_id] = track
-            yield track
+        if self._tracks_complete:
+            profiling.count(
+                    'library.tracks_by_id_cache.hits',
+                    len(self._tracks_by_id_cache))
+            # In the order of the XML, like the first pass.
+            tracks_by_key = self._tracks_by_id_cache
+            for key in self._track_keys:
+                yield tracks_by_key[key]
+            return
+        from_plist_item = Track.from_plist_item
+        if profiling.enabled:
+            from_plist_item = profiling.profiled('track.from_plist_item')(
+                    from_plist_item)
+        hits = 0
+        misses = 0
+        keys = []
+        try:
+            for track_id, track_item in self._lib.iter_tracks():
+                keys.append(track_id)
+                track = self._tracks_by_id_cache.get(track_id)
+                if track:
+                    hits += 1
+                else:
+                    misses += 1
+                    track = from_plist_item(track_item)
+                    self._tracks_by_id_cache[track_id] = track
+                yield track
+            self._track_keys = keys
+            self._tracks_complete = True
+        finally:
+            profiling.count('library.tracks_by_id_cache.hits', hits)
+            profiling.count('library.tracks_by_id_cache.misses', misses)
+            profiling.count('library.tracks_parsed', misses)
+
+    def subscribe(self, callback):
+        """Registers a callback for the changes found by Library.refresh.
+
+        @param callback: Called with the ChangeSet whenever refresh finds some
+                changes.
+        @type callback: function(ChangeSet)
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Unregisters a callback registered with Library.subscribe."""
+        self._subscribers.remove(callback)
+
+    @profiling.profiled('library.refresh')
+    def refresh(self):
+        """Brings the loaded tracks and playlists up to date with the XML.
+
+        Tracks and playlists are matched by their Persistent ID. Existing
+        Track and Playlist objects are updated in place, so references to them
+        (e.g. from albums) stay valid. A track counts as modified when its
+        Date Modified or any of its other fields changed, since iTunes doesn't
+        touch Date Modified for play counts, play dates or ratings.
+
+        Tracks that were never loaded aren't reported as added. Playlists are
+        only refreshed if all of them were loaded, single playlists got with
+        Library.playlist are got again instead.
+
+        Nothing is read if the size and modification time of the XML haven't
+        changed since it was last opened. Otherwise the XML is read once, and
+        the snapshot isn't touched: it no longer matches the XML, so it is
+        rebuilt the next time a Library is opened from it.
+
+        @return: The changes relative to the previously loaded state. Also
+                passed to all subscribers if not empty.
+        @rtype: ChangeSet
+        """
+        changes = ChangeSet()
+        if self._lib is None:
+            # Nothing loaded yet, so nothing can be outdated.
+            return changes
+        if _get_stat(self._get_path()) == self._source_stat:
+            return changes
+        self._open_xml()
+        old_tracks_by_key = self._tracks_by_id_cache
+        self._refresh_tracks(changes)
+        if self._playlists_cache is not None:
+            self._refresh_playlists(changes, old_tracks_by_key)
+        else:
+            # Playlists got individually are outdated as well.
+            self._playlists_by_id_cache = {}
+        if changes:
+            self._indexes = None
+            self._sorted_index_keys = None
+            for callback in list(self._subscribers):
+                callback(changes)
+        return changes
+
+    def _refresh_tracks(self, changes):
+        old_tracks = {}
+        for track_id, track in self._tracks_by_id_cache.iteritems():
+            old_tracks[track.persistent_id or track_id] = track
+        # Without all old tracks, a track missing from them may just not
+        # have been loaded.
+        knows_all_tracks = self._tracks_complete
+        tracks_by_id = {}
+        keys = []
+        for track_id, track_item in self._lib.iter_tracks():
+            keys.append(track_id)
+            new_track = Track.from_plist_item(track_item)
+            track = old_tracks.pop(new_track.persistent_id or track_id, None)
+            if track is None:
+                track = new_track
+                if knows_all_tracks:
+                    changes.added_tracks.append(track)
+            elif track._differs_from(new_track):
+                track._update_from(new_track)
+                changes.modified_tracks.append(track)
+            tracks_by_id[track_id] = track
+        changes.removed_tracks.extend(old_tracks.itervalues())
+        self._tracks_by_id_cache = tracks_by_id
+        self._track_keys = keys
+        self._tracks_complete = True
+
+    def _refresh_playlists(self, changes, old_tracks_by_key):
+        old_playlists = {}
+        for playlist in self._playlists_cache:
+            old_playlists[playlist.persistent_id or playlist.id] = playlist
+        playlists = []
+        playlists_by_id = {}
+        for playlist_item in self._lib.iter_playlists():
+            new_playlist = Playlist.from_plist_item(playlist_item, self)
+            playlist = old_playlists.pop(
+                    new_playlist.persistent_id or new_playlist.id, None)
+            if playlist is None:
+                playlist = new_playlist
+                changes.added_playlists.append(playlist)
+            else:
+                if (playlist._differs_from(new_playlist) or
+                    _items_differ(playlist, new_playlist, old_tracks_by_key)):
+                    changes.modified_playlists.append(playlist)
+                playlist._update_from(new_playlist)
+            playlists.append(playlist)
+            playlists_by_id[playlist.id] = playlist
+        changes.removed_playlists.extend(old_playlists.itervalues())
+        self._playlists_cache = playlists
+        self._playlists_by_id_cache = playlists_by_id
+
+    @profiling.profiled('library.query')
+    def query(self, **criteria):
+        """Finds the tracks matching some criteria.
+
+        Each criterion is a track field, optionally followed by two underscores
+        and one of the QUERY_OPERATORS: exact (the default), in, gt, gte, lt,
+        lte or between (inclusive, takes a (low, high) tuple). E.g.:
+
+            lib.query(artist='Tool', rating__gte=80, year__between=(1990, 1999))
+
+        Criteria on the INDEXED_FIELDS are answered from lazily built secondary
+        indexes. The most selective of them, judged by the sizes of the index
+        buckets it hits, yields the candidate tracks. The other indexed
+        criteria are intersected with those by probing each candidate, which
+        costs no more than the candidates themselves. Criteria on other
+        fields are checked the same way, or by scanning all tracks if no
+        indexed field is queried.
+
+        @return: The matching tracks.
+        @rtype: [Track]
+        """
+        indexed_criteria = []
+        other_criteria = []
+        for criterion, value in criteria.iteritems():
+            field, _, operator_name = criterion.partition('__')
+            operator_name = operator_name or 'exact'
+            if field.startswith('_') or not hasattr(Track, field):
+                raise ValueError('Unknown track field: %s' % field)
+            if operator_name not in QUERY_OPERATORS:
+                raise ValueError('Unknown operator: %s' % operator_name)
+            if field in INDEXED_FIELDS:
+                buckets = self._lookup(field, operator_name, value)
+                size = sum(len(b) for b in buckets)
+                indexed_criteria.append((size, buckets, field, operator_name,
+                                         value))
+            else:
+                other_criteria.append((field, operator_name, value))
+
+        if indexed_criteria:
+            indexed_criteria.sort(key=operator.itemgetter(0))
+            buckets = indexed_criteria[0][1]
+            tracks = [t for bucket in buckets for t in bucket]
+            other_criteria.extend(c[2:] for c in indexed_criteria[1:])
+        else:
+            tracks = self.tracks
+
+        checks = [(field, QUERY_OPERATORS[operator_name], value)
+                  for field, operator_name, value in other_criteria]
+        return [t for t in tracks
+                if all(match(getattr(t, field), value)
+                       for field, match, value in checks)]
+
+    def _lookup(self, field, operator_name, value):
+        """Returns the index buckets matching a criterion."""
+        index = self._get_index(field)
+        if operator_name == 'exact':
+            return [index.get(value, [])]
+        if operator_name == 'in':
+            return [index.get(v, []) for v in set(value)]
+        keys = self._get_sorted_index_keys(field)
+        low, high = 0, len(keys)
+        if operator_name == 'gt':
+            low = bisect.bisect_right(keys, value)
+        elif operator_name == 'gte':
+            low = bisect.bisect_left(keys, value)
+        elif operator_name == 'lt':
+            high = bisect.bisect_left(keys, value)
+        elif operator_name == 'lte':
+            high = bisect.bisect_right(keys, value)
+        elif operator_name == 'between':
+            low = bisect.bisect_left(keys, value[0])
+            high = bisect.bisect_right(keys, value[1])
+        return [index[k] for k in keys[low:high]]
+
+    def _get_index(self, field):
+        if self._indexes is None:
+            self._indexes = {}
+        index = self._indexes.get(field)
+        if index is None:
+            with profiling.phase('library.build_index'):
+                index = {}
+                for track in self.tracks:
+                    index.setdefault(getattr(track, field), []).append(track)
+            self._indexes[field] = index
+        return index
+
+    def _get_sorted_index_keys(self, field):
+        if self._sorted_index_keys is None:
+            self._sorted_index_keys = {}
+        keys = self._sorted_index_keys.get(field)
+        if keys is None:
+            # Missing values never match a range.
+            keys = sorted(k for k in self._get_index(field) if k is not None)
+            self._sorted_index_keys[field] = keys
+        return keys
 
     def __unicode__(self):
         return 'Library(%s)' % self._path
@@ -71,6 +470,241 @@ class Library(object):
         return unicode(self).encode('utf-8')
 
 
+class PlistReader(object):
+    """Streams the Tracks and Playlists sections of an iTunes library XML.
+
+    The file is walked event by event. Only the entry that is currently being
+    read (one track dict or one playlist dict) is held in memory, everything
+    else is discarded as soon as it has been parsed.
+
+    With more than one worker, the Tracks section is parsed in a process
+    pool instead: the file is memory-mapped, the section is split into byte
+    ranges at track boundaries, and each range is parsed by a worker. The
+    workers send back compact records (the keys of a range once, then a
+    tuple of values per track), which are turned back into the same plist
+    dicts, in the same order, as the serial parse.
+    """
+
+    def __init__(self, path, workers=1):
+        """Creates a new PlistReader.
+
+        @param path: The path to the iTunes library XML.
+        @type path: str
+        @param workers: The number of processes parsing the tracks. Optional.
+                Defaults to 1, which parses in this process.
+        @type workers: int
+        """
+        self.path = path
+        self.workers = workers
+
+    def iter_tracks(self):
+        """Reads the tracks of the library.
+
+        @return: Yields the track keys and their plist dicts.
+        @rtype: generator((str, dict))
+        """
+        if self.workers > 1:
+            ranges = _find_track_ranges(self.path, self.workers)
+            if ranges is not None:
+                return self._iter_tracks_parallel(ranges)
+            logger.warning('Unexpected library layout, parsing serially.')
+        return self._iter_section('Tracks')
+
+    @profiling.profiled('plist.parse_parallel')
+    def _iter_tracks_parallel(self, ranges):
+        tasks = [(self.path, start, end) for start, end in ranges]
+        if len(tasks) < 2:
+            # Not worth starting processes for.
+            results = itertools.imap(_parse_track_range, tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            results = pool.imap(_parse_track_range, tasks)
+        try:
+            for keys, records in results:
+                for track_key, values in records:
+                    yield track_key, dict(
+                            (k, v) for k, v in zip(keys, values)
+                            if v is not None)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def iter_playlists(self):
+        """Reads the playlists of the library.
+
+        @return: Yields the plist dicts of the playlists.
+        @rtype: generator(dict)
+        """
+        for _, playlist_item in self._iter_section('Playlists'):
+            yield playlist_item
+
+    def get_playlist(self, name=None, playlist_id=None):
+        """Reads the first playlist with a name or ID.
+
+        Stops reading as soon as the playlist is found.
+
+        @return: The plist dict of the playlist, or None if there is no such
+                playlist.
+        @rtype: dict
+        """
+        if playlist_id is not None:
+            key, value = 'Playlist ID', playlist_id
+        else:
+            key, value = 'Name', name
+        for playlist_item in self.iter_playlists():
+            if playlist_item.get(key) == value:
+                return playlist_item
+        return None
+
+    @profiling.profiled('plist.parse')
+    def _iter_section(self, section):
+        with open(self.path, 'rb') as f:
+            # Depth 1 is <plist>, 2 the top-level <dict>, 3 its keys and
+            # values and 4 the entries of the Tracks and Playlists sections.
+            depth = 0
+            root = None
+            container = None
+            top_key = None
+            entry_key = None
+            for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 2:
+                        root = elem
+                    elif depth == 3:
+                        container = elem
+                    continue
+                if depth == 3:
+                    if elem.tag == 'key':
+                        top_key = elem.text
+                    elif top_key == section:
+                        return
+                    root.clear()
+                elif depth == 4:
+                    if top_key == section:
+                        if elem.tag == 'key':
+                            entry_key = elem.text
+                        else:
+                            yield entry_key, _from_plist_element(elem)
+                            entry_key = None
+                    container.clear()
+                depth -= 1
+
+
+# The preferred size of the byte ranges of the parallel parse. Small enough to
+# keep the parsed tree of a range small, large enough to keep the number of
+# tasks low.
+_MAX_RANGE_SIZE = 4 << 20
+_MIN_RANGE_SIZE = 64 << 10
+_TRACKS_START = re.compile(r'<key>Tracks</key>\s*<dict>')
+_SECTION_END = re.compile(r'\s*</dict>')
+_LAST_TRACK_END = re.compile(r'</dict>\s*</dict>')
+
+
+def _find_track_ranges(path, workers):
+    """Splits the Tracks section into byte ranges of whole track entries.
+
+    Track dicts don't contain other dicts, so every </dict> in the section
+    ends a track entry.
+
+    @return: The (start, end) offsets of the ranges, or None if the layout
+            isn't the expected one.
+    @rtype: [(int, int)]
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with contextlib.closing(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as data:
+            match = _TRACKS_START.search(data)
+            if match is None:
+                return None
+            start = match.end()
+            if _SECTION_END.match(data, start):
+                return []
+            # The end of the last track dict, right before the </dict> that
+            # closes the section.
+            match = _LAST_TRACK_END.search(data, start)
+            if match is None:
+                return None
+            end = match.start() + len('</dict>')
+            range_size = (end - start) // (workers * 4) + 1
+            range_size = max(_MIN_RANGE_SIZE,
+                             min(_MAX_RANGE_SIZE, range_size))
+            ranges = []
+            while start < end:
+                split = data.find('</dict>', min(start + range_size, end))
+                if split == -1 or split >= end:
+                    split = end
+                else:
+                    split += len('</dict>')
+                ranges.append((start, split))
+                start = split
+            return ranges
+
+
+def _parse_track_range(args):
+    """Parses a byte range of track entries in a worker process.
+
+    @return: The plist keys found in the range, and the track keys and the
+            values of those plist keys per track, None where missing.
+    @rtype: ([str], [(str, tuple)])
+    """
+    path, start, end = args
+    with open(path, 'rb') as f:
+        with contextlib.closing(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as data:
+            root = ElementTree.fromstring(
+                    '<dict>%s</dict>' % data[start:end])
+    items = []
+    key_set = set()
+    track_key = None
+    for elem in root:
+        if elem.tag == 'key':
+            track_key = elem.text
+        else:
+            item = _from_plist_element(elem)
+            key_set.update(item)
+            items.append((track_key, item))
+    keys = sorted(key_set)
+    records = [(track_key, tuple(item.get(k) for k in keys))
+               for track_key, item in items]
+    return keys, records
+
+
+def _from_plist_element(elem):
+    """Converts a parsed plist element the same way plistlib does."""
+    tag = elem.tag
+    if tag == 'dict':
+        value = {}
+        key = None
+        for child in elem:
+            if child.tag == 'key':
+                key = child.text or ''
+            else:
+                value[key] = _from_plist_element(child)
+        return value
+    elif tag == 'array':
+        return [_from_plist_element(child) for child in elem]
+    elif tag == 'string':
+        return elem.text or ''
+    elif tag == 'integer':
+        return int(elem.text)
+    elif tag == 'real':
+        return float(elem.text)
+    elif tag == 'true':
+        return True
+    elif tag == 'false':
+        return False
+    elif tag == 'date':
+        return plistlib._dateFromString(elem.text)
+    elif tag == 'data':
+        return plistlib.Data.fromBase64(elem.text or '')
+    raise ValueError('Unknown plist element: %s' % tag)
+
+
 class Playlist(object):
     """A playlist."""
 
@@ -83,38 +717,60 @@ class Playlist(object):
     smart_criteria = None
     smart_info = None
     visible = None
-    _all_tracks = {}
-    _item_ids = []
+    _item_ids = ()
+    _library = None
 
-    def __init__(self, all_tracks):
+    def __init__(self, library):
         """Creates a new playlist.
 
-        @param all_tracks: All tracks in the library, keyed by ID. Needed to
-                reference the tracks from the playlist.
-        @type all_tracks: {str, Track}
+        @param library: The library of the playlist. Its track cache is used
+                to reference the tracks from the playlist.
+        @type library: Library
         """
-        self._all_tracks = all_tracks
+        self._library = library
 
     @staticmethod
-    def from_plist_item(item, all_tracks):
-        playlist = Playlist(all_tracks)
+    def from_plist_item(item, library):
+        playlist = Playlist(library)
         playlist.all_items = item.get('All Items')
         playlist.distinguished_kind = item.get('Distinguished Kind')
         playlist.id = item.get('Playlist ID')
         playlist.master = item.get('Master')
         playlist.name = item.get('Name')
-        playlist.persistent_id = item.get('Persistent ID')
+        # iTunes writes Playlist Persistent ID. Persistent ID is what was
+        # read before, so it is still accepted.
+        playlist.persistent_id = (
+                item.get('Playlist Persistent ID') or item.get('Persistent ID'))
         playlist.smart_criteria = item.get('Smart Criteria')
         playlist.smart_info = item.get('Smart Info')
         playlist.visible = item.get('Visible')
-        items = item.get('Playlist Items', [])
-        playlist._item_ids = map(lambda i: i['Track ID'], items)
+        # A compact buffer of C longs instead of a list of int objects.
+        playlist._item_ids = array.array(
+                'l', (i['Track ID'] for i in item.get('Playlist Items', ())))
         return playlist
 
     @property
     def items(self):
-        for item_id in self._item_ids:
-            yield self._all_tracks[item_id]
+        for track in self._library._get_tracks_by_ids(self._item_ids):
+            yield track
+
+    @property
+    def item_ids(self):
+        """The track IDs of the items, as an array of C longs."""
+        return self._item_ids
+
+    def _differs_from(self, other):
+        """Compares all fields but the items."""
+        for name in _PLAYLIST_FIELDS:
+            if getattr(self, name) != getattr(other, name):
+                return True
+        return False
+
+    def _update_from(self, other):
+        for name in _PLAYLIST_FIELDS:
+            setattr(self, name, getattr(other, name))
+        self._library = other._library
+        self._item_ids = other._item_ids
 
     def __unicode__(self):
         return 'Playlist(id=%s)' % self.id
@@ -123,77 +779,127 @@ class Playlist(object):
         return unicode(self).encode('utf-8')
 
 
+_PLAYLIST_FIELDS = (
+        'all_items', 'distinguished_kind', 'id', 'master', 'name',
+        'persistent_id', 'smart_criteria', 'smart_info', 'visible')
+
+
 class Track(object):
-    """A track."""
-
-    album = None
-    album_artist = None
-    album_rating = None
-    album_rating_computed = None
-    artist = None
-    artwork_count = None
-    bit_rate = None
-    composer = None
-    date_added = None
-    date_modified = None
-    file_folder_count = None
-    genre = None
-    id = None
-    kind = None
-    library_folder_count = None
-    location = None
-    name = None
-    number = None
-    persistent_id = None
-    play_count = None
-    play_date = None
-    play_date_utc = None
-    podcast = None
-    rating = None
-    sample_rate = None
-    size = None
-    skip_count = None
-    total_time = None
-    type = None
-    year = None
+    """A track.
+
+    Tracks are kept compact: they have no __dict__, the strings that repeat a
+    lot across tracks (artist, album, genre, ...) are interned, so there is
+    only one copy per distinct value, and the location is only URL-decoded
+    when it is first accessed.
+    """
+
+    __slots__ = (
+            'album',
+            'album_artist',
+            'album_rating',
+            'album_rating_computed',
+            'artist',
+            'artwork_count',
+            'bit_rate',
+            'composer',
+            'date_added',
+            'date_modified',
+            'file_folder_count',
+            'genre',
+            'id',
+            'kind',
+            'library_folder_count',
+            'name',
+            'number',
+            'persistent_id',
+            'play_count',
+            'play_date',
+            'play_date_utc',
+            'podcast',
+            'rating',
+            'sample_rate',
+            'size',
+            'skip_count',
+            'total_time',
+            'type',
+            'year',
+            '_location',
+            '_location_url',
+    )
+
+    def __init__(self):
+        for name in Track.__slots__:
+            setattr(self, name, None)
+
+    @property
+    def location(self):
+        if self._location is None and self._location_url is not None:
+            self._location = _decode_location(self._location_url)
+        return self._location
+
+    @location.setter
+    def location(self, location):
+        self._location = location
+        self._location_url = None
+
+    @property
+    def path(self):
+        """The file system path of the track, if it is a local file."""
+        return _location_to_path(self.location)
 
     @staticmethod
     def from_plist_item(item):
-        track = Track()
-        track.album = item.get('Album')
-        track.album_artist = item.get('Album Artist')
-        track.album_rating = item.get('Album Rating')
-        track.album_rating_computed = item.get('Album Rating Computed')
-        track.artist = item.get('Artist')
-        track.artwork_count = item.get('Artwork Count')
-        track.bit_rate = item.get('Bit Rate')
-        track.composer = item.get('Composer')
-        track.date_added = item.get('Date Added')
-        track.date_modified = item.get('Date Modified')
-        track.file_folder_count = item.get('File Folder Count')
-        track.genre = item.get('Genre')
-        track.id = item.get('Track ID')
-        track.kind = item.get('Kind')
-        track.library_folder_count = item.get('Library Folder Count')
-        track.location = item.get('Location')
-        if track.location:
-            track.location = urllib2.unquote(track.location).decode('utf-8')
-        track.name = item.get('Name')
-        track.number = item.get('Track Number')
-        track.persistent_id = item.get('Persistent ID')
-        track.play_count = item.get('Play Count')
-        track.play_date = item.get('Play Date')
-        track.play_date_utc = item.get('Play Date UTC')
-        track.podcast = item.get('Podcast')
-        track.rating = item.get('Rating')
-        track.sample_rate = item.get('Sample Rate')
-        track.size = item.get('Size')
-        track.skip_count = item.get('Skip Count')
-        track.total_time = item.get('Total Time')
-        track.type = item.get('Track Type')
-        track.year = item.get('Year')
+        get = item.get
+        track = Track.__new__(Track)
+        track.album = _intern(get('Album'))
+        track.album_artist = _intern(get('Album Artist'))
+        track.album_rating = get('Album Rating')
+        track.album_rating_computed = get('Album Rating Computed')
+        track.artist = _intern(get('Artist'))
+        track.artwork_count = get('Artwork Count')
+        track.bit_rate = get('Bit Rate')
+        track.composer = _intern(get('Composer'))
+        track.date_added = get('Date Added')
+        track.date_modified = get('Date Modified')
+        track.file_folder_count = get('File Folder Count')
+        track.genre = _intern(get('Genre'))
+        track.id = get('Track ID')
+        track.kind = _intern(get('Kind'))
+        track.library_folder_count = get('Library Folder Count')
+        # Decoded lazily, see Track.location.
+        track._location = None
+        track._location_url = get('Location')
+        track.name = get('Name')
+        track.number = get('Track Number')
+        track.persistent_id = get('Persistent ID')
+        track.play_count = get('Play Count')
+        track.play_date = get('Play Date')
+        track.play_date_utc = get('Play Date UTC')
+        track.podcast = get('Podcast')
+        track.rating = get('Rating')
+        track.sample_rate = get('Sample Rate')
+        track.size = get('Size')
+        track.skip_count = get('Skip Count')
+        track.total_time = get('Total Time')
+        track.type = _intern(get('Track Type'))
+        track.year = get('Year')
         return track
 
+    def _differs_from(self, other):
+        # Date Modified first, it changes whenever the file does.
+        if self.date_modified != other.date_modified:
+            return True
+        for name in Track.__slots__:
+            # The decoded location is a cache, the raw one is compared.
+            if name == '_location':
+                continue
+            if getattr(self, name) != getattr(other, name):
+                return True
+        return False
+
+    def _update_from(self, other):
+        for name in Track.__slots__:
+            setattr(self, name, getattr(other, name))
 
     def __unicode__(self):
         return '''Track(id='%s', artist='%s', name='%s')''' % (
@@ -203,6 +909,156 @@ class Track(object):
         return unicode(self).encode('utf-8')
 
 
+class ChangeSet(object):
+    """The changes found by Library.refresh."""
+
+    def __init__(self):
+        self.added_tracks = []
+        self.removed_tracks = []
+        self.modified_tracks = []
+        self.added_playlists = []
+        self.removed_playlists = []
+        self.modified_playlists = []
+
+    def __nonzero__(self):
+        return bool(
+                self.added_tracks or self.removed_tracks or
+                self.modified_tracks or self.added_playlists or
+                self.removed_playlists or self.modified_playlists)
+
+    def __unicode__(self):
+        return ('ChangeSet(tracks: +%d -%d ~%d, playlists: +%d -%d ~%d)' % (
+                len(self.added_tracks), len(self.removed_tracks),
+                len(self.modified_tracks), len(self.added_playlists),
+                len(self.removed_playlists), len(self.modified_playlists)))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _items_differ(playlist, new_playlist, old_tracks_by_key):
+    """Compares the items of an outdated playlist with the current ones."""
+    old_keys = [str(track_id) for track_id in playlist._item_ids]
+    if all(key in old_tracks_by_key for key in old_keys):
+        # Track IDs aren't stable across exports, so compare the tracks
+        # themselves.
+        old_items = [old_tracks_by_key[key] for key in old_keys]
+        return old_items != list(new_playlist.items)
+    # Not all of the old tracks were loaded, so only the IDs are left.
+    return playlist._item_ids != new_playlist._item_ids
+
+
+def _get_stat(path):
+    """Returns the size and modification time of a file, if it exists."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def _decode_location(url):
+    if url:
+        if profiling.enabled:
+            with profiling.phase('track.decode_location'):
+                return urllib2.unquote(url).decode('utf-8')
+        return urllib2.unquote(url).decode('utf-8')
+    return url
+
+
+def _location_to_path(location):
+    if not location or not location.startswith('file://'):
+        return None
+    path = location.replace('file://', '', 1)
+    # Older versions of iTunes write file://localhost/path.
+    if path.startswith('localhost/'):
+        path = path[len('localhost'):]
+    return path
+
+
+def _get_album_artist(track):
+    """Returns the artist to group a track into an album by.
+
+    @return: The album artist, or the artist if there is none. None if the
+            track can't be part of an album.
+    @rtype: unicode
+    """
+    if track.album_artist:
+        artist = track.album_artist
+    else:
+        artist = track.artist
+    if (not artist or not track.number or not track.year or
+        not track.album):
+        return None
+    return artist
+
+
+# The shards of the _map_shards call in progress. Forked workers inherit them,
+# so only the shard numbers and results need to be sent between processes.
+_shards = None
+
+
+def _map_shards(function, shards):
+    """Calls a function on each shard in a process pool, one per shard.
+
+    @return: The results, in the order of the shards.
+    @rtype: list
+    """
+    global _shards
+    _shards = shards
+    try:
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            calls = [(function, i) for i in xrange(len(shards))]
+            return pool.map(_call_on_shard, calls)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _shards = None
+
+
+def _call_on_shard(args):
+    function, shard = args
+    return function(_shards[shard])
+
+
+def _group_album_shard(records):
+    """Groups one shard of tracks in a worker process.
+
+    @param records: The tracks' indexes, album artists, years, albums,
+            location URLs and decoded locations (if already decoded).
+    @type records: [(int, unicode, int, unicode, str, unicode)]
+    @return: The album keys and the indexes of their tracks.
+    @rtype: [((unicode, int, unicode, unicode), [int])]
+    """
+    indexes_by_key = {}
+    album_keys = []
+    for i, artist, year, album, url, location in records:
+        if location is None:
+            location = _decode_location(url)
+        location = location.replace('file://', '')
+        directory = os.path.split(location)[0]
+        album_key = (artist, year, album, directory)
+        indexes = indexes_by_key.get(album_key)
+        if indexes is None:
+            indexes = indexes_by_key[album_key] = []
+            album_keys.append(album_key)
+        indexes.append(i)
+    return [(k, indexes_by_key[k]) for k in album_keys]
+
+
+# Shared by all tracks of all libraries. Only holds the distinct values of a
+# few highly repetitive fields, so it stays small.
+_interned_strings = {}
+
+
+def _intern(value):
+    if value is None:
+        return None
+    return _interned_strings.setdefault(value, value)
+
+
 class Album(object):
     """An album.
 
@@ -212,14 +1068,22 @@ class Album(object):
     So this class is also just a collection of tracks, and all properties are
     derived from the tracks in this album.
 
-    The properties are calculated lazily and then cached.
+    The properties are backed by running aggregates (rated tracks, rating
+    sum, tracks per artist, total time and plays), which are updated in O(1)
+    as tracks are added, removed or updated. Use add_track and remove_track
+    instead of changing Album.tracks directly, and call update_track after a
+    track changed (e.g. for the modified tracks of a ChangeSet from
+    Library.refresh). Should Album.tracks be changed directly anyway, the
+    aggregates are rebuilt once the number of tracks no longer matches.
 
     You can group tracks into Albums using Album.group_tracks_into_albums.
     """
 
-    _avg_rating_cache = None
-    _is_compilation_cache = None
-    _rating_completeness_cache = None
+    # What each track added to the aggregates, to take it back out when the
+    # track is removed or updated in place. None until the aggregates are
+    # first needed.
+    _contributions = None
+    _track_count = 0
 
     def __init__(self, artist, year, album, tracks=None):
         self.artist = artist
@@ -230,36 +1094,130 @@ class Album(object):
         else:
             self.tracks = []
 
+    def add_track(self, track):
+        """Adds a track to the album.
+
+        @type track: Track
+        """
+        if self._contributions is None:
+            # Nothing to update before the aggregates are first needed.
+            self.tracks.append(track)
+            return
+        self._ensure_aggregates()
+        self.tracks.append(track)
+        self._add_contribution(track)
+
+    def remove_track(self, track):
+        """Removes a track from the album.
+
+        @type track: Track
+        @raise ValueError: If the track isn't part of the album.
+        """
+        self._ensure_aggregates()
+        self.tracks.remove(track)
+        self._apply(self._contributions.pop(track), -1)
+
+    def update_track(self, track):
+        """Updates the aggregates after a track of the album changed.
+
+        @type track: Track
+        """
+        self._ensure_aggregates()
+        self._apply(self._contributions[track], -1)
+        self._add_contribution(track)
+
     @property
     def avg_rating(self):
-        if self._avg_rating_cache is None:
-            rated_tracks = filter(lambda t: t.rating, self.tracks)
-            if len(rated_tracks):
-                self._avg_rating_cache = (
-                        float(sum(t.rating for t in rated_tracks))
-                        / len(rated_tracks))
-            else:
-                self._avg_rating_cache = 0.0
-        return self._avg_rating_cache
+        self._ensure_aggregates()
+        if not self._rated_count:
+            return 0.0
+        return float(self._rating_sum) / self._rated_count
 
     @property
     def rating_completeness(self):
-        if self._rating_completeness_cache is None:
-            # 10 means 0 stars in iTunes. We consider 0 stars as unrated.
-            rated_tracks = filter(lambda t: t.rating > 10, self.tracks)
-            self._rating_completeness_cache = \
-                    1.0 * len(rated_tracks) / len(self.tracks)
-        return self._rating_completeness_cache
+        self._ensure_aggregates()
+        if not self.tracks:
+            return 0.0
+        return 1.0 * self._fully_rated_count / len(self.tracks)
 
     @property
     def is_compilation(self):
-        if self._is_compilation_cache is None:
-            unique_artists = set(map(lambda t: t.artist, self.tracks))
-            self._is_compilation_cache = len(unique_artists) > 1
-        return self._is_compilation_cache
+        self._ensure_aggregates()
+        return len(self._artist_counts) > 1
+
+    @property
+    def total_time(self):
+        """The total time of all tracks, in milliseconds."""
+        self._ensure_aggregates()
+        return self._total_time
+
+    @property
+    def play_count(self):
+        """The plays of all tracks."""
+        self._ensure_aggregates()
+        return self._play_count
+
+    def _ensure_aggregates(self):
+        if (self._contributions is None or
+            self._track_count != len(self.tracks)):
+            self._rebuild_aggregates()
+
+    def _rebuild_aggregates(self):
+        # The same as _add_contribution for each track, in a single pass.
+        contributions = {}
+        rated_count = rating_sum = fully_rated_count = 0
+        artist_counts = {}
+        total_time = play_count = 0
+        for track in self.tracks:
+            rating = track.rating
+            contribution = contributions[track] = (
+                    rating, track.artist, track.total_time or 0,
+                    track.play_count or 0)
+            if rating:
+                rated_count += 1
+                rating_sum += rating
+                if rating > 10:
+                    fully_rated_count += 1
+            artist_counts[contribution[1]] = (
+                    artist_counts.get(contribution[1], 0) + 1)
+            total_time += contribution[2]
+            play_count += contribution[3]
+        self._contributions = contributions
+        self._track_count = len(self.tracks)
+        self._rated_count = rated_count
+        self._rating_sum = rating_sum
+        self._fully_rated_count = fully_rated_count
+        self._artist_counts = artist_counts
+        self._total_time = total_time
+        self._play_count = play_count
+
+    def _add_contribution(self, track):
+        contribution = (
+                track.rating, track.artist, track.total_time or 0,
+                track.play_count or 0)
+        self._contributions[track] = contribution
+        self._apply(contribution, 1)
+
+    def _apply(self, contribution, sign):
+        rating, artist, total_time, play_count = contribution
+        self._track_count += sign
+        if rating:
+            self._rated_count += sign
+            self._rating_sum += sign * rating
+        # 10 means 0 stars in iTunes. We consider 0 stars as unrated.
+        if rating > 10:
+            self._fully_rated_count += sign
+        artist_count = self._artist_counts.get(artist, 0) + sign
+        if artist_count:
+            self._artist_counts[artist] = artist_count
+        else:
+            del self._artist_counts[artist]
+        self._total_time += sign * total_time
+        self._play_count += sign * play_count
 
     @staticmethod
-    def group_tracks_into_albums(tracks):
+    @profiling.profiled('album.group_tracks_into_albums')
+    def group_tracks_into_albums(tracks, workers=1):
         """Groups some tracks into Albums.
 
         A track is considered part of an Album when it has a track number and
@@ -267,28 +1225,35 @@ class Album(object):
         year, album, and the files are in the same directory, with no other
         tracks in the same directory.
 
+        With more than one worker, the tracks are sharded by directory and the
+        shards are grouped in a process pool. The result is exactly the same
+        as with one worker.
+
+        @param workers: The number of worker processes. Optional. Defaults to
+                1, which groups in this process.
+        @type workers: int
         @return: Yields the grouped albums.
         @rtype: generator(Album)
         """
+        if workers > 1:
+            for album in Album._group_tracks_into_albums_sharded(
+                    tracks, workers):
+                yield album
+            return
+
         albums_by_key = {}
         albums_by_directory = {}
 
         # Identify unique, potential albums.
         for track in tracks:
-            if track.album_artist:
-                artist = track.album_artist
-            else:
-                artist = track.artist
-
-            if (not artist or not track.number or not track.year or
-                not track.album):
+            artist = _get_album_artist(track)
+            if artist is None:
                 continue
 
             location = track.location.replace('file://', '')
             directory = os.path.split(location)[0]
 
-            album_key = '%s-%s-%s-%s' % (
-                    artist, track.year, track.album, directory)
+            album_key = (artist, track.year, track.album, directory)
 
             album = albums_by_key.get(album_key)
             if not album:
@@ -297,14 +1262,56 @@ class Album(object):
                 albums_by_directory.setdefault(directory, [])
                 albums_by_directory[directory].append(album)
 
-            album.tracks.append(track)
+            album.add_track(track)
 
         # Only consider those albums where there are no other tracks in the same
         # directory. Otherwise single tracks might be treated as albums.
         for directory, albums in albums_by_directory.iteritems():
             if len(albums) == 1:
+                profiling.count('albums.formed')
                 yield albums[0]
 
+    @staticmethod
+    def _group_tracks_into_albums_sharded(tracks, workers):
+        tracks = list(tracks)
+        shards = [[] for _ in xrange(workers)]
+        for i, track in enumerate(tracks):
+            artist = _get_album_artist(track)
+            if artist is None:
+                continue
+            # Shard by the still encoded directory. Should two encodings of the
+            # same directory end up in different shards, they are merged below.
+            url = track._location_url
+            if url is None:
+                url = track.location
+            shard = hash(url.rsplit('/', 1)[0]) % workers
+            shards[shard].append((
+                    i, artist, track.year, track.album, track._location_url,
+                    track._location))
+
+        shard_results = _map_shards(_group_album_shard, shards)
+
+        indexes_by_key = {}
+        keys_by_directory = {}
+        for shard_result in shard_results:
+            for album_key, indexes in shard_result:
+                if album_key in indexes_by_key:
+                    indexes_by_key[album_key].extend(indexes)
+                    indexes_by_key[album_key].sort()
+                    continue
+                indexes_by_key[album_key] = indexes
+                directory = album_key[3]
+                keys_by_directory.setdefault(directory, [])
+                keys_by_directory[directory].append(album_key)
+
+        for directory, album_keys in keys_by_directory.iteritems():
+            if len(album_keys) == 1:
+                album_key = album_keys[0]
+                album_tracks = [tracks[i] for i in indexes_by_key[album_key]]
+                artist, year, album, _ = album_key
+                profiling.count('albums.formed')
+                yield Album(artist, year, album, album_tracks)
+
     def __unicode__(self):
         return '%s - %s - %s - Average rating: %0.2f - Rating completeness: %0.2f' % (
                 self.artist, self.year, self.album, self.avg_rating,
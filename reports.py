@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+"""A small engine to compute many reports in a single pass.
+
+Each report is an aggregator: it is fed every track and every album once and
+keeps only what it needs to produce its result (a counter, a bounded heap,
+...). Adding a report therefore doesn't add another pass over the library.
+"""
+
+import heapq
+import itertools
+
+
+class Report(object):
+    """A report fed by the ReportEngine.
+
+    Subclasses override add_track and/or add_album to aggregate, and
+    get_results to return the result items.
+    """
+
+    title = None
+
+    def add_track(self, track):
+        pass
+
+    def add_album(self, album):
+        pass
+
+    def get_results(self):
+        """@return: The result items, in order. Empty by default.
+        @rtype: list
+        """
+        return []
+
+    def format_text(self, item):
+        """Formats a result item as text.
+
+        @rtype: unicode
+        """
+        return unicode(item)
+
+    def to_json(self, item):
+        """Converts a result item into something JSON serializable."""
+        return item
+
+
+class ReportEngine(object):
+    """Feeds tracks and albums to all registered reports in one pass."""
+
+    def __init__(self, reports=None):
+        self.reports = list(reports or [])
+
+    def register(self, report):
+        """Adds a report.
+
+        @type report: Report
+        """
+        self.reports.append(report)
+
+    def run(self, tracks, albums=()):
+        """Feeds all tracks, then all albums to the reports.
+
+        @type tracks: iterable(Track)
+        @type albums: iterable(Album)
+        @return: The reports and their results, in order of registration.
+        @rtype: [(Report, list)]
+        """
+        # Only feed the reports that aggregate tracks or albums at all.
+        track_reports = [
+                r for r in self.reports if _overrides(r, 'add_track')]
+        album_reports = [
+                r for r in self.reports if _overrides(r, 'add_album')]
+        if track_reports:
+            for track in tracks:
+                for report in track_reports:
+                    report.add_track(track)
+        if album_reports:
+            for album in albums:
+                for report in album_reports:
+                    report.add_album(album)
+        return [(report, report.get_results()) for report in self.reports]
+
+
+class TopN(object):
+    """Keeps the n items with the largest keys in a bounded heap.
+
+    Adding an item costs O(log n), no matter how many items were added.
+    Of items with equal keys, the ones added first are kept.
+    """
+
+    def __init__(self, n, key=None):
+        """Creates a new TopN.
+
+        @param n: The number of items to keep.
+        @type n: int
+        @param key: Returns the key to rank an item by. Optional. Defaults to
+                the item itself.
+        @type key: function(object)
+        """
+        self.n = n
+        self.key = key or (lambda item: item)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def add(self, item):
+        # The negated counter breaks ties in favour of earlier items, and
+        # keeps the items themselves from ever being compared.
+        entry = (self.key(item), -next(self._counter), item)
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, entry)
+        elif self._heap and entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def get(self):
+        """@return: The kept items, largest key first.
+        @rtype: list
+        """
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+
+def _overrides(report, method_name):
+    method = getattr(type(report), method_name)
+    return method.im_func is not getattr(Report, method_name).im_func
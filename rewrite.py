@@ -0,0 +1,457 @@
+#!/usr/bin/python
+
+"""A tool to write a patched copy of an iTunes library XML.
+
+The copy can be imported into iTunes again, e.g. with Moody tags restored or
+deleted tracks removed. Changes are collected in a LibraryPatch and applied
+by rewrite_library in a single sequential pass over the XML:
+
+    - Everything but the patched track dicts and the items of removed tracks
+      is copied byte for byte, in large slices.
+    - Only one track dict is looked at at a time, so memory stays constant
+      however large the library is.
+    - Untargeted track dicts are skipped by their Track ID key, and their
+      Persistent ID if the patch targets any by Persistent ID, without
+      parsing them. Track dicts don't contain other dicts, so the first
+      </dict> after a track's <dict> ends it.
+    - The playlists are only scanned if tracks are removed, to drop their
+      items.
+
+Tracks removed by Persistent ID are only dropped from the playlists if the
+Tracks section comes first, as iTunes writes it, since the Track IDs of the
+items aren't known before.
+
+As a tool, the patch is read from STDIN as JSON Lines, one track per line:
+
+    {"track_id": 123, "fields": {"Rating": 80, "Composer": null}}
+    {"persistent_id": "0123456789ABCDEF", "remove": true}
+
+A field set to null is removed from the track dict.
+"""
+
+import datetime
+import getopt
+import logging
+import mmap
+import os
+import os.path
+import re
+import stat
+import sys
+import tempfile
+import urllib
+from xml.sax import saxutils
+
+import simplejson
+
+import profiling
+import pytunes
+
+LOG_FORMAT = '%(message)s'
+
+_COPY_SIZE = 1 << 20
+_TRACKS_START = re.compile(r'<key>Tracks</key>\s*<dict>')
+_PLAYLISTS_START = re.compile(r'<key>Playlists</key>\s*<array>')
+_SECTION_END = re.compile(r'\s*</dict>')
+_TRACK_ENTRY = re.compile(r'\s*<key>(\d+)</key>\s*<dict>')
+_PERSISTENT_ID = re.compile(
+        r'<key>Persistent ID</key>\s*<string>([^<]*)</string>')
+_FIELD = re.compile(
+        r'(\s*)<key>([^<]*)</key>(\s*)(?:<\w+/>|<(\w+)>[^<]*</\4>)')
+_ARRAY_TAG = re.compile(r'<(/?)array>')
+_PLAYLIST_ITEM = re.compile(
+        r'\s*<dict>\s*<key>Track ID</key>\s*<integer>(\d+)</integer>\s*'
+        r'</dict>')
+# Where new fields go if a track dict has none yet.
+_DEFAULT_INDENT = '\n\t\t\t'
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: rewrite.py -o PATH < PATCH
+    [-h|--help]          This screen.
+    [-l|--library PATH]  The iTunes library XML. Defaults to the user's.
+    [-o|--output PATH]   Where to write the patched copy. Required.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    library_path = None
+    output_path = None
+    profile_path = None
+
+    options = 'hl:o:p:'
+    options_long = ['help', 'library=', 'output=', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+    except getopt.error, msg:
+        raise Usage(msg)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            raise Usage()
+        if opt in ('-l', '--library'):
+            library_path = arg
+        if opt in ('-o', '--output'):
+            output_path = arg
+        if opt in ('-p', '--profile'):
+            profile_path = arg
+
+    if not output_path:
+        raise Usage('Must specify an output path.')
+
+    return library_path, output_path, profile_path
+
+
+class LibraryPatch(object):
+    """Changes to the tracks of a library XML, see rewrite_library.
+
+    Tracks are targeted by Track ID or Persistent ID. Fields are plist keys,
+    e.g. 'Rating' or 'Composer', and their values ints, strings, bools,
+    floats or datetimes. None removes a field.
+    """
+
+    def __init__(self):
+        self._fields_by_id = {}
+        self._fields_by_persistent_id = {}
+        self._removed_ids = set()
+        self._removed_persistent_ids = set()
+
+    def update_track(self, fields, track_id=None, persistent_id=None):
+        """Sets fields of a track.
+
+        @param fields: The values per plist key.
+        @type fields: {str: object}
+        @type track_id: int
+        @type persistent_id: str
+        """
+        if track_id is not None:
+            self._fields_by_id.setdefault(track_id, {}).update(fields)
+        elif persistent_id is not None:
+            self._fields_by_persistent_id.setdefault(
+                    persistent_id, {}).update(fields)
+        else:
+            raise ValueError('Need a Track ID or a Persistent ID.')
+
+    def move_track(self, path, track_id=None, persistent_id=None):
+        """Points a track to a new file.
+
+        @type path: unicode
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        location = 'file://localhost' + urllib.quote(path)
+        self.update_track({'Location': location}, track_id, persistent_id)
+
+    def remove_track(self, track_id=None, persistent_id=None):
+        """Removes a track, and its items from all playlists."""
+        if track_id is not None:
+            self._removed_ids.add(track_id)
+        elif persistent_id is not None:
+            self._removed_persistent_ids.add(persistent_id)
+        else:
+            raise ValueError('Need a Track ID or a Persistent ID.')
+
+    def __len__(self):
+        return (len(self._fields_by_id) + len(self._fields_by_persistent_id) +
+                len(self._removed_ids) + len(self._removed_persistent_ids))
+
+    def __unicode__(self):
+        return u'LibraryPatch(%d tracks)' % len(self)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def read_patch(lines):
+    """Reads a patch from JSON Lines, see the module docs. Blank lines are
+    skipped.
+
+    @type lines: iterable(str)
+    @rtype: LibraryPatch
+    @raise ValueError: If a line isn't a valid change.
+    """
+    patch = LibraryPatch()
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = simplejson.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Not a track change.')
+            track_id = record.get('track_id')
+            persistent_id = record.get('persistent_id')
+            if record.get('remove'):
+                patch.remove_track(track_id, persistent_id)
+            else:
+                fields = record.get('fields')
+                if not isinstance(fields, dict):
+                    raise ValueError('No fields to change.')
+                patch.update_track(fields, track_id, persistent_id)
+        except ValueError, e:
+            raise ValueError('Line %d: %s' % (line_number, e))
+    return patch
+
+
+@profiling.profiled('rewrite.rewrite_library')
+def rewrite_library(source_path, target_path, patch):
+    """Writes a patched copy of a library XML.
+
+    The copy is written to a temporary file first and then moved into
+    place, so target_path may be source_path.
+
+    @type source_path: str
+    @type target_path: str
+    @type patch: LibraryPatch
+    @return: The number of tracks modified, tracks removed and playlist items
+            removed, and of targeted tracks that weren't found.
+    @rtype: {str: int}
+    @raise ValueError: If the XML isn't laid out like iTunes writes it.
+    """
+    directory = os.path.dirname(os.path.abspath(target_path))
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb', _COPY_SIZE) as out:
+            with open(source_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError('Empty library XML: %s' % source_path)
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    counts = _Rewriter(data, out, patch).run()
+                finally:
+                    data.close()
+        # mkstemp creates the file readable by its owner only.
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(source_path).st_mode))
+        os.rename(tmp_path, target_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return counts
+
+
+class _Rewriter(object):
+    """Copies a mapped library XML to a file, patching it on the way."""
+
+    def __init__(self, data, out, patch):
+        self.data = data
+        self.out = out
+        self.patch = patch
+        self.copied = 0
+        self.tracks_done = False
+        self.removed_ids = set(patch._removed_ids)
+        self.found_ids = set()
+        self.found_persistent_ids = set()
+        self.counts = {
+            'tracks.modified': 0,
+            'tracks.removed': 0,
+            'playlist_items.removed': 0,
+        }
+
+    def run(self):
+        sections = []
+        match = _TRACKS_START.search(self.data)
+        if match is None:
+            raise ValueError('No Tracks section found.')
+        sections.append((match.end(), self._rewrite_tracks))
+        match = _PLAYLISTS_START.search(self.data)
+        if match is not None:
+            sections.append((match.end(), self._rewrite_playlists))
+        for start, rewrite_section in sorted(sections):
+            rewrite_section(start)
+        self._copy_until(len(self.data))
+
+        patch = self.patch
+        self.counts['tracks.missing'] = (
+                len((set(patch._fields_by_id) | patch._removed_ids) -
+                    self.found_ids) +
+                len((set(patch._fields_by_persistent_id) |
+                     patch._removed_persistent_ids) -
+                    self.found_persistent_ids))
+        return self.counts
+
+    def _rewrite_tracks(self, pos):
+        data = self.data
+        patch = self.patch
+        by_persistent_id = bool(patch._fields_by_persistent_id or
+                                patch._removed_persistent_ids)
+        while True:
+            match = _TRACK_ENTRY.match(data, pos)
+            if match is None:
+                break
+            body_start = match.end()
+            body_end = data.find('</dict>', body_start)
+            if body_end == -1:
+                raise ValueError('Unterminated track at %d.' % match.start())
+            pos = body_end + len('</dict>')
+
+            track_id = int(match.group(1))
+            fields = patch._fields_by_id.get(track_id)
+            removed = track_id in patch._removed_ids
+            if fields or removed:
+                self.found_ids.add(track_id)
+            if by_persistent_id:
+                persistent_id_match = _PERSISTENT_ID.search(
+                        data, body_start, body_end)
+                if persistent_id_match is not None:
+                    persistent_id = persistent_id_match.group(1)
+                    more_fields = patch._fields_by_persistent_id.get(
+                            persistent_id)
+                    if more_fields:
+                        fields = dict(fields or {})
+                        fields.update(more_fields)
+                        self.found_persistent_ids.add(persistent_id)
+                    if persistent_id in patch._removed_persistent_ids:
+                        removed = True
+                        self.found_persistent_ids.add(persistent_id)
+                        self.removed_ids.add(track_id)
+
+            if removed:
+                self._copy_until(match.start())
+                self.copied = pos
+                self.counts['tracks.removed'] += 1
+            elif fields:
+                self._copy_until(body_start)
+                self.out.write(_patch_fields(data[body_start:body_end], fields))
+                self.copied = body_end
+                self.counts['tracks.modified'] += 1
+        if _SECTION_END.match(data, pos) is None:
+            raise ValueError('Unexpected content in the Tracks section at %d.'
+                             % pos)
+        self.tracks_done = True
+
+    def _rewrite_playlists(self, pos):
+        if self.patch._removed_persistent_ids and not self.tracks_done:
+            logger.warning('The playlists come before the tracks, so the '
+                           'items of tracks removed by Persistent ID are '
+                           'kept.')
+        if not self.removed_ids:
+            return
+        # Find the end of the section. Playlists contain arrays of items.
+        depth = 1
+        for match in _ARRAY_TAG.finditer(self.data, pos):
+            depth += -1 if match.group(1) else 1
+            if not depth:
+                end = match.start()
+                break
+        else:
+            raise ValueError('Unterminated Playlists section.')
+        for match in _PLAYLIST_ITEM.finditer(self.data, pos, end):
+            if int(match.group(1)) in self.removed_ids:
+                self._copy_until(match.start())
+                self.copied = match.end()
+                self.counts['playlist_items.removed'] += 1
+
+    def _copy_until(self, end):
+        # Copy in slices, so large unchanged stretches aren't read into
+        # memory at once.
+        for start in xrange(self.copied, end, _COPY_SIZE):
+            self.out.write(self.data[start:min(start + _COPY_SIZE, end)])
+        self.copied = max(self.copied, end)
+
+
+def _patch_fields(body, fields):
+    """Patches the fields of a track dict, keeping the formatting of all
+    others. New fields are appended.
+
+    @param body: The XML between the <dict> and </dict> of the track.
+    @type body: str
+    @type fields: {str: object}
+    @rtype: str
+    """
+    pieces = []
+    remaining = dict(fields)
+    indent = separator = None
+    pos = 0
+    while True:
+        match = _FIELD.match(body, pos)
+        if match is None:
+            break
+        if indent is None:
+            indent, separator = match.group(1), match.group(3)
+        key = saxutils.unescape(match.group(2)).decode('utf-8')
+        if key in remaining:
+            value = remaining.pop(key)
+            if value is not None:
+                pieces.append('%s<key>%s</key>%s%s' % (
+                        match.group(1), match.group(2), match.group(3),
+                        _format_value(value)))
+        else:
+            pieces.append(match.group(0))
+        pos = match.end()
+    tail = body[pos:]
+    if tail.strip():
+        raise ValueError('Unexpected content in a track: %r' % tail[:80])
+    if indent is None:
+        indent, separator = _DEFAULT_INDENT, ''
+    for key, value in sorted(remaining.iteritems()):
+        if value is not None:
+            pieces.append('%s<key>%s</key>%s%s' % (
+                    indent, _escape(key), separator, _format_value(value)))
+    pieces.append(tail)
+    return ''.join(pieces)
+
+
+def _format_value(value):
+    """Formats a value the way iTunes (and plistlib) write it."""
+    if value is True:
+        return '<true/>'
+    if value is False:
+        return '<false/>'
+    if isinstance(value, (int, long)):
+        return '<integer>%d</integer>' % value
+    if isinstance(value, float):
+        return '<real>%r</real>' % value
+    if isinstance(value, datetime.datetime):
+        return '<date>%s</date>' % value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, basestring):
+        return '<string>%s</string>' % _escape(value)
+    raise ValueError('Cannot write %r to a library XML.' % (value,))
+
+
+def _escape(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return saxutils.escape(text)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        library_path, output_path, profile_path = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    source_path = pytunes.Library(library_path).path
+    try:
+        patch = read_patch(iter(sys.stdin.readline, ''))
+        logger.info('Rewriting %s...', source_path)
+        counts = rewrite_library(source_path, output_path, patch)
+    except (IOError, OSError, ValueError), e:
+        logger.error('Cannot rewrite the library: %s', e)
+        return 1
+    logger.info('Done: %s.', ', '.join(
+            '%d %s' % (n, name) for name, n in sorted(counts.items())))
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+"""A server that keeps an iTunes library loaded, so tools don't reload it.
+
+Opening the library, loading all tracks and grouping them into albums is
+what most runs of stats.py, cleanup.py and moody.py spend their time on. The
+server does it once and answers their queries over HTTP, bound to localhost.
+The library is refreshed (see pytunes.Library.refresh) whenever the XML
+changes, in the background and before every request.
+
+Requests take an optional library parameter. If it doesn't match the library
+of the server, the server answers 409 Conflict and clients load the library
+themselves.
+
+    GET /status              The library path and the number of tracks and
+                             albums, as JSON.
+    GET /tracks?CRITERIA     The tracks matching the criteria of
+                             pytunes.Library.query, as JSON. Values are
+                             parsed as JSON if possible, e.g.
+                             /tracks?artist=Tool&year__between=[1990,1999].
+    GET /stats?format=F      The output of stats.py.
+    GET /cleanup             The plan of cleanup.py, as JSON.
+    POST /moody?export=0|1&diff=0|1&stream=0|1
+                             The output of moody.py. The body is its input.
+
+The client side is in serverclient.py.
+"""
+
+import BaseHTTPServer
+import getopt
+import httplib
+import logging
+import os.path
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+import simplejson
+
+import cleanup
+import moody
+import pipeline
+import profiling
+import pytunes
+import serverclient
+import stats
+
+LOG_FORMAT = '%(message)s'
+DEFAULT_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: server.py
+    [-h|--help]            This screen.
+    [-a|--address ADDRESS] The address to listen on. Defaults to
+                           localhost:8752.
+    [-l|--library PATH]    The iTunes library XML. Defaults to the user's.
+    [-i|--interval SECS]   How often to check the XML for changes. Defaults
+                           to 10 seconds.
+    [-w|--workers N]       The number of processes parsing the library XML.
+                           Defaults to 1.
+    [-p|--profile PATH]    Write a profile of the run to PATH when stopped, as
+                           collapsed stacks if it ends with .folded, as JSON
+                           otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+class LibraryState(object):
+    """A library, its songs and albums, kept up to date with the XML.
+
+    All access goes through the lock, since the library isn't thread safe.
+    """
+
+    def __init__(self, library):
+        """@type library: pytunes.Library"""
+        self.library = library
+        self.lock = threading.Lock()
+        self.songs = None
+        self.albums = None
+
+    def refresh(self):
+        """Loads the library, or reloads it if the XML changed.
+
+        Must be called with the lock held.
+        """
+        if self.songs is None:
+            logger.info('Loading all tracks...')
+            self._update()
+        elif self.library.refresh():
+            logger.info('Reloaded the changed library.')
+            self._update()
+
+    def _update(self):
+        self.songs = pipeline.Pipeline(lambda: self.library.tracks).pipe(
+                pipeline.without_podcasts)
+        self.albums = list(self.songs.pipe(pipeline.group_albums))
+
+    def handles(self, path):
+        """@return: Whether there is a handler for the path.
+        @rtype: bool
+        """
+        return hasattr(self, '_handle_' + path.strip('/'))
+
+    def handle(self, path, params, body):
+        """Answers a request. Must be called with the lock held.
+
+        @return: The content type and content of the response.
+        @rtype: (str, str)
+        @raise ValueError: If the parameters or body are invalid.
+        """
+        handler = getattr(self, '_handle_' + path.strip('/'))
+        return handler(params, body)
+
+    def _handle_status(self, params, body):
+        return _json_response({
+            'library': self.library.path,
+            'tracks': sum(1 for _ in self.library.tracks),
+            'songs': sum(1 for _ in self.songs),
+            'albums': len(self.albums),
+        })
+
+    def _handle_tracks(self, params, body):
+        criteria = {}
+        for criterion, value in params.iteritems():
+            try:
+                value = simplejson.loads(value)
+            except ValueError:
+                value = value.decode('utf-8')
+            if isinstance(value, list):
+                value = tuple(value)
+            criteria[str(criterion)] = value
+        tracks = self.library.query(**criteria)
+        return _json_response([_track_to_json(t) for t in tracks])
+
+    def _handle_stats(self, params, body):
+        output_format = params.get('format', 'text')
+        if output_format not in stats.FORMATS:
+            raise ValueError('Unknown format: %s.' % output_format)
+        out = StringIO.StringIO()
+        results = stats.run_reports(self.songs, self.albums)
+        stats.print_results(results, output_format, out)
+        return 'text/plain; charset=utf-8', out.getvalue()
+
+    def _handle_cleanup(self, params, body):
+        plan = cleanup.plan_cleanup(self.songs, self.albums)
+        return _json_response([action.to_json() for action in plan])
+
+    def _handle_moody(self, params, body):
+        out = StringIO.StringIO()
+        moody.run(self.library.tracks, params.get('export') == '1',
+                  params.get('diff') == '1', params.get('stream') == '1',
+                  StringIO.StringIO(body or ''), out)
+        return 'text/plain; charset=utf-8', out.getvalue()
+
+    def __unicode__(self):
+        return u'LibraryState(%s)' % self.library
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class LibraryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a LibraryState over HTTP, one thread per request."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state):
+        """@param address: The HOST:PORT to listen on.
+        @type address: str
+        @type state: LibraryState
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+                self, serverclient.parse_address(address), _RequestHandler)
+        self.state = state
+
+    def poll(self, interval):
+        """Refreshes the library every interval seconds, in a daemon
+        thread, so requests rarely wait for a reload.
+
+        @type interval: float
+        """
+        def _poll():
+            while True:
+                time.sleep(interval)
+                with self.state.lock:
+                    self.state.refresh()
+        thread = threading.Thread(target=_poll, name='library-poll')
+        thread.daemon = True
+        thread.start()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(self.rfile.read(length))
+
+    def _handle(self, body):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        library_path = params.pop('library', None)
+        state = self.server.state
+        if library_path and (os.path.abspath(library_path) !=
+                             os.path.abspath(state.library.path)):
+            self._respond(httplib.CONFLICT, 'text/plain',
+                          'The server serves %s.' % state.library.path)
+            return
+        if not state.handles(url.path):
+            self._respond(httplib.NOT_FOUND, 'text/plain',
+                          'Unknown path: %s' % url.path)
+            return
+        try:
+            with state.lock:
+                with profiling.phase('server.request'):
+                    state.refresh()
+                    content_type, content = state.handle(
+                            url.path, params, body)
+        except ValueError, e:
+            self._respond(httplib.BAD_REQUEST, 'text/plain',
+                          'Invalid request: %s' % e)
+        except Exception, e:
+            logger.exception('Failed to answer %s', self.path)
+            self._respond(httplib.INTERNAL_SERVER_ERROR, 'text/plain',
+                          'Server error: %s' % e)
+        else:
+            self._respond(httplib.OK, content_type, content)
+
+    def _respond(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _json_response(value):
+    return 'application/json', simplejson.dumps(value, default=_to_json)
+
+
+def _track_to_json(track):
+    item = dict((name, getattr(track, name))
+                for name in pytunes.Track.__slots__
+                if not name.startswith('_'))
+    item['location'] = track.location
+    return item
+
+
+def _to_json(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError('Not JSON serializable: %r' % (value,))
+
+
+def _parse_args(argv):
+    address = serverclient.DEFAULT_ADDRESS
+    library_path = None
+    interval = DEFAULT_INTERVAL
+    workers = 1
+    profile_path = None
+
+    options = 'ha:l:i:w:p:'
+    options_long = [
+            'help', 'address=', 'library=', 'interval=', 'workers=',
+            'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-a', '--address'):
+                address = arg
+                serverclient.parse_address(address)
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-i', '--interval'):
+                interval = float(arg)
+            if opt in ('-w', '--workers'):
+                workers = int(arg)
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if interval <= 0:
+        raise Usage('The interval must be positive.')
+    if workers < 1:
+        raise Usage('Need at least one worker.')
+
+    return address, library_path, interval, workers, profile_path
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        address, library_path, interval, workers, profile_path = (
+                _parse_args(argv))
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    logger.info('Opening iTunes library...')
+    state = LibraryState(pytunes.Library(library_path, workers=workers))
+    with state.lock:
+        state.refresh()
+    server = LibraryServer(address, state)
+    server.poll(interval)
+    logger.info('Serving %s on %s.', state.library.path, address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
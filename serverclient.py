@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+"""The client side of the library server, see server.py.
+
+The tools ask the server with query, and load the library themselves if it
+returns None, e.g. because the server serves another library.
+"""
+
+import httplib
+import logging
+import os.path
+import socket
+import urllib
+
+import profiling
+import pytunes
+
+DEFAULT_ADDRESS = 'localhost:8752'
+
+logger = logging.getLogger(__name__)
+
+
+class ServerError(Exception):
+    """The server failed to answer a request."""
+
+
+class ServerUnavailable(ServerError):
+    """The server isn't running, or serves another library."""
+
+
+def parse_address(address):
+    """Parses a HOST:PORT address. The host defaults to localhost.
+
+    @rtype: (str, int)
+    @raise ValueError: If the address isn't valid.
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('Invalid server address: %s' % address)
+    return host or 'localhost', port
+
+
+def query(address, path, library_path=None, body=None, **params):
+    """Sends a request to the server.
+
+    @param address: The HOST:PORT of the server.
+    @type address: str
+    @param library_path: The library the request is about. Optional.
+            Defaults to the user's, like pytunes.Library. The server only
+            answers if it serves this library.
+    @type library_path: str
+    @param body: The body of the request. Optional. Makes it a POST.
+    @type body: str
+    @return: The response, or None if the server isn't available.
+    @rtype: str
+    @raise ServerError: If the server failed to answer the request.
+    """
+    library_path = pytunes.Library(library_path).path
+    try:
+        return Client(address).request(path, library_path, body, **params)
+    except ServerUnavailable, e:
+        logger.info('Not using the library server: %s', e)
+        return None
+
+
+class Client(object):
+    """A client of the library server."""
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        self.host, self.port = parse_address(address)
+        self.timeout = timeout
+
+    @profiling.profiled('server.request')
+    def request(self, path, library_path=None, body=None, **params):
+        """Sends a request and returns the response.
+
+        See query for the parameters, but without a library_path the
+        request is about the library of the server, whichever it is.
+
+        @rtype: str
+        @raise ServerUnavailable: If the server isn't running, or serves
+                another library.
+        @raise ServerError: If the server failed to answer the request.
+        """
+        if library_path:
+            params['library'] = os.path.abspath(library_path)
+        url = path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        conn = httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+        try:
+            conn.request('POST' if body is not None else 'GET', url, body)
+            response = conn.getresponse()
+            content = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            raise ServerUnavailable(
+                    'Cannot reach %s:%d: %s' % (self.host, self.port, e))
+        finally:
+            conn.close()
+        if response.status == httplib.CONFLICT:
+            raise ServerUnavailable(content)
+        if response.status != httplib.OK:
+            raise ServerError(content)
+        return content
@@ -0,0 +1,433 @@
+#!/usr/bin/python
+
+"""A tool to find similar artists and tracks by playlist co-occurrence.
+
+Tracks that are often in the same playlists, and artists whose tracks are,
+are considered similar. The library is turned into two sparse incidence
+matrices: tracks x playlists and artists x playlists, with a 1 where the
+track (or any track of the artist) is in the playlist. The master playlist
+and the distinguished playlists (Music, Movies, Podcasts, ...) are left out,
+since they say nothing about which music goes together.
+
+The similarities to a single track or artist are one row of a sparse matrix
+product of the incidence matrix with its transpose:
+
+    - Co-occurrence: the number of playlists shared.
+    - Cosine: the co-occurrence divided by the geometric mean of the numbers
+      of playlists of both, so ubiquitous tracks don't dominate.
+
+Only that row is computed, so a query costs about as much as the playlists
+of the track or artist are long, and the full products, which can be huge
+for long playlists, are never built.
+
+The incidence matrices are cached next to the library snapshots and rebuilt
+when the library XML changes.
+"""
+
+import contextlib
+import getopt
+import hashlib
+import logging
+import os
+import os.path
+import sys
+import tempfile
+
+import numpy
+import scipy.sparse
+import simplejson
+
+import profiling
+import pytunes
+
+LOG_FORMAT = '%(message)s'
+FORMATS = ('text', 'json')
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.pytunes/similarity')
+
+# The similarity metrics.
+COSINE = 'cosine'
+COOCCURRENCE = 'cooccurrence'
+METRICS = (COSINE, COOCCURRENCE)
+
+# Bump this whenever the layout of the cache changes.
+_FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: similarity.py
+    [-h|--help]          This screen.
+    [-a|--artist NAME]   Find the artists most similar to NAME.
+    [-t|--track ID]      Find the tracks most similar to the track with ID.
+    [-k|--top N]         The number of results. Defaults to 10.
+    [-m|--metric METRIC] cosine (default) or cooccurrence.
+    [-f|--format FORMAT] The output format: text (default) or json.
+    [-l|--library PATH]  The iTunes library XML. Defaults to the user's.
+    [-n|--no-cache]      Don't use the cache in ~/.pytunes/similarity.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    artist = None
+    track_id = None
+    k = 10
+    metric = COSINE
+    output_format = 'text'
+    library_path = None
+    use_cache = True
+    profile_path = None
+
+    options = 'ha:t:k:m:f:l:np:'
+    options_long = [
+            'help', 'artist=', 'track=', 'top=', 'metric=', 'format=',
+            'library=', 'no-cache', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-a', '--artist'):
+                artist = arg.decode('utf-8')
+            if opt in ('-t', '--track'):
+                track_id = int(arg)
+            if opt in ('-k', '--top'):
+                k = int(arg)
+            if opt in ('-m', '--metric'):
+                metric = arg
+            if opt in ('-f', '--format'):
+                output_format = arg
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-n', '--no-cache'):
+                use_cache = False
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if (artist is None) == (track_id is None):
+        raise Usage('Must specify either an artist or a track.')
+    if k < 1:
+        raise Usage('Need at least one result.')
+    if metric not in METRICS:
+        raise Usage('Unknown metric: %s.' % metric)
+    if output_format not in FORMATS:
+        raise Usage('Unknown format: %s.' % output_format)
+
+    return (artist, track_id, k, metric, output_format, library_path,
+            use_cache, profile_path)
+
+
+class SimilarityModel(object):
+    """The incidence matrices of a library, and queries on them."""
+
+    def __init__(self, track_ids, artists, playlist_ids, track_playlists,
+                 artist_playlists):
+        """Creates a new SimilarityModel. See build to build one.
+
+        @param track_ids: The track IDs of the rows of track_playlists,
+                sorted.
+        @type track_ids: numpy.ndarray
+        @param artists: The artists of the rows of artist_playlists, sorted.
+        @type artists: [unicode]
+        @param playlist_ids: The playlist IDs of the columns.
+        @type playlist_ids: numpy.ndarray
+        @param track_playlists: The tracks x playlists incidence matrix.
+        @type track_playlists: scipy.sparse.csr_matrix
+        @param artist_playlists: The artists x playlists incidence matrix.
+        @type artist_playlists: scipy.sparse.csr_matrix
+        """
+        self.track_ids = track_ids
+        self.artists = artists
+        self.playlist_ids = playlist_ids
+        self.track_playlists = track_playlists
+        self.artist_playlists = artist_playlists
+        self._artist_rows = dict((a, i) for i, a in enumerate(artists))
+        self._transposed = {}
+
+    @staticmethod
+    @profiling.profiled('similarity.build')
+    def build(library):
+        """Builds the incidence matrices of a library.
+
+        @type library: pytunes.Library
+        @rtype: SimilarityModel
+        """
+        playlist_ids = []
+        item_ids = []
+        for playlist in library.playlists:
+            if playlist.master or playlist.distinguished_kind is not None:
+                continue
+            if not len(playlist.item_ids):
+                continue
+            playlist_ids.append(playlist.id)
+            item_ids.append(numpy.frombuffer(
+                    playlist.item_ids, dtype=numpy.dtype('l')))
+        playlist_ids = numpy.array(playlist_ids, dtype=numpy.int64)
+        lengths = [len(ids) for ids in item_ids]
+        if item_ids:
+            item_ids = numpy.concatenate(item_ids)
+        else:
+            item_ids = numpy.zeros(0, dtype=numpy.int64)
+        track_ids, track_rows = numpy.unique(item_ids, return_inverse=True)
+        playlist_columns = numpy.repeat(
+                numpy.arange(len(playlist_ids)), lengths)
+        track_playlists = _incidence_matrix(
+                track_rows, playlist_columns,
+                (len(track_ids), len(playlist_ids)))
+
+        # Map the track rows to artist rows and sum them up.
+        artist_by_track_id = dict(
+                (t.id, t.artist) for t in library.tracks if t.artist)
+        track_artists = [artist_by_track_id.get(i) for i in track_ids]
+        artists = sorted(set(a for a in track_artists if a is not None))
+        artist_rows = dict((a, i) for i, a in enumerate(artists))
+        rows = numpy.array(
+                [artist_rows.get(a, -1) for a in track_artists],
+                dtype=numpy.int64)
+        has_artist = rows >= 0
+        track_artist_matrix = _incidence_matrix(
+                rows[has_artist], numpy.nonzero(has_artist)[0],
+                (len(artists), len(track_ids)))
+        artist_playlists = track_artist_matrix.dot(track_playlists).tocsr()
+        artist_playlists.data[:] = 1
+        return SimilarityModel(track_ids, artists, playlist_ids,
+                               track_playlists, artist_playlists)
+
+    def similar_tracks(self, track_id, k=10, metric=COSINE):
+        """Finds the tracks most similar to a track.
+
+        @type track_id: int
+        @param k: The number of tracks to return. Optional. Defaults to 10.
+        @type k: int
+        @param metric: COSINE or COOCCURRENCE. Optional. Defaults to COSINE.
+        @type metric: str
+        @return: The IDs of the most similar tracks and their scores, best
+                first. Empty if the track is in no playlist.
+        @rtype: [(int, float)]
+        """
+        row = numpy.searchsorted(self.track_ids, track_id)
+        if row == len(self.track_ids) or self.track_ids[row] != track_id:
+            return []
+        return [(int(self.track_ids[i]), score) for i, score in self._top(
+                self.track_playlists, row, k, metric)]
+
+    def similar_artists(self, artist, k=10, metric=COSINE):
+        """Finds the artists most similar to an artist.
+
+        See similar_tracks for the parameters.
+
+        @type artist: unicode
+        @return: The most similar artists and their scores, best first. Empty
+                if none of the tracks of the artist is in a playlist.
+        @rtype: [(unicode, float)]
+        """
+        row = self._artist_rows.get(artist)
+        if row is None:
+            return []
+        return [(self.artists[i], score) for i, score in self._top(
+                self.artist_playlists, row, k, metric)]
+
+    @profiling.profiled('similarity.query')
+    def _top(self, matrix, row, k, metric):
+        """Scores all rows of the matrix against one of them.
+
+        @return: The row numbers and scores of the k best other rows, by
+                descending score, then by row number.
+        @rtype: [(int, float)]
+        """
+        key = id(matrix)
+        transposed = self._transposed.get(key)
+        if transposed is None:
+            transposed = self._transposed[key] = matrix.transpose().tocsr()
+        cooccurrence = matrix[row].dot(transposed)
+        rows = cooccurrence.indices
+        scores = cooccurrence.data.astype(numpy.float64)
+        if metric == COSINE:
+            counts = numpy.diff(matrix.indptr)
+            scores /= numpy.sqrt(counts[rows] * float(counts[row]))
+        is_other = rows != row
+        rows, scores = rows[is_other], scores[is_other]
+        if len(rows) > k:
+            # Keep everything tied with the k-th best score, so the order of
+            # the ties doesn't depend on the partitioning.
+            threshold = numpy.partition(scores, len(scores) - k)[-k]
+            is_top = scores >= threshold
+            rows, scores = rows[is_top], scores[is_top]
+        order = numpy.lexsort((rows, -scores))[:k]
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    def save(self, path, fingerprint):
+        """Writes the model to a file, atomically.
+
+        @param fingerprint: The size and modification time of the library
+                XML the model was built from.
+        @type fingerprint: (int, float)
+        """
+        directory = os.path.dirname(path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(
+                        f,
+                        version=numpy.array([_FORMAT_VERSION]),
+                        fingerprint=numpy.array(
+                                [str(fingerprint[0]), repr(fingerprint[1])]),
+                        track_ids=self.track_ids,
+                        artists=numpy.array(self.artists, dtype=numpy.unicode_),
+                        playlist_ids=self.playlist_ids,
+                        track_indptr=self.track_playlists.indptr,
+                        track_indices=self.track_playlists.indices,
+                        artist_indptr=self.artist_playlists.indptr,
+                        artist_indices=self.artist_playlists.indices)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def load(path, fingerprint):
+        """Reads a model written by save.
+
+        @return: The model, or None if it was built from another version of
+                the library XML.
+        @rtype: SimilarityModel
+        """
+        with contextlib.closing(numpy.load(path)) as f:
+            if (f['version'][0] != _FORMAT_VERSION or
+                list(f['fingerprint']) !=
+                    [str(fingerprint[0]), repr(fingerprint[1])]):
+                return None
+            track_ids = f['track_ids']
+            artists = [unicode(a) for a in f['artists']]
+            playlist_ids = f['playlist_ids']
+            shape = (len(track_ids), len(playlist_ids))
+            track_playlists = _binary_csr_matrix(
+                    f['track_indices'], f['track_indptr'], shape)
+            shape = (len(artists), len(playlist_ids))
+            artist_playlists = _binary_csr_matrix(
+                    f['artist_indices'], f['artist_indptr'], shape)
+        return SimilarityModel(track_ids, artists, playlist_ids,
+                               track_playlists, artist_playlists)
+
+    def __unicode__(self):
+        return u'SimilarityModel(%d tracks, %d artists, %d playlists)' % (
+                len(self.track_ids), len(self.artists),
+                len(self.playlist_ids))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def get_model(library, cache_dir=DEFAULT_CACHE_DIR):
+    """Loads the model of a library from the cache, or builds it.
+
+    @type library: pytunes.Library
+    @param cache_dir: The directory of the cache. None to not use a cache.
+            Optional. Defaults to ~/.pytunes/similarity.
+    @type cache_dir: str
+    @rtype: SimilarityModel
+    """
+    if cache_dir is None:
+        return SimilarityModel.build(library)
+    source_path = os.path.abspath(library.path)
+    stat = os.stat(source_path)
+    fingerprint = (stat.st_size, stat.st_mtime)
+    path_hash = hashlib.sha1(source_path.encode('utf-8')
+                             if isinstance(source_path, unicode)
+                             else source_path).hexdigest()
+    path = os.path.join(cache_dir, path_hash + '.npz')
+    if os.path.exists(path):
+        try:
+            model = SimilarityModel.load(path, fingerprint)
+        except (IOError, KeyError, ValueError), e:
+            logger.warning('Ignoring a broken similarity cache: %s', e)
+            model = None
+        if model is not None:
+            return model
+    logger.info('Building the playlist incidence matrices...')
+    model = SimilarityModel.build(library)
+    try:
+        model.save(path, fingerprint)
+    except (IOError, OSError), e:
+        logger.warning('Not caching the similarity model: %s', e)
+    return model
+
+
+def _incidence_matrix(rows, columns, shape):
+    """Builds a 0/1 matrix, counting duplicate entries once."""
+    matrix = scipy.sparse.coo_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+            shape=shape).tocsr()
+    matrix.data[:] = 1
+    return matrix
+
+
+def _binary_csr_matrix(indices, indptr, shape):
+    data = numpy.ones(len(indices), dtype=numpy.int32)
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (artist, track_id, k, metric, output_format, library_path, use_cache,
+                profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    logger.info('Opening iTunes library...')
+    lib = pytunes.Library(library_path)
+    model = get_model(lib, DEFAULT_CACHE_DIR if use_cache else None)
+    if artist is not None:
+        results = [{'artist': a, 'score': score}
+                   for a, score in model.similar_artists(artist, k, metric)]
+    else:
+        tracks_by_id = dict((t.id, t) for t in lib.tracks)
+        results = []
+        for similar_id, score in model.similar_tracks(track_id, k, metric):
+            track = tracks_by_id.get(similar_id)
+            results.append({
+                'id': similar_id,
+                'artist': track.artist if track else None,
+                'name': track.name if track else None,
+                'score': score,
+            })
+
+    if output_format == 'json':
+        print simplejson.dumps(results, indent=2)
+    else:
+        for result in results:
+            if 'id' in result:
+                line = u'%.3f %s - %s' % (
+                        result['score'], result['artist'], result['name'])
+            else:
+                line = u'%.3f %s' % (result['score'], result['artist'])
+            print line.encode('utf-8')
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
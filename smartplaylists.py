@@ -0,0 +1,703 @@
+#!/usr/bin/python
+
+"""Decodes and evaluates iTunes smart playlists.
+
+iTunes stores the settings of a smart playlist in two binary blobs:
+
+    - Smart Info (92 bytes): live updating, whether the rules and the limit
+      are checked, the limit itself and whether only checked items match.
+    - Smart Criteria: an 'SLst' header (136 bytes; the number of rules at
+      8:12 and whether any instead of all rules must match at 12:16),
+      followed by the rules. Each rule is a 56 byte header (the field at 0:4,
+      the logic sign at 4, the operator at 5 and the length of the data at
+      52:56) and its data: UTF-16BE for strings, 68 bytes for numbers and
+      dates (the low value at 0:8 with its units at 8:16, the high value at
+      24:32 with its units at 32:40).
+
+The rules are compiled into predicates, and many smart playlists are
+evaluated together: each distinct rule is evaluated once, vectorized on a
+tracktable.TrackTable where the table has the field, and the remaining rules
+are evaluated in a single pass over the tracks.
+
+Requires NumPy.
+"""
+
+import datetime
+import getopt
+import logging
+import struct
+import sys
+
+import numpy
+
+import profiling
+import pytunes
+import tracktable
+
+LOG_FORMAT = '%(message)s'
+
+# The field types.
+STRING = 'string'
+INTEGER = 'integer'
+BOOLEAN = 'boolean'
+DATE = 'date'
+
+# The supported fields: code, Track attribute and type.
+FIELDS = {
+    0x02: ('name', STRING),
+    0x03: ('album', STRING),
+    0x04: ('artist', STRING),
+    0x05: ('bit_rate', INTEGER),
+    0x06: ('sample_rate', INTEGER),
+    0x07: ('year', INTEGER),
+    0x08: ('genre', STRING),
+    0x09: ('kind', STRING),
+    0x0a: ('date_modified', DATE),
+    0x0b: ('number', INTEGER),
+    0x0c: ('size', INTEGER),
+    0x0d: ('total_time', INTEGER),
+    0x10: ('date_added', DATE),
+    0x12: ('composer', STRING),
+    0x16: ('play_count', INTEGER),
+    0x17: ('play_date_utc', DATE),
+    0x19: ('rating', INTEGER),
+    0x39: ('podcast', BOOLEAN),
+    0x44: ('skip_count', INTEGER),
+    0x47: ('album_artist', STRING),
+}
+FIELD_CODES = dict((name, code) for code, (name, _) in FIELDS.iteritems())
+
+# The operators and their codes. in_the_last has no code of its own, it is a
+# date range starting at a marker value.
+OPERATORS = {
+    'is': 0x01,
+    'contains': 0x02,
+    'starts': 0x04,
+    'ends': 0x08,
+    'gt': 0x10,
+    'in_range': 0x20,
+    'lt': 0x40,
+}
+IN_THE_LAST = 'in_the_last'
+OPERATOR_NAMES = dict((code, name) for name, code in OPERATORS.iteritems())
+
+# The largest value iTunes uses as an open end of a range.
+MAX_VALUE = 0x7fffffff
+
+_SMART_INFO_SIZE = 92
+_CRITERIA_HEADER_SIZE = 136
+_RULE_HEADER_SIZE = 56
+_NUMBER_DATA_SIZE = 68
+_SIGN_STRING = 0x01
+_SIGN_NEGATED = 0x02
+_IN_THE_LAST_MARKER = 0x2dae2dae2dae2dae
+# Seconds between the Mac OS epoch (1904) and the Unix epoch (1970).
+_MAC_EPOCH_OFFSET = 2082844800
+_UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+
+class Usage(Exception):
+    """Usage: smartplaylists.py
+    [-h|--help]          This screen.
+    [-l|--library PATH]  The iTunes library XML. Defaults to the user's.
+    [-v|--verbose]       List the differing tracks.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+
+    Evaluates all smart playlists and checks them against the playlist items
+    iTunes wrote.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    library_path = None
+    verbose = False
+    profile_path = None
+
+    options = 'hl:vp:'
+    options_long = ['help', 'library=', 'verbose', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+    except getopt.error, msg:
+        raise Usage(msg)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            raise Usage()
+        if opt in ('-l', '--library'):
+            library_path = arg
+        if opt in ('-v', '--verbose'):
+            verbose = True
+        if opt in ('-p', '--profile'):
+            profile_path = arg
+
+    return library_path, verbose, profile_path
+
+
+class SmartInfo(object):
+    """The settings of a smart playlist besides its rules."""
+
+    def __init__(
+            self, live_update=True, check_rules=True, check_limits=False,
+            limit_type=0, limit_sort=0, limit_value=0,
+            match_checked_only=False):
+        self.live_update = live_update
+        self.check_rules = check_rules
+        self.check_limits = check_limits
+        self.limit_type = limit_type
+        self.limit_sort = limit_sort
+        self.limit_value = limit_value
+        self.match_checked_only = match_checked_only
+
+
+class SmartRule(object):
+    """A rule of a smart playlist."""
+
+    def __init__(
+            self, field_code, operator_name, value, high=None,
+            negated=False, units=1):
+        """Creates a new SmartRule.
+
+        @param field_code: The field code, see FIELDS.
+        @type field_code: int
+        @param operator_name: The operator, see OPERATORS, or IN_THE_LAST.
+        @type operator_name: str
+        @param value: The value to compare to: a unicode for string fields,
+                an int for numbers, a datetime for dates, the number of units
+                for in_the_last, and the low end for ranges.
+        @param high: The high end for ranges.
+        @param negated: Whether the rule is negated (is not, does not
+                contain, ...).
+        @type negated: bool
+        @param units: The seconds per unit for in_the_last.
+        @type units: int
+        """
+        self.field_code = field_code
+        self.operator_name = operator_name
+        self.value = value
+        self.high = high
+        self.negated = negated
+        self.units = units
+
+    @property
+    def field(self):
+        """The Track attribute of the field, or None if unsupported."""
+        return FIELDS.get(self.field_code, (None, None))[0]
+
+    @property
+    def type(self):
+        return FIELDS.get(self.field_code, (None, None))[1]
+
+    @property
+    def is_supported(self):
+        if self.type is None:
+            return False
+        if self.operator_name is None:
+            return False
+        if self.type == STRING:
+            return self.operator_name in ('is', 'contains', 'starts', 'ends')
+        if self.operator_name == IN_THE_LAST:
+            return self.type == DATE
+        return self.operator_name in ('is', 'gt', 'lt', 'in_range')
+
+    def compile(self, now=None):
+        """Compiles the rule into a predicate on the value of its field.
+
+        @param now: The time in_the_last is relative to. Optional. Defaults
+                to now.
+        @type now: datetime.datetime
+        @rtype: function(object)
+        """
+        if not self.is_supported:
+            raise ValueError('Unsupported rule: %s' % self)
+        if self.type == STRING:
+            match = _compile_string_match(
+                    self.operator_name, _fold(self.value))
+            predicate = lambda value: match(_fold(value or u''))
+        elif self.type == DATE:
+            low, high = self._get_date_range(now)
+            if self.operator_name == 'is':
+                # Dates are the same if they are on the same day.
+                predicate = lambda value: (
+                        value is not None and value.date() == low.date())
+            else:
+                predicate = lambda value: (
+                        value is not None and low <= value <= high)
+        else:
+            low, high = self._get_int_range()
+            predicate = lambda value: low <= (value or 0) <= high
+        if self.negated:
+            return lambda value: not predicate(value)
+        return predicate
+
+    def _get_int_range(self):
+        """Returns the inclusive range of matching values."""
+        if self.operator_name == 'is':
+            return self.value, self.value
+        if self.operator_name == 'gt':
+            return self.value + 1, sys.maxint
+        if self.operator_name == 'lt':
+            return -sys.maxint - 1, self.value - 1
+        return self.value, self.high
+
+    def _get_date_range(self, now=None):
+        """Returns the inclusive range of matching dates."""
+        one_second = datetime.timedelta(seconds=1)
+        if self.operator_name == IN_THE_LAST:
+            now = now or datetime.datetime.utcnow()
+            since = now - datetime.timedelta(
+                    seconds=self.value * self.units)
+            return since, datetime.datetime.max
+        if self.operator_name == 'is':
+            return self.value, self.value
+        if self.operator_name == 'gt':
+            return self.value + one_second, datetime.datetime.max
+        if self.operator_name == 'lt':
+            return datetime.datetime.min, self.value - one_second
+        return self.value, self.high
+
+    def _key(self):
+        return (self.field_code, self.operator_name, self.value, self.high,
+                self.negated, self.units)
+
+    def __eq__(self, other):
+        return isinstance(other, SmartRule) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __unicode__(self):
+        if self.high is not None:
+            value = u'%s..%s' % (self.value, self.high)
+        else:
+            value = unicode(self.value)
+        return u'%s %s%s %s' % (
+                self.field or '0x%02x' % self.field_code,
+                'not ' if self.negated else '', self.operator_name, value)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class SmartCriteria(object):
+    """The rules of a smart playlist."""
+
+    def __init__(self, rules, match_any=False):
+        """Creates a new SmartCriteria.
+
+        @type rules: [SmartRule]
+        @param match_any: Whether any rule must match, instead of all.
+        @type match_any: bool
+        """
+        self.rules = rules
+        self.match_any = match_any
+
+    @property
+    def is_supported(self):
+        return all(rule.is_supported for rule in self.rules)
+
+
+class SmartPlaylistCheck(object):
+    """The result of checking a smart playlist against its items."""
+
+    def __init__(self, playlist, problem=None, missing=(), extra=()):
+        """Creates a new SmartPlaylistCheck.
+
+        @param problem: Why the playlist couldn't be checked, if it
+                couldn't.
+        @type problem: str
+        @param missing: The items that the rules don't match.
+        @type missing: [Track]
+        @param extra: The tracks that the rules match but aren't items.
+        @type extra: [Track]
+        """
+        self.playlist = playlist
+        self.problem = problem
+        self.missing = list(missing)
+        self.extra = list(extra)
+
+    @property
+    def matches(self):
+        return self.problem is None and not self.missing and not self.extra
+
+    def __unicode__(self):
+        if self.problem:
+            status = u'not checked (%s)' % self.problem
+        elif self.matches:
+            status = u'OK'
+        else:
+            status = u'%d missing, %d extra' % (
+                    len(self.missing), len(self.extra))
+        return u'%s: %s' % (self.playlist.name, status)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class SmartPlaylistEvaluator(object):
+    """Evaluates many smart criteria on the same tracks at once."""
+
+    def __init__(self, tracks, now=None):
+        """Creates a new SmartPlaylistEvaluator.
+
+        @type tracks: iterable(Track)
+        @param now: The time in_the_last rules are relative to. Optional.
+                Defaults to now.
+        @type now: datetime.datetime
+        """
+        self.table = tracktable.TrackTable.from_tracks(tracks)
+        self.now = now or datetime.datetime.utcnow()
+
+    @profiling.profiled('smartplaylists.evaluate')
+    def evaluate(self, criteria_list):
+        """Evaluates some criteria.
+
+        Each distinct rule is only evaluated once, no matter how many
+        criteria it is part of.
+
+        @type criteria_list: [SmartCriteria]
+        @return: The matching tracks of each criteria, in order.
+        @rtype: [[Track]]
+        """
+        rules = set(rule for c in criteria_list for rule in c.rules)
+        masks = {}
+        scanned_rules = []
+        for rule in rules:
+            mask = self._get_vectorized_mask(rule)
+            if mask is None:
+                scanned_rules.append(rule)
+            else:
+                masks[rule] = mask
+        masks.update(self._scan(scanned_rules))
+
+        results = []
+        for criteria in criteria_list:
+            rule_masks = [masks[rule] for rule in criteria.rules]
+            if not rule_masks:
+                mask = numpy.ones(len(self.table), dtype=numpy.bool_)
+            elif criteria.match_any:
+                mask = numpy.logical_or.reduce(rule_masks)
+            else:
+                mask = numpy.logical_and.reduce(rule_masks)
+            results.append(self.table.get_tracks(mask))
+        return results
+
+    def _get_vectorized_mask(self, rule):
+        """Evaluates a rule on the table, if the table has its field."""
+        field = rule.field
+        if field in tracktable.STRING_FIELDS:
+            return self.table.where(field, rule.compile(self.now))
+        if field in tracktable.BOOLEAN_FIELDS:
+            column = self.table.column(field).astype(numpy.int64)
+        elif field in tracktable.NUMERIC_FIELDS and rule.type != DATE:
+            column = self.table.column(field)
+        elif field == 'date_added' and rule.operator_name != 'is':
+            # Missing dates are stored as 0 and never match.
+            column = self.table.column(field)
+            low, high = [
+                    _to_timestamp(d) for d in rule._get_date_range(self.now)]
+            mask = (column != 0) & (column >= low) & (column <= high)
+            return ~mask if rule.negated else mask
+        else:
+            return None
+        low, high = rule._get_int_range()
+        mask = (column >= low) & (column <= high)
+        return ~mask if rule.negated else mask
+
+    def _scan(self, rules):
+        """Evaluates some rules in one pass over the tracks."""
+        if not rules:
+            return {}
+        checks = [(rule.field, rule.compile(self.now)) for rule in rules]
+        results = [[] for _ in rules]
+        for track in self.table.tracks:
+            for (field, predicate), result in zip(checks, results):
+                result.append(predicate(getattr(track, field)))
+        return dict(
+                (rule, numpy.array(result, dtype=numpy.bool_))
+                for rule, result in zip(rules, results))
+
+
+def decode_smart_info(data):
+    """Decodes a Smart Info blob.
+
+    @type data: str or plistlib.Data
+    @rtype: SmartInfo
+    """
+    data = bytearray(_get_bytes(data))
+    if len(data) < 14:
+        raise ValueError('Smart Info too short: %d bytes' % len(data))
+    return SmartInfo(
+            live_update=bool(data[1]),
+            check_rules=bool(data[2]),
+            check_limits=bool(data[3]),
+            limit_type=data[4],
+            limit_sort=data[5],
+            limit_value=struct.unpack('>I', str(data[8:12]))[0],
+            match_checked_only=bool(data[12]))
+
+
+def encode_smart_info(info):
+    """Encodes a Smart Info blob.
+
+    @type info: SmartInfo
+    @rtype: str
+    """
+    data = bytearray(_SMART_INFO_SIZE)
+    data[1] = int(info.live_update)
+    data[2] = int(info.check_rules)
+    data[3] = int(info.check_limits)
+    data[4] = info.limit_type
+    data[5] = info.limit_sort
+    data[8:12] = struct.pack('>I', info.limit_value)
+    data[12] = int(info.match_checked_only)
+    return str(data)
+
+
+def decode_smart_criteria(data):
+    """Decodes a Smart Criteria blob.
+
+    Rules on unknown fields or with unknown operators are decoded as well,
+    but aren't supported by SmartRule.compile.
+
+    @type data: str or plistlib.Data
+    @rtype: SmartCriteria
+    """
+    data = _get_bytes(data)
+    if len(data) < _CRITERIA_HEADER_SIZE or data[0:4] != 'SLst':
+        raise ValueError('Not a Smart Criteria blob')
+    num_rules, match_any = struct.unpack('>II', data[8:16])
+    rules = []
+    offset = _CRITERIA_HEADER_SIZE
+    for _ in xrange(num_rules):
+        header = data[offset:offset + _RULE_HEADER_SIZE]
+        if len(header) < _RULE_HEADER_SIZE:
+            raise ValueError('Smart Criteria truncated')
+        field_code = struct.unpack('>I', header[0:4])[0]
+        sign, operator_code = ord(header[4]), ord(header[5])
+        length = struct.unpack('>I', header[52:56])[0]
+        offset += _RULE_HEADER_SIZE
+        value_data = data[offset:offset + length]
+        offset += length
+        rules.append(_decode_rule(
+                field_code, sign, operator_code, value_data))
+    return SmartCriteria(rules, bool(match_any))
+
+
+def encode_smart_criteria(criteria):
+    """Encodes a Smart Criteria blob.
+
+    @type criteria: SmartCriteria
+    @rtype: str
+    """
+    header = bytearray(_CRITERIA_HEADER_SIZE)
+    header[0:4] = 'SLst'
+    header[4:8] = struct.pack('>I', 0x00010001)
+    header[8:12] = struct.pack('>I', len(criteria.rules))
+    header[12:16] = struct.pack('>I', 1 if criteria.match_any else 0)
+    parts = [str(header)]
+    for rule in criteria.rules:
+        is_string = rule.type == STRING
+        sign = _SIGN_STRING if is_string else 0
+        if rule.negated:
+            sign |= _SIGN_NEGATED
+        if is_string:
+            value_data = rule.value.encode('utf-16-be')
+        elif rule.operator_name == IN_THE_LAST:
+            value_data = _encode_number_data(
+                    _IN_THE_LAST_MARKER, 1, -rule.value, rule.units)
+        else:
+            low, high = rule.value, rule.high
+            if high is None:
+                high = low
+            if rule.type == DATE:
+                low, high = _to_mac_time(low), _to_mac_time(high)
+            value_data = _encode_number_data(low, 1, high, 1)
+        header = bytearray(_RULE_HEADER_SIZE)
+        header[0:4] = struct.pack('>I', rule.field_code)
+        header[4] = sign
+        header[5] = OPERATORS.get(rule.operator_name, OPERATORS['in_range'])
+        header[52:56] = struct.pack('>I', len(value_data))
+        parts.append(str(header))
+        parts.append(value_data)
+    return ''.join(parts)
+
+
+def get_smart_playlists(playlists):
+    """Filters the smart playlists.
+
+    @rtype: [Playlist]
+    """
+    return filter(lambda p: p.smart_criteria is not None, playlists)
+
+
+def check_smart_playlists(playlists, tracks, now=None):
+    """Evaluates smart playlists and compares them with their items.
+
+    The items are what iTunes evaluated when it wrote the library. Playlists
+    with a limit, restricted to checked items or with unsupported rules can't
+    be checked.
+
+    @param playlists: The smart playlists.
+    @type playlists: [Playlist]
+    @param tracks: All tracks of the library.
+    @type tracks: iterable(Track)
+    @rtype: [SmartPlaylistCheck]
+    """
+    checks = []
+    evaluated_playlists = []
+    criteria_list = []
+    for playlist in playlists:
+        try:
+            info = decode_smart_info(playlist.smart_info)
+            criteria = decode_smart_criteria(playlist.smart_criteria)
+        except ValueError, e:
+            checks.append(SmartPlaylistCheck(playlist, str(e)))
+            continue
+        if info.check_limits:
+            checks.append(SmartPlaylistCheck(playlist, 'limited'))
+        elif info.match_checked_only:
+            checks.append(SmartPlaylistCheck(playlist, 'checked items only'))
+        elif info.check_rules and not criteria.is_supported:
+            checks.append(SmartPlaylistCheck(playlist, 'unsupported rules'))
+        else:
+            if not info.check_rules:
+                # Without rules, every track matches.
+                criteria = SmartCriteria([])
+            checks.append(None)
+            evaluated_playlists.append(playlist)
+            criteria_list.append(criteria)
+
+    evaluator = SmartPlaylistEvaluator(tracks, now)
+    results = iter(zip(
+            evaluated_playlists, evaluator.evaluate(criteria_list)))
+    for i, check in enumerate(checks):
+        if check is not None:
+            continue
+        playlist, matching_tracks = next(results)
+        items = list(playlist.items)
+        item_set = set(items)
+        matching_set = set(matching_tracks)
+        checks[i] = SmartPlaylistCheck(
+                playlist,
+                missing=[t for t in items if t not in matching_set],
+                extra=[t for t in matching_tracks if t not in item_set])
+    return checks
+
+
+def _decode_rule(field_code, sign, operator_code, value_data):
+    negated = bool(sign & _SIGN_NEGATED)
+    operator_name = OPERATOR_NAMES.get(operator_code)
+    if sign & _SIGN_STRING:
+        return SmartRule(
+                field_code, operator_name, value_data.decode('utf-16-be'),
+                negated=negated)
+    if len(value_data) < 40:
+        return SmartRule(field_code, None, None, negated=negated)
+    low, low_units = struct.unpack('>qq', value_data[0:16])
+    high, high_units = struct.unpack('>qq', value_data[24:40])
+    field_type = FIELDS.get(field_code, (None, None))[1]
+    if field_type == DATE and low == _IN_THE_LAST_MARKER:
+        return SmartRule(
+                field_code, IN_THE_LAST, -high, negated=negated,
+                units=high_units)
+    if field_type == DATE:
+        low, high = _from_mac_time(low), _from_mac_time(high)
+    if operator_name != 'in_range':
+        high = None
+    return SmartRule(field_code, operator_name, low, high, negated)
+
+
+def _encode_number_data(low, low_units, high, high_units):
+    data = bytearray(_NUMBER_DATA_SIZE)
+    data[0:16] = struct.pack('>qq', low, low_units)
+    data[24:40] = struct.pack('>qq', high, high_units)
+    return str(data)
+
+
+def _compile_string_match(operator_name, value):
+    if operator_name == 'is':
+        return lambda s: s == value
+    if operator_name == 'contains':
+        return lambda s: value in s
+    if operator_name == 'starts':
+        return lambda s: s.startswith(value)
+    return lambda s: s.endswith(value)
+
+
+def _fold(value):
+    # iTunes compares strings case insensitively.
+    return value.lower()
+
+
+def _get_bytes(data):
+    # plistlib wraps <data> in a plistlib.Data.
+    return getattr(data, 'data', data)
+
+
+def _from_mac_time(seconds):
+    return _UNIX_EPOCH + datetime.timedelta(
+            seconds=seconds - _MAC_EPOCH_OFFSET)
+
+
+def _to_mac_time(date):
+    return _to_timestamp(date) + _MAC_EPOCH_OFFSET
+
+
+def _to_timestamp(date):
+    if date == datetime.datetime.max:
+        return sys.maxint
+    if date == datetime.datetime.min:
+        return -sys.maxint - 1
+    delta = date - _UNIX_EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        library_path, verbose, profile_path = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    logger.info('Opening iTunes library...')
+    lib = pytunes.Library(library_path)
+    logger.info('Checking smart playlists...')
+    checks = check_smart_playlists(
+            get_smart_playlists(lib.playlists), lib.tracks)
+    for check in checks:
+        print unicode(check).encode('utf-8')
+        if verbose:
+            for track in check.missing:
+                print (u'  missing: %s' % track).encode('utf-8')
+            for track in check.extra:
+                print (u'  extra: %s' % track).encode('utf-8')
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
+
+    if not all(c.matches or c.problem for c in checks):
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
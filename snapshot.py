@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+"""An on-disk snapshot cache of parsed iTunes libraries.
+
+Parsing the library XML is by far the most expensive part of opening a
+library. A snapshot stores the parsed track and playlist dicts in a small
+SQLite database, which is used instead of the XML as long as the size,
+modification time and content hash of the XML are unchanged.
+"""
+
+import contextlib
+import cPickle
+import hashlib
+import os
+import os.path
+import sqlite3
+import tempfile
+
+import profiling
+
+DEFAULT_SNAPSHOT_DIR = os.path.expanduser('~/.pytunes/snapshots')
+
+# Bump this whenever the layout of the snapshot changes.
+_FORMAT_VERSION = 3
+_HASH_BLOCK_SIZE = 1 << 20
+# The maximum number of keys per query, below SQLite's limit of 999
+# parameters.
+_MAX_QUERY_KEYS = 500
+
+
+class Snapshot(object):
+    """A snapshot of one library XML.
+
+    Provides the same iter_tracks, iter_playlists and get_playlist interface
+    as pytunes.PlistReader. The rows are read lazily, one at a time. Unlike
+    the XML, single tracks and playlists can be read without reading all.
+    """
+
+    def __init__(self, source_path, snapshot_dir=None):
+        """Creates a new Snapshot.
+
+        @param source_path: The path to the library XML.
+        @type source_path: str
+        @param snapshot_dir: The directory to keep the snapshots in. Optional.
+                Defaults to ~/.pytunes/snapshots.
+        @type snapshot_dir: str
+        """
+        self.source_path = os.path.abspath(source_path)
+        self.snapshot_dir = snapshot_dir or DEFAULT_SNAPSHOT_DIR
+        path_hash = hashlib.sha1(_encode(self.source_path)).hexdigest()
+        self.path = os.path.join(self.snapshot_dir, path_hash + '.sqlite')
+        self._fingerprint = None
+
+    def is_current(self):
+        """Checks whether the snapshot matches the library XML.
+
+        The content hash is only computed when size and modification time
+        match.
+
+        @rtype: bool
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            meta = self._read_meta()
+        except sqlite3.Error:
+            return False
+        stat = os.stat(self.source_path)
+        if (meta.get('version') != str(_FORMAT_VERSION) or
+            meta.get('size') != str(stat.st_size) or
+            meta.get('mtime') != repr(stat.st_mtime)):
+            return False
+        return meta.get('hash') == self._get_fingerprint()[2]
+
+    def build(self, reader):
+        """(Re)builds the snapshot.
+
+        The snapshot is written to a temporary file first and then moved into
+        place, so readers never see a partially written snapshot.
+
+        @param reader: The reader to take the tracks and playlists from.
+        @type reader: pytunes.PlistReader
+        """
+        size, mtime, content_hash = self._get_fingerprint()
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        fd, tmp_path = tempfile.mkstemp(
+                suffix='.tmp', dir=self.snapshot_dir)
+        os.close(fd)
+        try:
+            with contextlib.closing(sqlite3.connect(tmp_path)) as conn:
+                conn.execute(
+                        'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                conn.execute(
+                        'CREATE TABLE tracks (key TEXT PRIMARY KEY, item BLOB)')
+                conn.execute(
+                        'CREATE TABLE playlists '
+                        '(playlist_id INTEGER, name TEXT, item BLOB)')
+                conn.executemany(
+                        'INSERT INTO tracks VALUES (?, ?)',
+                        ((key, _dump(item))
+                         for key, item in reader.iter_tracks()))
+                conn.executemany(
+                        'INSERT INTO playlists VALUES (?, ?, ?)',
+                        ((item.get('Playlist ID'), item.get('Name'),
+                          _dump(item))
+                         for item in reader.iter_playlists()))
+                # Indexed after inserting, which is faster than keeping the
+                # indexes up to date on every insert.
+                conn.execute(
+                        'CREATE INDEX playlists_playlist_id '
+                        'ON playlists (playlist_id)')
+                conn.execute(
+                        'CREATE INDEX playlists_name ON playlists (name)')
+                conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                    ('version', str(_FORMAT_VERSION)),
+                    ('source', _encode(self.source_path)),
+                    ('size', str(size)),
+                    ('mtime', repr(mtime)),
+                    ('hash', content_hash),
+                ])
+                conn.commit()
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def invalidate(self):
+        """Deletes the snapshot, so it will be rebuilt on next use."""
+        self._fingerprint = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @profiling.profiled('snapshot.load_tracks')
+    def iter_tracks(self):
+        """Reads the tracks from the snapshot.
+
+        @return: Yields the track keys and their plist dicts.
+        @rtype: generator((str, dict))
+        """
+        rows = self._query('SELECT key, item FROM tracks ORDER BY rowid')
+        for key, item in rows:
+            yield str(key), cPickle.loads(str(item))
+
+    @profiling.profiled('snapshot.load_playlists')
+    def iter_playlists(self):
+        """Reads the playlists from the snapshot.
+
+        @return: Yields the plist dicts of the playlists.
+        @rtype: generator(dict)
+        """
+        rows = self._query('SELECT item FROM playlists ORDER BY rowid')
+        for item, in rows:
+            yield cPickle.loads(str(item))
+
+    def get_playlist(self, name=None, playlist_id=None):
+        """Reads the first playlist with a name or ID from the snapshot.
+
+        Only the matching playlist is unpickled.
+
+        @return: The plist dict of the playlist, or None if there is no such
+                playlist.
+        @rtype: dict
+        """
+        if playlist_id is not None:
+            rows = self._query(
+                    'SELECT item FROM playlists WHERE playlist_id = ? '
+                    'ORDER BY rowid LIMIT 1', (playlist_id,))
+        else:
+            rows = self._query(
+                    'SELECT item FROM playlists WHERE name = ? '
+                    'ORDER BY rowid LIMIT 1', (name,))
+        for item, in rows:
+            return cPickle.loads(str(item))
+        return None
+
+    def get_tracks(self, keys):
+        """Reads some tracks from the snapshot.
+
+        @param keys: The keys of the tracks in the Tracks section.
+        @type keys: [str]
+        @return: Yields the keys of the tracks found and their plist dicts,
+                in no particular order.
+        @rtype: generator((str, dict))
+        """
+        keys = list(keys)
+        for start in xrange(0, len(keys), _MAX_QUERY_KEYS):
+            chunk = keys[start:start + _MAX_QUERY_KEYS]
+            rows = self._query(
+                    'SELECT key, item FROM tracks WHERE key IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk)
+            for key, item in rows:
+                yield str(key), cPickle.loads(str(item))
+
+    def get_track(self, key):
+        """Reads a single track from the snapshot.
+
+        @param key: The key of the track in the Tracks section.
+        @type key: str
+        @return: The plist dict of the track, or None if there is no such
+                track.
+        @rtype: dict
+        """
+        rows = self._query('SELECT item FROM tracks WHERE key = ?', (key,))
+        for item, in rows:
+            return cPickle.loads(str(item))
+        return None
+
+    def _read_meta(self):
+        return dict(self._query('SELECT key, value FROM meta'))
+
+    def _query(self, sql, params=()):
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            for row in conn.execute(sql, params):
+                yield row
+
+    def _get_fingerprint(self):
+        if self._fingerprint is None:
+            stat = os.stat(self.source_path)
+            content_hash = hashlib.sha1()
+            with open(self.source_path, 'rb') as f:
+                while True:
+                    block = f.read(_HASH_BLOCK_SIZE)
+                    if not block:
+                        break
+                    content_hash.update(block)
+            self._fingerprint = (
+                    stat.st_size, stat.st_mtime, content_hash.hexdigest())
+        return self._fingerprint
+
+    def __unicode__(self):
+        return 'Snapshot(%s)' % self.path
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _dump(item):
+    return buffer(cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL))
+
+
+def _encode(path):
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
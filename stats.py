@@ -3,100 +3,310 @@
 """A tool to run stats over your iTunes library."""
 
 import collections
+import getopt
 import logging
 import os
 import os.path
+import sys
+
+import simplejson
 
 import analysis
+import pipeline
+import profiling
 import pytunes
+import reports
+import serverclient
 
 LOG_FORMAT = '%(message)s'
+FORMATS = ('text', 'json')
 
 logger = logging.getLogger(__name__)
 
 
-def print_incompletely_rated_albums(albums):
-    print 'Incompletely rated albums:'
-    incompletely_rated_albums = analysis.find_incompletely_rated_albums(albums)
-    albums_sorted_by_completeness = sorted(
-            incompletely_rated_albums, key=lambda a: a.rating_completeness)
-    for album in albums_sorted_by_completeness:
-        print unicode(album).encode('utf-8')
-    print
-
-
-def print_best_albums(albums, n=50):
-    print '%d best rated albums (by average rating):' % n
-    completely_rated_albums = analysis.find_completely_rated_albums(albums)
-    albums_sorted_by_rating = sorted(
-            completely_rated_albums, key=lambda a: a.avg_rating)
-    for album in reversed(albums_sorted_by_rating[-n:]):
-        print unicode(album).encode('utf-8')
-    print
-
-
-def print_worst_albums(albums, n=50):
-    print '%d worst rated albums (by average rating):' % n
-    completely_rated_albums = analysis.find_completely_rated_albums(albums)
-    albums_sorted_by_rating = sorted(
-            completely_rated_albums, key=lambda a: a.avg_rating)
-    for album in albums_sorted_by_rating[:n]:
-        print unicode(album).encode('utf-8')
-    print
-
-
-def print_duplicates(tracks, tolerated_time_difference=10):
-    print 'Duplicates:'
-    duplicates = analysis.find_duplicates(tracks, tolerated_time_difference)
-    sorted_duplicates = sorted(
-            duplicates, key=lambda t: '%s-%s' % (t.artist, t.name))
-    for track in sorted_duplicates:
-        print unicode(track).encode('utf-8')
-
-
-def print_favorite_bands(songs, n=50):
-    print '%d favorite bands (by number of tracks in the library):' % n
-    counter = collections.Counter()
-    counter.update([t.artist for t in songs])
-    for artist, count in counter.most_common(n):
-        print '%s - %d' % (unicode(artist).encode('utf-8'), count)
-    print
-
-
-def print_best_bands(songs, min_rating, n=50):
-    print '%d best bands (by number of highly rated tracks):' % n
-    good_tracks = filter(lambda t: t.rating >= min_rating, songs)
-    counter = collections.Counter()
-    counter.update([t.artist for t in good_tracks])
-    for artist, count in counter.most_common(n):
-        print '%s - %d' % (unicode(artist).encode('utf-8'), count)
-    print
-
-
-def main():
-    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+class Usage(Exception):
+    """Usage: stats.py
+    [-h|--help]          This screen.
+    [-f|--format FORMAT] The output format: text (default) or json.
+    [-l|--library PATH]  The iTunes library XML. Defaults to the user's.
+    [-w|--workers N]     The number of processes parsing the library XML.
+                         Defaults to 1.
+    [--server ADDRESS]   Ask the library server at ADDRESS (e.g.
+                         localhost:8752) instead of loading the library, if
+                         it is running.
+    [-p|--profile PATH]  Write a profile of the run to PATH, as collapsed
+                         stacks if it ends with .folded, as JSON otherwise.
+    """
+    def __init__(self, msg=''):
+        self.msg = msg
+
+    def __str__(self):
+        return '\n'.join((self.__doc__, str(self.msg)))
+
+
+def _parse_args(argv):
+    output_format = 'text'
+    library_path = None
+    workers = 1
+    server_address = None
+    profile_path = None
+
+    options = 'hf:l:w:p:'
+    options_long = [
+            'help', 'format=', 'library=', 'workers=', 'server=', 'profile=']
+    try:
+        opts, args = getopt.getopt(argv[1:], options, options_long)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                raise Usage()
+            if opt in ('-f', '--format'):
+                output_format = arg
+            if opt in ('-l', '--library'):
+                library_path = arg
+            if opt in ('-w', '--workers'):
+                workers = int(arg)
+            if opt == '--server':
+                server_address = arg
+                serverclient.parse_address(server_address)
+            if opt in ('-p', '--profile'):
+                profile_path = arg
+    except (getopt.error, ValueError), msg:
+        raise Usage(msg)
+
+    if output_format not in FORMATS:
+        raise Usage('Unknown format: %s.' % output_format)
+    if workers < 1:
+        raise Usage('Need at least one worker.')
+
+    return output_format, library_path, workers, server_address, profile_path
+
+
+class IncompletelyRatedAlbumsReport(reports.Report):
+
+    title = 'Incompletely rated albums:'
+
+    def __init__(self):
+        self._albums = []
+
+    def add_album(self, album):
+        if album.rating_completeness < 1:
+            self._albums.append(album)
+
+    def get_results(self):
+        return sorted(self._albums, key=lambda a: a.rating_completeness)
+
+    def to_json(self, album):
+        return _album_to_json(album)
+
+
+class BestAlbumsReport(reports.Report):
+
+    def __init__(self, n=50):
+        self.title = '%d best rated albums (by average rating):' % n
+        self._top_albums = reports.TopN(n, key=lambda a: a.avg_rating)
+
+    def add_album(self, album):
+        if album.rating_completeness == 1:
+            self._top_albums.add(album)
+
+    def get_results(self):
+        return self._top_albums.get()
+
+    def to_json(self, album):
+        return _album_to_json(album)
+
+
+class WorstAlbumsReport(reports.Report):
+
+    def __init__(self, n=50):
+        self.title = '%d worst rated albums (by average rating):' % n
+        self._bottom_albums = reports.TopN(n, key=lambda a: -a.avg_rating)
+
+    def add_album(self, album):
+        if album.rating_completeness == 1:
+            self._bottom_albums.add(album)
+
+    def get_results(self):
+        return self._bottom_albums.get()
+
+    def to_json(self, album):
+        return _album_to_json(album)
+
+
+class DuplicatesReport(reports.Report):
+
+    title = 'Duplicates (best matches first):'
+
+    def __init__(self, tolerated_time_difference=10):
+        self._tolerated_time_difference = tolerated_time_difference
+        self._tracks = []
+
+    def add_track(self, track):
+        self._tracks.append(track)
+
+    def get_results(self):
+        return analysis.find_duplicate_clusters(
+                self._tracks, self._tolerated_time_difference)
+
+    def format_text(self, cluster):
+        lines = ['Score %0.2f:' % cluster.score]
+        lines.extend(u'  %s' % unicode(t) for t in cluster.tracks)
+        return u'\n'.join(lines)
 
-    logger.info('Opening iTunes library...')
-    lib = pytunes.Library()
-    logger.info('Loading all tracks...')
-    songs = filter(lambda t: not t.podcast, lib.tracks)
-    albums = list(pytunes.Album.group_tracks_into_albums(songs))
+    def to_json(self, cluster):
+        return {
+            'score': cluster.score,
+            'tracks': [_track_to_json(t) for t in cluster.tracks],
+        }
+
+
+class FavoriteBandsReport(reports.Report):
+
+    def __init__(self, n=50):
+        self.title = (
+                '%d favorite bands (by number of tracks in the library):' % n)
+        self._n = n
+        self._counter = collections.Counter()
+
+    def add_track(self, track):
+        self._counter[track.artist] += 1
+
+    def get_results(self):
+        return self._counter.most_common(self._n)
+
+    def format_text(self, item):
+        artist, count = item
+        return u'%s - %d' % (unicode(artist), count)
+
+    def to_json(self, item):
+        artist, count = item
+        return {'artist': artist, 'count': count}
+
+
+class BestBandsReport(FavoriteBandsReport):
+
+    def __init__(self, min_rating, n=50):
+        FavoriteBandsReport.__init__(self, n)
+        self.title = '%d best bands (by number of highly rated tracks):' % n
+        self._min_rating = min_rating
+
+    def add_track(self, track):
+        if track.rating >= self._min_rating:
+            self._counter[track.artist] += 1
+
+
+def run_reports(songs, albums):
+    """Runs all reports over the songs and their albums.
+
+    @param songs: The songs. Iterated once.
+    @type songs: iterable(Track)
+    @param albums: The albums of the songs. Albums with fewer than 8 tracks
+            are left out.
+    @type albums: [Album]
+    @return: The reports and their results.
+    @rtype: [(reports.Report, list)]
+    """
     albums = filter(lambda a: len(a.tracks) > 7, albums)
-    htgt = filter(lambda a: a.album == 'Here Today Gone Tomorrow', albums)[0]
-    dryrun = True
     n = 10
     min_rating = 80  # 4 stars.
-    min_good_tracks = 4
-    keep_good_tracks = True
     tolerated_time_difference = 10
 
-    print_best_albums(albums, n)
-    print_best_bands(songs, min_rating, n)
-    print_favorite_bands(songs, n)
-    print_worst_albums(albums, n)
-    print_incompletely_rated_albums(albums)
-    print_duplicates(songs, tolerated_time_difference)
+    engine = reports.ReportEngine()
+    engine.register(BestAlbumsReport(n))
+    engine.register(BestBandsReport(min_rating, n))
+    engine.register(FavoriteBandsReport(n))
+    engine.register(WorstAlbumsReport(n))
+    engine.register(IncompletelyRatedAlbumsReport())
+    engine.register(DuplicatesReport(tolerated_time_difference))
+    with profiling.phase('stats.reports'):
+        return engine.run(songs, albums)
+
+
+def print_results(results, output_format, out=None):
+    out = out or sys.stdout
+    with profiling.phase('stats.print'):
+        if output_format == 'json':
+            print_json(results, out)
+        else:
+            print_text(results, out)
+
+
+def print_text(results, out=None):
+    out = out or sys.stdout
+    for report, items in results:
+        print >>out, report.title
+        for item in items:
+            print >>out, report.format_text(item).encode('utf-8')
+        print >>out
+
+
+def print_json(results, out=None):
+    out = out or sys.stdout
+    print >>out, simplejson.dumps([
+        {
+            'title': report.title,
+            'results': [report.to_json(item) for item in items],
+        }
+        for report, items in results
+    ], indent=2)
+
+
+def _album_to_json(album):
+    return {
+        'artist': album.artist,
+        'year': album.year,
+        'album': album.album,
+        'avg_rating': album.avg_rating,
+        'rating_completeness': album.rating_completeness,
+    }
+
+
+def _track_to_json(track):
+    return {'id': track.id, 'artist': track.artist, 'name': track.name}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        (output_format, library_path, workers, server_address,
+                profile_path) = _parse_args(argv)
+    except Usage, err:
+        print >>sys.stderr, err
+        return 2
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    if profile_path:
+        profiler = profiling.enable()
+
+    output = None
+    if server_address:
+        try:
+            output = serverclient.query(
+                    server_address, '/stats', library_path,
+                    format=output_format)
+        except serverclient.ServerError, e:
+            logger.error(e)
+            return 1
+
+    if output is not None:
+        sys.stdout.write(output)
+    else:
+        logger.info('Opening iTunes library...')
+        lib = pytunes.Library(library_path, workers=workers)
+        logger.info('Loading all tracks...')
+        songs = pipeline.Pipeline(lambda: lib.tracks).pipe(
+                pipeline.without_podcasts)
+        albums = list(songs.pipe(pipeline.group_albums))
+        print_results(run_reports(songs, albums), output_format)
+
+    if profile_path:
+        profiling.disable()
+        profiler.write(profile_path)
+        logger.info('Wrote the profile to %s.', profile_path)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+"""A columnar view of the tracks of an iTunes library.
+
+A TrackTable stores the tracks as a struct of arrays instead of a list of
+objects: numeric fields are NumPy arrays, string fields are dictionary
+encoded (an array of codes into a list of distinct values). This allows to
+filter, count and rank the tracks with vectorized operations instead of
+Python-level loops.
+
+Requires NumPy.
+"""
+
+import calendar
+
+import numpy
+
+# Missing numeric values are stored as 0, which sorts and compares like the
+# None they replace (e.g. an unrated track is never >= some rating).
+NUMERIC_FIELDS = (
+        'id', 'rating', 'play_count', 'skip_count', 'total_time', 'year',
+        'bit_rate', 'size', 'date_added')
+STRING_FIELDS = ('artist', 'album_artist', 'album', 'genre', 'kind', 'name')
+BOOLEAN_FIELDS = ('podcast',)
+
+
+class TrackTable(object):
+    """A struct of arrays holding the most commonly analyzed track fields.
+
+    Masks are boolean NumPy arrays with one entry per row. They can be
+    combined with &, | and ~ and passed to most methods to restrict them to
+    some rows.
+    """
+
+    def __init__(self, tracks, columns, values):
+        """Creates a new TrackTable. Use TrackTable.from_tracks instead.
+
+        @param tracks: The tracks, one per row.
+        @type tracks: [Track]
+        @param columns: The arrays, keyed by field name.
+        @type columns: {str: numpy.ndarray}
+        @param values: The distinct values of the string fields, indexed by
+                their codes, keyed by field name.
+        @type values: {str: [unicode]}
+        """
+        self.tracks = tracks
+        self._columns = columns
+        self._values = values
+        self._codes_by_value = {}
+
+    @staticmethod
+    def from_tracks(tracks):
+        """Builds a table from some tracks.
+
+        @type tracks: iterable(Track)
+        @rtype: TrackTable
+        """
+        tracks = list(tracks)
+        columns = {}
+        values = {}
+        for field in NUMERIC_FIELDS:
+            if field == 'date_added':
+                column = [_to_timestamp(t.date_added) for t in tracks]
+            else:
+                column = [getattr(t, field) or 0 for t in tracks]
+            columns[field] = numpy.array(column, dtype=numpy.int64)
+        for field in BOOLEAN_FIELDS:
+            column = [bool(getattr(t, field)) for t in tracks]
+            columns[field] = numpy.array(column, dtype=numpy.bool_)
+        for field in STRING_FIELDS:
+            # Code 0 is reserved for missing values.
+            field_values = [None]
+            codes_by_value = {None: 0}
+            codes = numpy.empty(len(tracks), dtype=numpy.int32)
+            for i, track in enumerate(tracks):
+                value = getattr(track, field)
+                code = codes_by_value.get(value)
+                if code is None:
+                    code = len(field_values)
+                    codes_by_value[value] = code
+                    field_values.append(value)
+                codes[i] = code
+            columns[field] = codes
+            values[field] = field_values
+        return TrackTable(tracks, columns, values)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def column(self, field):
+        """Returns the array of a field.
+
+        For string fields, these are the codes. Use decode to get the values.
+
+        @rtype: numpy.ndarray
+        """
+        return self._columns[field]
+
+    def decode(self, field, code):
+        """Returns the value of a code of a string field.
+
+        @rtype: unicode
+        """
+        return self._values[field][code]
+
+    def code(self, field, value):
+        """Returns the code of a value of a string field.
+
+        @return: The code, or -1 if the value doesn't occur in the table.
+        @rtype: int
+        """
+        codes_by_value = self._codes_by_value.get(field)
+        if codes_by_value is None:
+            codes_by_value = dict(
+                    (v, c) for c, v in enumerate(self._values[field]))
+            self._codes_by_value[field] = codes_by_value
+        return codes_by_value.get(value, -1)
+
+    def equals(self, field, value):
+        """Returns a mask of the rows where a field has some value.
+
+        @rtype: numpy.ndarray
+        """
+        if field in self._values:
+            return self._columns[field] == self.code(field, value)
+        return self._columns[field] == value
+
+    def isin(self, field, values):
+        """Returns a mask of the rows where a field has one of some values.
+
+        @type values: iterable
+        @rtype: numpy.ndarray
+        """
+        if field in self._values:
+            values = [self.code(field, v) for v in values]
+        else:
+            values = list(values)
+        return numpy.in1d(self._columns[field], values)
+
+    def where(self, field, predicate):
+        """Returns a mask of the rows where a predicate holds for a string
+        field.
+
+        The predicate is called once per distinct value (including None),
+        not once per row.
+
+        @type predicate: function(unicode)
+        @rtype: numpy.ndarray
+        """
+        matches = numpy.array(
+                [bool(predicate(v)) for v in self._values[field]],
+                dtype=numpy.bool_)
+        return matches[self._columns[field]]
+
+    def select(self, mask):
+        """Returns a new table with only the rows in the mask.
+
+        The new table shares the decoded string values with this one.
+
+        @rtype: TrackTable
+        """
+        indexes = numpy.flatnonzero(mask)
+        tracks = [self.tracks[i] for i in indexes]
+        columns = dict(
+                (field, column[indexes])
+                for field, column in self._columns.iteritems())
+        return TrackTable(tracks, columns, self._values)
+
+    def argsort(self, *fields):
+        """Returns the row indexes sorted by some fields.
+
+        String fields are sorted by their codes, i.e. equal values end up next
+        to each other, but not in alphabetical order.
+
+        @param fields: The fields to sort by, most significant first.
+        @rtype: numpy.ndarray
+        """
+        return numpy.lexsort([self._columns[f] for f in reversed(fields)])
+
+    def get_tracks(self, mask=None):
+        """Returns the tracks of the rows in the mask, or all of them.
+
+        @rtype: [Track]
+        """
+        if mask is None:
+            return list(self.tracks)
+        return [self.tracks[i] for i in numpy.flatnonzero(mask)]
+
+    def count_by(self, field, mask=None):
+        """Counts the rows per distinct value of a field.
+
+        @return: The values and their counts, most common first. Values that
+                don't occur in the (masked) rows are omitted.
+        @rtype: [(object, int)]
+        """
+        return self.most_common(field, None, mask)
+
+    def most_common(self, field, n, mask=None):
+        """Returns the n most common values of a field.
+
+        @param n: The number of values to return, or None for all of them.
+        @type n: int
+        @rtype: [(object, int)]
+        """
+        column = self._columns[field]
+        if mask is not None:
+            column = column[mask]
+        if field in self._values:
+            counts = numpy.bincount(
+                    column, minlength=len(self._values[field]))
+            keys = numpy.arange(len(counts))
+        else:
+            keys, counts = numpy.unique(column, return_counts=True)
+        nonzero = numpy.flatnonzero(counts)
+        keys, counts = keys[nonzero], counts[nonzero]
+        order = _top_indexes(counts, n)
+        if field in self._values:
+            values = self._values[field]
+            return [(values[keys[i]], int(counts[i])) for i in order]
+        return [(keys[i].item(), int(counts[i])) for i in order]
+
+    def top(self, field, n, mask=None):
+        """Returns the tracks with the n highest values of a numeric field.
+
+        @rtype: [Track]
+        """
+        rows = numpy.arange(len(self.tracks))
+        column = self._columns[field]
+        if mask is not None:
+            rows, column = rows[mask], column[mask]
+        return [self.tracks[rows[i]] for i in _top_indexes(column, n)]
+
+    def __unicode__(self):
+        return 'TrackTable(rows=%d)' % len(self.tracks)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _top_indexes(values, n):
+    """Returns the indexes of the n highest values, highest first.
+
+    Only the n highest values are sorted, the rest is partitioned away.
+    """
+    if n is None or n >= len(values):
+        candidates = numpy.arange(len(values))
+    elif n <= 0:
+        return []
+    else:
+        candidates = numpy.argpartition(-values, n - 1)[:n]
+    # Stable on the negated values, so ties keep their original order.
+    order = numpy.argsort(-values[candidates], kind='mergesort')
+    return candidates[order]
+
+
+def _to_timestamp(date):
+    if date is None:
+        return 0
+    return calendar.timegm(date.utctimetuple())